@@ -1,10 +1,14 @@
+import time
+
+# start of the startup time breakdown (see --startup_report)
+start_imports = time.perf_counter()
+
 import sys
 import asyncio
 from dotenv import load_dotenv
 import argparse
 import os
 from os.path import join, dirname
-import time
 
 main_path = dirname(os.getcwd())
 src_folder = os.path.join(main_path, "text2sql_epi")
@@ -19,12 +23,19 @@ from text2sql_epi.settings import settings
 from text2sql_epi.rag import AgentRag
 from text2sql_epi.sql_post_processor import MedicalSQLProcessor
 from text2sql_epi import helpers
-from text2sql_epi.snowflake_session import get_db
+from text2sql_epi.concept_cache import ConceptResolutionCache
+from text2sql_epi.llm_cache import LLMResponseCache
+from text2sql_epi.query_library import QueryLibrary
+from text2sql_epi.retrieval_executor import RetrievalExecutor
+
+# heavy libraries (sentence_transformers, torch, sklearn) are imported when the models load
+import_time = time.perf_counter() - start_imports
 
 
 async def end2end_pred_pipeline_ds(
     input_question, main_path_rag, querylib_file_rag, log_folder, med_coding=False, use_db=False,
-        medcodeonto_file=None
+        medcodeonto_file=None, concept_cache_file=None, embedding_server_url=None,
+        startup_report=False, llm_cache_file=None, llm_cache_mode=None, deployment_pool=None
 ):
 
     print(f"Use medical coding: {med_coding}")
@@ -37,17 +48,54 @@ async def end2end_pred_pipeline_ds(
         "drug": ["RxNorm", "RxNorm Extension"],
     }
 
-    time.sleep(1)
-
+    # the embedding model and the search index load in the background during the LLM calls
+    # the LLM is called with temperature=0: the responses of a rerun can be read from the cache
+    llm_cache = (
+        LLMResponseCache(llm_cache_file, mode=llm_cache_mode) if llm_cache_mode else None
+    )
     rag_agent = AgentRag(
-        main_path=main_path_rag, log_folder=log_folder, querylib_file=querylib_file_rag
+        main_path=main_path_rag, log_folder=log_folder, querylib_file=querylib_file_rag,
+        embedding_server_url=embedding_server_url, llm_cache=llm_cache,
+        deployment_pool=deployment_pool
     )
 
-    med_sql_processor = MedicalSQLProcessor(assistant=rag_agent.assistant)
+    if med_coding:
+        from text2sql_epi.query_library import MedCodingOnto
+        medcodeonto = MedCodingOnto(
+            ontolib_name="medcodes_mockup",
+            source="medcodes_mockup",
+            ontolib_source_file=None,
+            col_text="CONCEPT_NAME"
+        )
 
+        print(f"Loading embedding from {medcodeonto_file}")
+        medcodeonto = medcodeonto.load(querylib_file=medcodeonto_file)
+        if embedding_server_url is not None:
+            # the ontology shares the model of the server instead of loading its own copy
+            medcodeonto.encoder_backend = "remote"
+            medcodeonto.encoder_params = {"url": embedding_server_url}
+        medcodeonto.warm_up(background=True)
+
+    # the entries of previous ontology versions are deleted
+    concept_cache = (
+        ConceptResolutionCache(concept_cache_file, fingerprint=medcodeonto.get_fingerprint())
+        if med_coding
+        else None
+    )
+    med_sql_processor = MedicalSQLProcessor(
+        assistant=rag_agent.assistant, concept_cache=concept_cache
+    )
+
+    start = time.perf_counter()
     initial_prompt, text_sql_template, df_recs_list_out, question_masked = (
         await helpers.prepare_gpt_call(input_question, rag_agent)
     )
+    if startup_report:
+        report = {"imports": import_time, **rag_agent.get_startup_report()}
+        report["masking and retrieval"] = time.perf_counter() - start
+        print("Startup time breakdown (s), encoder and search index loaded in background:")
+        for name, duration in report.items():
+            print(f"  {name:<24} {'running' if duration is None else f'{duration:.2f}'}")
     gpt_answer = await rag_agent.assistant.get_response()
     df_recs_list_out = df_recs_list_out.astype({"DATE_LABELLED": str})
 
@@ -57,20 +105,8 @@ async def end2end_pred_pipeline_ds(
     print(f"SQL template:\n {query_template_pred}\n")
 
     if med_coding:
-        from text2sql_epi.query_library import MedCodingOnto
-        medcodeonto = MedCodingOnto(
-            ontolib_name="medcodes_mockup",
-            source="medcodes_mockup",
-            ontolib_source_file=None,
-            col_text="CONCEPT_NAME"
-        )
-
-        print(f"Loading embedding from {medcodeonto_file}")
-        medcodeonto = medcodeonto.load(querylib_file=medcodeonto_file)
-
         query_filled_pred = await med_sql_processor.post_process_sql_query(
             query_template_pred,
-            sleep_sec=rag_agent.sleep_sec,
             explorer_concepts=None,
             selected_coding=selected_coding,
             rag=rag_agent,
@@ -78,10 +114,14 @@ async def end2end_pred_pipeline_ds(
         )
 
         print(f"SQL filled:\n {query_filled_pred}\n")
+        print(f"Concept cache: {concept_cache.get_stats()}")
     else:
         query_filled_pred = None
 
     if use_db and query_filled_pred is not None:
+        # imported here: sqlalchemy is only needed with a database
+        from text2sql_epi.snowflake_session import get_db
+
         db = next(get_db(settings.SNOWFLAKE_DATABASE))
 
         new_prompt = rag_agent.assistant.conversation
@@ -109,6 +149,11 @@ async def end2end_pred_pipeline_ds(
         print(f"Database: {settings.SNOWFLAKE_DATABASE}\n")
         print(f"Answer: {answer}\n")
 
+    if llm_cache is not None:
+        print(f"LLM cache: {llm_cache.get_stats()}")
+    if deployment_pool is not None:
+        print(f"Deployments: {deployment_pool.get_stats()}")
+
 
 if __name__ == "__main__":
 
@@ -139,11 +184,74 @@ if __name__ == "__main__":
         help="Add here your question",
         type=str
     )
+    parser.add_argument(
+        "--retrieval_workers",
+        default=2,
+        help="Number of threads encoding and searching the query library and the ontology",
+        type=int
+    )
+
+    parser.add_argument(
+        "--concept_cache_file",
+        default=os.path.join(out_folder, "concept_cache.sqlite"),
+        help="SQLite cache of the concepts retrieved for the medical entities",
+        type=str
+    )
+
+    parser.add_argument(
+        "--embedding_server",
+        default=None,
+        help="URL of a shared embedding server (see run_embedding_server.py), e.g. "
+        "http://127.0.0.1:8765 or unix:///tmp/text2sql_embeddings.sock",
+        type=str
+    )
+
+    parser.add_argument(
+        "--llm_cache_mode",
+        default=None,
+        choices=["read_write", "write_only", "replay"],
+        help="cache of the LLM responses: read_write (read-through and write-through), "
+        "write_only (refresh) or replay (cached responses only, no LLM call)",
+        type=str
+    )
+    parser.add_argument(
+        "--llm_cache_file",
+        default=os.path.join(out_folder, "llm_cache.sqlite"),
+        help="SQLite cache of the LLM responses",
+        type=str
+    )
+
+    parser.add_argument(
+        "--deployment_pool",
+        default=None,
+        nargs="+",
+        help="equivalent assistant types whose deployments share the LLM calls, e.g. "
+        "gpt4turbo gpt4turbo-south (routed by latency and throttling, with failover)",
+        type=str
+    )
+
+    parser.add_argument(
+        "--startup_report",
+        action="store_true",
+        help="print the time spent in imports, library loading and model warm-up",
+    )
 
     args = parser.parse_args()
 
-    querylib_file = os.path.join(out_folder, "querylib.pkl")
-    medcodeonto_file_loaded = os.path.join(out_folder, "medcodes_onto.pkl")
+    QueryLibrary.retrieval_executor = RetrievalExecutor(max_workers=args.retrieval_workers)
+
+    querylib_file = os.path.join(out_folder, "querylib")
+    medcodeonto_file_loaded = os.path.join(out_folder, "medcodes_onto")
+
+    deployment_pool = None
+    if args.deployment_pool:
+        from text2sql_epi.assistants import get_engine_from_assistant_type
+        from text2sql_epi.deployment_pool import create_deployment_pool
+
+        deployment_pool = create_deployment_pool(
+            [get_engine_from_assistant_type(name) for name in args.deployment_pool],
+            name="+".join(args.deployment_pool),
+        )
 
     asyncio.run(
         end2end_pred_pipeline_ds(
@@ -152,7 +260,13 @@ if __name__ == "__main__":
             main_path_rag=main_path,
             log_folder=out_folder,
             med_coding=args.med_coding,
-            querylib_file_rag=os.path.join(out_folder, "querylib.pkl"),
+            querylib_file_rag=querylib_file,
             medcodeonto_file=medcodeonto_file_loaded,
+            concept_cache_file=args.concept_cache_file,
+            embedding_server_url=args.embedding_server,
+            startup_report=args.startup_report,
+            llm_cache_file=args.llm_cache_file,
+            llm_cache_mode=args.llm_cache_mode,
+            deployment_pool=deployment_pool,
         )
     )
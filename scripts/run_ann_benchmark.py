@@ -0,0 +1,157 @@
+import sys
+import os
+import argparse
+import tempfile
+import time
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    import numpy as np
+
+    from text2sql_epi.query_library import QueryLibrary
+    from text2sql_epi.search_index import (
+        HNSWIndex,
+        IVFIndex,
+        QuantizedIndex,
+        create_search_index,
+    )
+
+    out_folder = os.path.join(main_path, "data_out")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--index_dir",
+        default=None,
+        help="ontology index folder (default: synthetic embeddings)",
+        type=str,
+    )
+    parser.add_argument(
+        "--n_rows_synthetic",
+        default=200000,
+        help="number of rows of the synthetic embedding matrix",
+        type=int,
+    )
+    parser.add_argument(
+        "--dim_synthetic",
+        default=1024,
+        help="dimension of the synthetic embeddings (bge-large: 1024)",
+        type=int,
+    )
+    parser.add_argument("--n_queries", default=200, type=int)
+    parser.add_argument("--top_k", default=10, type=int)
+    parser.add_argument(
+        "--backends",
+        default=["exact", "ivf", "hnsw", "int8", "binary", "cascade"],
+        nargs="+",
+        help="search backends compared with the exact search",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    if args.index_dir is not None:
+        medcodeonto = QueryLibrary.load_index(args.index_dir)
+        embed_matrix = np.asarray(medcodeonto.embeddings[0]["embed_matrix"])
+    else:
+        # clustered synthetic embeddings, closer to real concept embeddings than uniform noise
+        n_clusters = max(1, args.n_rows_synthetic // 200)
+        centers = rng.standard_normal((n_clusters, args.dim_synthetic)).astype(np.float32)
+        embed_matrix = centers[rng.integers(0, n_clusters, args.n_rows_synthetic)]
+        embed_matrix += 0.8 * rng.standard_normal(embed_matrix.shape).astype(np.float32)
+        embed_matrix /= np.linalg.norm(embed_matrix, axis=1, keepdims=True)
+
+    # queries: perturbed rows of the index, like paraphrases of concept names
+    queries = embed_matrix[rng.choice(embed_matrix.shape[0], size=args.n_queries)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    print(f"Index: {embed_matrix.shape[0]} rows x {embed_matrix.shape[1]} dims")
+
+    # the float vectors are memory-mapped from disk, as in an index folder
+    tmp_dir = tempfile.mkdtemp()
+    np.save(os.path.join(tmp_dir, "embed_matrix.npy"), embed_matrix)
+    embed_matrix_mmap = np.load(os.path.join(tmp_dir, "embed_matrix.npy"), mmap_mode="r")
+
+    def index_memory_mb(search_index):
+        """Memory of the index structures scanned by every query, per worker"""
+        if isinstance(search_index, QuantizedIndex):
+            # float vectors stay on disk, only the rows of the rescored candidates are read
+            n_bytes = search_index.codes.nbytes + sum(
+                array.nbytes for array in search_index.get_quantization_arrays().values()
+            )
+        elif isinstance(search_index, HNSWIndex):
+            n_bytes = len(search_index) * (
+                search_index.embed_matrix.shape[1] * 4 + 2 * search_index.m * 4
+            )
+        elif isinstance(search_index, IVFIndex):
+            n_bytes = (
+                search_index.embed_matrix.nbytes
+                + search_index.centroids.nbytes
+                + search_index.list_rows.nbytes
+            )
+        else:
+            n_bytes = search_index.embed_matrix.nbytes
+        return n_bytes / 10 ** 6
+
+    def bench(search_index):
+        search_index.search(queries[:1], top_k=args.top_k)  # warm-up
+        latencies = []
+        idx_found = []
+        for query in queries:
+            start = time.perf_counter()
+            idx, _ = search_index.search(query[None, :], top_k=args.top_k)
+            latencies.append(time.perf_counter() - start)
+            idx_found.append(idx[0])
+        return np.array(latencies) * 1000, idx_found
+
+    configs = {
+        "exact": [{}],
+        "ivf": [{"n_probe": 4}, {"n_probe": 8}, {"n_probe": 16}],
+        "hnsw": [{"ef_search": 64}, {"ef_search": 128}, {"ef_search": 256}],
+        "int8": [{"n_rescore": 20}, {"n_rescore": 100}],
+        "binary": [{"n_rescore": 20}, {"n_rescore": 100}, {"n_rescore": 500}],
+        # truncated to the first 256 dimensions (see run_cascade_benchmark.py for the others)
+        "cascade": [{"n_rescore": 20}, {"n_rescore": 100}],
+    }
+
+    results = []
+    idx_exact = None
+    for backend in ["exact"] + [b for b in args.backends if b != "exact"]:
+        try:
+            start = time.perf_counter()
+            search_index = create_search_index(embed_matrix_mmap, backend=backend)
+            build_time = time.perf_counter() - start
+        except ImportError as e:
+            print(f"Skipping {backend}: {e}")
+            continue
+        for params in configs[backend]:
+            for key, value in params.items():
+                setattr(search_index, key, value)
+            latencies, idx_found = bench(search_index)
+            if idx_exact is None:
+                idx_exact = idx_found
+            recall = np.mean(
+                [
+                    len(np.intersect1d(found, exact)) / len(exact)
+                    for found, exact in zip(idx_found, idx_exact)
+                ]
+            )
+            label = f"{backend} " + ", ".join(f"{k}={v}" for k, v in params.items())
+            results.append(
+                (label, build_time, index_memory_mb(search_index), latencies, recall)
+            )
+
+    print(
+        f"\n{'backend':<28} {'build (s)':>10} {'memory (Mb)':>12} {'p50 (ms)':>10} "
+        f"{'p95 (ms)':>10} {'recall@' + str(args.top_k):>10}"
+    )
+    for label, build_time, memory_mb, latencies, recall in results:
+        print(
+            f"{label:<28} {build_time:>10.1f} {memory_mb:>12.1f} "
+            f"{np.percentile(latencies, 50):>10.2f} {np.percentile(latencies, 95):>10.2f} "
+            f"{recall:>10.3f}"
+        )
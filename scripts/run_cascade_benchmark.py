@@ -0,0 +1,183 @@
+import sys
+import os
+import argparse
+import time
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    import numpy as np
+    import pandas as pd
+
+    from text2sql_epi.encoders import create_encoder
+    from text2sql_epi.query_library import encode_texts
+    from text2sql_epi.search_index import CascadeIndex, EmbeddingIndex
+
+    in_folder = os.path.join(main_path, "dataset")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input_path",
+        default=in_folder,
+        help="path where the data is stored",
+        type=str,
+    )
+    parser.add_argument(
+        "--embedding_model_name",
+        default="BAAI/bge-large-en-v1.5",
+        help="model rescoring the candidates",
+        type=str,
+    )
+    parser.add_argument(
+        "--first_pass_model_name",
+        default="BAAI/bge-small-en-v1.5",
+        help="smaller model selecting the candidates (empty to only evaluate the truncation)",
+        type=str,
+    )
+    parser.add_argument(
+        "--truncate_dims",
+        default=[128, 256],
+        nargs="+",
+        help="dimensions kept by the truncated first pass",
+        type=int,
+    )
+    parser.add_argument(
+        "--n_rescore",
+        default=[50, 100, 200],
+        nargs="+",
+        help="numbers of candidates rescored with the large model",
+        type=int,
+    )
+    parser.add_argument(
+        "--n_rows_synthetic",
+        default=100000,
+        help="number of synthetic concept names added to the library",
+        type=int,
+    )
+    parser.add_argument("--n_queries", default=200, type=int)
+    parser.add_argument("--top_k", default=10, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    df_querylib = pd.read_excel(os.path.join(args.input_path, "text2sql_epi_dataset_omop.xlsx"))
+    df_concepts = pd.read_excel(os.path.join(args.input_path, "medcodes_mockup.xlsx"))
+    concept_names = df_concepts["CONCEPT_NAME"].astype(str).tolist()
+    # synthetic concept names made of the words of the mockup names, as a large vocabulary
+    words = sorted({word for name in concept_names for word in name.split()})
+    texts_library = (
+        concept_names
+        + df_querylib["QUESTION_MASKED"].astype(str).tolist()
+        + [
+            " ".join(rng.choice(words, size=n_words))
+            for n_words in rng.integers(2, 6, size=args.n_rows_synthetic)
+        ]
+    )
+    texts_queries = df_querylib["QUESTION"].astype(str).tolist() + concept_names
+    texts_queries = [
+        texts_queries[idx]
+        for idx in rng.choice(
+            len(texts_queries), size=min(args.n_queries, len(texts_queries)), replace=False
+        )
+    ]
+
+    models = {"large": args.embedding_model_name}
+    if args.first_pass_model_name:
+        models["small"] = args.first_pass_model_name
+
+    embed_library = {}
+    embed_queries = {}
+    cpu_encode = {}
+    for label, model_name in models.items():
+        encoder = create_encoder(model_name)
+        start = time.perf_counter()
+        embed_library[label] = encode_texts(encoder, texts_library, show_progress_bar=False)
+        print(
+            f"{len(texts_library)} library texts encoded with {model_name} "
+            f"(dim {embed_library[label].shape[1]}) in {time.perf_counter() - start:.1f} s"
+        )
+        # the pipeline encodes one query at a time
+        encoder.encode(texts_queries[:1], normalize_embeddings=True)
+        embed_queries[label] = []
+        start = time.process_time()
+        for text in texts_queries:
+            embed_queries[label].append(encoder.encode([text], normalize_embeddings=True)[0])
+        cpu_encode[label] = (time.process_time() - start) / len(texts_queries) * 1000
+        embed_queries[label] = np.asarray(embed_queries[label], dtype=np.float32)
+
+    def bench(search_index, queries_label="large", first_pass_label=None):
+        """:return: (positions of the records, CPU ms per query of the search)"""
+        def search(idx_query):
+            kwargs = {}
+            if first_pass_label is not None:
+                kwargs = {"first_pass_embeddings": embed_queries[first_pass_label][[idx_query]]}
+            query = embed_queries[queries_label][[idx_query]]
+            return search_index.search(query, top_k=args.top_k, **kwargs)[0][0]
+
+        search(0)  # warm-up
+        start = time.process_time()
+        idx_records = [search(idx_query) for idx_query in range(len(texts_queries))]
+        return np.array(idx_records), (time.process_time() - start) / len(texts_queries) * 1000
+
+    # reference: exact search with the large model
+    idx_exact, cpu_exact = bench(EmbeddingIndex(embed_library["large"]))
+    results = [("exact large", idx_exact, cpu_exact, cpu_encode["large"])]
+
+    if "small" in models:
+        idx_small, cpu_small = bench(EmbeddingIndex(embed_library["small"]), "small")
+        results.append(("exact small only", idx_small, cpu_small, cpu_encode["small"]))
+
+    for n_rescore in args.n_rescore:
+        for truncate_dim in args.truncate_dims:
+            if truncate_dim >= embed_library["large"].shape[1]:
+                continue
+            search_index = CascadeIndex(
+                embed_library["large"], n_rescore=n_rescore, truncate_dim=truncate_dim
+            )
+            idx_records, cpu_search = bench(search_index)
+            results.append(
+                (
+                    f"truncated {truncate_dim} / {n_rescore}",
+                    idx_records,
+                    cpu_search,
+                    cpu_encode["large"],
+                )
+            )
+        if "small" in models:
+            search_index = CascadeIndex(
+                embed_library["large"],
+                n_rescore=n_rescore,
+                first_pass_model_name=models["small"],
+                first_pass_matrix=embed_library["small"],
+            )
+            idx_records, cpu_search = bench(search_index, first_pass_label="small")
+            results.append(
+                (
+                    f"small model / {n_rescore}",
+                    idx_records,
+                    cpu_search,
+                    cpu_encode["large"] + cpu_encode["small"],
+                )
+            )
+
+    print(
+        f"\n{len(texts_library)} rows, {len(texts_queries)} queries, recall@{args.top_k} "
+        "against the exact search with the large model, CPU time per query"
+    )
+    print(
+        f"{'search':<24} {'recall':>7} {'search (ms)':>12} {'encode (ms)':>12} {'total (ms)':>11}"
+    )
+    for label, idx_records, cpu_search, cpu_query_encode in results:
+        recall = np.mean(
+            [
+                len(np.intersect1d(found, reference)) / len(reference)
+                for found, reference in zip(idx_records, idx_exact)
+            ]
+        )
+        print(
+            f"{label:<24} {recall:>7.3f} {cpu_search:>12.2f} {cpu_query_encode:>12.2f} "
+            f"{cpu_search + cpu_query_encode:>11.2f}"
+        )
@@ -0,0 +1,164 @@
+import sys
+import os
+import argparse
+import asyncio
+import logging
+import time
+from os.path import join
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    from dotenv import load_dotenv
+
+    load_dotenv(join(main_path, ".env.local"))
+
+    import numpy as np
+    from aiohttp import web
+
+    from text2sql_epi.assistants import GPTAssistant
+    from text2sql_epi.deployment_pool import create_deployment_pool
+    from text2sql_epi.offline import MockChatServer
+
+    logging.basicConfig(level=logging.ERROR)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--latencies_ms",
+        default=[300, 600, 300],
+        nargs="+",
+        help="latency of each mock deployment",
+        type=float,
+    )
+    parser.add_argument(
+        "--throttle_rates",
+        default=[0.0, 0.0, 0.3],
+        nargs="+",
+        help="share of 429 responses of each mock deployment",
+        type=float,
+    )
+    parser.add_argument(
+        "--error_rates",
+        default=[0.0, 0.0, 0.0],
+        nargs="+",
+        help="share of 500 responses of each mock deployment",
+        type=float,
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        default=4,
+        help="requests processed at once by each mock deployment",
+        type=int,
+    )
+    parser.add_argument(
+        "--retry_after_sec",
+        default=2,
+        help="Retry-After header of the throttled responses",
+        type=float,
+    )
+    parser.add_argument(
+        "--failure_cooldown_sec",
+        default=1,
+        help="time a failing deployment is skipped by the pool (doubled while it keeps failing)",
+        type=float,
+    )
+    parser.add_argument(
+        "--max_attempts",
+        default=3,
+        help="attempts of a request across the deployments",
+        type=int,
+    )
+    parser.add_argument("--n_requests", default=300, type=int)
+    parser.add_argument("--concurrency", default=16, type=int)
+    parser.add_argument("--first_port", default=8101, type=int)
+    args = parser.parse_args()
+
+    n_deployments = len(args.latencies_ms)
+    assert len(args.throttle_rates) == n_deployments and len(args.error_rates) == n_deployments
+    engines = [f"mock-deployment-{idx}" for idx in range(n_deployments)]
+
+    async def run_requests(pool):
+        """:return: latencies of the answered requests in seconds, number of failed requests,
+        total duration"""
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+
+        async def request(idx):
+            async with semaphore:
+                # one assistant per question, as in the pipeline
+                assistant = GPTAssistant(deployment_pool=pool)
+                start = time.perf_counter()
+                await assistant.get_response(f"Question {idx}. Masked text:")
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[request(idx) for idx in range(args.n_requests)], return_exceptions=True
+        )
+        n_failed = sum(isinstance(result, Exception) for result in results)
+        return np.array(latencies), n_failed, time.perf_counter() - start
+
+    async def main():
+        servers, runners, endpoints = [], [], {}
+        for idx, engine in enumerate(engines):
+            server = MockChatServer(
+                latency_ms=args.latencies_ms[idx],
+                throttle_rate=args.throttle_rates[idx],
+                error_rate=args.error_rates[idx],
+                retry_after_sec=args.retry_after_sec,
+                seed=idx,
+                max_concurrency=args.max_concurrency,
+            )
+            runner = web.AppRunner(server.create_app())
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", args.first_port + idx).start()
+            servers.append(server)
+            runners.append(runner)
+            endpoints[engine] = {
+                "azure_endpoint": f"http://127.0.0.1:{args.first_port + idx}",
+                "api_key": "mock",
+                "api_version": "2024-02-01",
+            }
+
+        print(
+            f"{args.n_requests} requests, {args.concurrency} concurrent, deployments processing "
+            f"{args.max_concurrency} requests at once: "
+            + ", ".join(
+                f"{engine} ({latency:.0f} ms, {throttle:.0%} 429, {error:.0%} 500)"
+                for engine, latency, throttle, error in zip(
+                    engines, args.latencies_ms, args.throttle_rates, args.error_rates
+                )
+            )
+        )
+        print(
+            f"{'routing':<24} {'req/s':>7} {'failed':>7} {'p50 (ms)':>9} {'p95 (ms)':>9}  "
+            "requests per deployment"
+        )
+        configs = [(f"only {engine}", [engine]) for engine in engines] + [("pool", engines)]
+        for label, pool_engines in configs:
+            for server in servers:
+                server.n_requests = server.n_throttled = server.n_errors = 0
+            pool = create_deployment_pool(
+                pool_engines,
+                endpoints=endpoints,
+                name=label,
+                rate_limits={},
+                failure_cooldown_sec=args.failure_cooldown_sec,
+                max_attempts=args.max_attempts,
+            )
+            latencies, n_failed, duration = await run_requests(pool)
+            if not len(latencies):
+                latencies = np.array([np.nan])
+            print(
+                f"{label:<24} {(args.n_requests - n_failed) / duration:>7.1f} {n_failed:>7} "
+                f"{np.percentile(latencies, 50) * 1000:>9.0f} "
+                f"{np.percentile(latencies, 95) * 1000:>9.0f}  "
+                + " ".join(str(server.get_stats()) for server in servers)
+            )
+        for runner in runners:
+            await runner.cleanup()
+
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+import sys
+import os
+import argparse
+import time
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    import numpy as np
+    import pandas as pd
+    from sentence_transformers import SentenceTransformer
+
+    from text2sql_epi.query_library import encode_texts
+
+    in_folder = os.path.join(main_path, "dataset")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input_path",
+        default=in_folder,
+        help="path where the data is stored",
+        type=str,
+    )
+    parser.add_argument(
+        "--embedding_model_name",
+        default="BAAI/bge-large-en-v1.5",
+        type=str,
+    )
+    parser.add_argument(
+        "--batch_size",
+        default=64,
+        help="number of texts encoded per forward pass",
+        type=int,
+    )
+    parser.add_argument(
+        "--num_processes",
+        default=None,
+        help="number of CPU processes used by the multi-process benchmark",
+        type=int,
+    )
+    parser.add_argument(
+        "--n_rows_synthetic",
+        default=20000,
+        help="number of rows of the synthetic scale-up of the ontology",
+        type=int,
+    )
+    args = parser.parse_args()
+
+    df_onto = pd.read_excel(os.path.join(args.input_path, "medcodes_mockup.xlsx"))
+    names = df_onto["CONCEPT_NAME"].astype(str).tolist()
+
+    # synthetic scale-up: combine concept names to obtain a vocabulary with realistic length spread
+    rng = np.random.default_rng(0)
+    names_synthetic = [
+        " ".join(rng.choice(names, size=rng.integers(1, 4)))
+        for _ in range(args.n_rows_synthetic)
+    ]
+
+    embedding_model = SentenceTransformer(args.embedding_model_name)
+
+    def run(label, texts, **kwargs):
+        start = time.perf_counter()
+        embed_matrix = encode_texts(
+            embedding_model, texts, show_progress_bar=False, **kwargs
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"{label:<45} rows: {len(texts):>8}  time: {elapsed:8.2f} s  "
+            f"throughput: {len(texts) / elapsed:8.1f} rows/s"
+        )
+        return embed_matrix
+
+    def run_row_by_row(label, texts):
+        start = time.perf_counter()
+        embed_matrix = np.stack(
+            [embedding_model.encode(text, normalize_embeddings=True) for text in texts]
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"{label:<45} rows: {len(texts):>8}  time: {elapsed:8.2f} s  "
+            f"throughput: {len(texts) / elapsed:8.1f} rows/s"
+        )
+        return embed_matrix
+
+    for dataset_name, texts in [
+        ("medcodes_mockup", names),
+        ("synthetic", names_synthetic),
+    ]:
+        print(f"\nDataset: {dataset_name}")
+        embed_ref = run_row_by_row("row by row (previous calc_embedding)", texts)
+        run(
+            f"batched, batch_size={args.batch_size}",
+            texts,
+            batch_size=args.batch_size,
+            sort_by_length=False,
+        )
+        embed_sorted = run(
+            f"batched + length sorted, batch_size={args.batch_size}",
+            texts,
+            batch_size=args.batch_size,
+        )
+        if args.num_processes is not None and args.num_processes > 1:
+            run(
+                f"length sorted, {args.num_processes} processes",
+                texts,
+                batch_size=args.batch_size,
+                num_processes=args.num_processes,
+            )
+        print(
+            "max abs difference to row by row embeddings: "
+            f"{np.abs(embed_sorted - embed_ref).max():.2e}"
+        )
@@ -0,0 +1,68 @@
+import sys
+import os
+import argparse
+import logging
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    from text2sql_epi.embedding_server import EmbeddingServer
+    from text2sql_epi.encoders import create_encoder
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--embedding_model_name",
+        default="BAAI/bge-large-en-v1.5",
+        type=str,
+    )
+    parser.add_argument(
+        "--encoder_backend",
+        default="torch",
+        choices=["torch", "onnx"],
+        help="encoder of the server: PyTorch or ONNX Runtime (requires onnxruntime and onnx)",
+        type=str,
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="use int8 weights with the onnx encoder",
+    )
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8765, type=int)
+    parser.add_argument(
+        "--unix_socket",
+        default=None,
+        help="path of a Unix socket to listen on instead of host and port",
+        type=str,
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        default=64,
+        help="maximum number of texts encoded together",
+        type=int,
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        default=5,
+        help="time a request waits for others to join its batch",
+        type=float,
+    )
+    args = parser.parse_args()
+
+    encoder = create_encoder(
+        args.embedding_model_name,
+        backend=args.encoder_backend,
+        **({"quantize": args.quantize} if args.encoder_backend == "onnx" else {}),
+    )
+    server = EmbeddingServer(
+        encoder,
+        model_name=args.embedding_model_name,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    server.run(host=args.host, port=args.port, unix_socket=args.unix_socket)
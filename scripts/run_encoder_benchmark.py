@@ -0,0 +1,103 @@
+import sys
+import os
+import argparse
+import time
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    import numpy as np
+    import pandas as pd
+
+    from text2sql_epi.encoders import create_encoder
+    from text2sql_epi.query_library import encode_texts
+    from text2sql_epi.search_index import EmbeddingIndex
+
+    in_folder = os.path.join(main_path, "dataset")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input_path",
+        default=in_folder,
+        help="path where the data is stored",
+        type=str,
+    )
+    parser.add_argument(
+        "--embedding_model_name",
+        default="BAAI/bge-large-en-v1.5",
+        type=str,
+    )
+    parser.add_argument(
+        "--onnx_dir",
+        default=None,
+        help="folder of the exported ONNX model (default: in ~/.cache/text2sql_epi/onnx)",
+        type=str,
+    )
+    parser.add_argument(
+        "--n_single", default=100, help="number of single-query encodings timed", type=int
+    )
+    parser.add_argument("--top_k", default=5, type=int)
+    args = parser.parse_args()
+
+    df_querylib = pd.read_excel(os.path.join(args.input_path, "text2sql_epi_dataset_omop.xlsx"))
+    df_concepts = pd.read_excel(os.path.join(args.input_path, "medcodes_mockup.xlsx"))
+    # library side: the masked questions, query side: the questions and the concept names
+    texts_library = df_querylib["QUESTION_MASKED"].astype(str).tolist()
+    texts_queries = (
+        df_querylib["QUESTION"].astype(str).tolist()
+        + df_concepts["CONCEPT_NAME"].astype(str).tolist()
+    )
+
+    encoders = {
+        "torch": create_encoder(args.embedding_model_name, backend="torch"),
+        "onnx": create_encoder(
+            args.embedding_model_name, backend="onnx", onnx_dir=args.onnx_dir
+        ),
+        "onnx int8": create_encoder(
+            args.embedding_model_name, backend="onnx", onnx_dir=args.onnx_dir, quantize=True
+        ),
+    }
+
+    # the library is always encoded with PyTorch, as with an existing index
+    library_index = EmbeddingIndex(
+        encode_texts(encoders["torch"], texts_library, show_progress_bar=False)
+    )
+
+    print(
+        f"{'encoder':<10} {'single p50 (ms)':>16} {'single p95 (ms)':>16} {'batch (texts/s)':>16}"
+        f" {'cosine min':>11} {'cosine mean':>12} {'top-1 agree':>12} {'top-k overlap':>14}"
+    )
+    embed_torch = None
+    idx_torch = None
+    for label, encoder in encoders.items():
+        encoder.encode(texts_queries[:1], normalize_embeddings=True)  # warm-up
+        latencies = []
+        for text in texts_queries[: args.n_single]:
+            start = time.perf_counter()
+            encoder.encode([text], normalize_embeddings=True)
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies) * 1000
+
+        start = time.perf_counter()
+        embed_queries = encode_texts(encoder, texts_queries, show_progress_bar=False)
+        throughput = len(texts_queries) / (time.perf_counter() - start)
+        idx_records, _ = library_index.search(embed_queries, top_k=args.top_k)
+
+        if embed_torch is None:
+            embed_torch, idx_torch = embed_queries, idx_records
+        cosine = (embed_queries * embed_torch).sum(axis=1)
+        top_1_agreement = np.mean(idx_records[:, 0] == idx_torch[:, 0])
+        top_k_overlap = np.mean(
+            [
+                len(np.intersect1d(found, reference)) / len(reference)
+                for found, reference in zip(idx_records, idx_torch)
+            ]
+        )
+        print(
+            f"{label:<10} {np.percentile(latencies, 50):>16.1f} "
+            f"{np.percentile(latencies, 95):>16.1f} {throughput:>16.1f} {cosine.min():>11.4f} "
+            f"{cosine.mean():>12.4f} {top_1_agreement:>12.3f} {top_k_overlap:>14.3f}"
+        )
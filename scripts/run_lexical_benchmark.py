@@ -0,0 +1,166 @@
+import sys
+import os
+import argparse
+import time
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    import numpy as np
+    import pandas as pd
+
+    from text2sql_epi.query_library import MedCodingOnto, QueryLibrary
+
+    in_folder = os.path.join(main_path, "dataset")
+    out_folder = os.path.join(main_path, "data_out")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--index_dir",
+        default=os.path.join(out_folder, "medcodes_onto"),
+        help="ontology index folder (see run_medcoding_calc.py), used for the encoding latency",
+        type=str,
+    )
+    parser.add_argument(
+        "--n_rows_synthetic",
+        default=500000,
+        help="number of concepts of the synthetic vocabulary (0 to skip it)",
+        type=int,
+    )
+    parser.add_argument("--dim", default=1024, help="embedding dimension", type=int)
+    parser.add_argument("--n_queries", default=200, type=int)
+    parser.add_argument("--top_k", default=10, type=int)
+    parser.add_argument(
+        "--top_k_prompt",
+        default=4,
+        help="concepts returned per name, a name is answered by the fast path if it matches a "
+        "concept name exactly or has as many lexical matches",
+        type=int,
+    )
+    parser.add_argument("--lexical_min_score", default=0.9, type=float)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    def perturb(name):
+        """Variants a placeholder name often has: case, punctuation, plural, one typo"""
+        variant = rng.integers(4)
+        if variant == 0:
+            return name.upper()
+        if variant == 1:
+            return name.replace(" ", "-")
+        if variant == 2:
+            return name + "s"
+        idx = rng.integers(len(name))
+        return name[:idx] + name[idx + 1 :]
+
+    def paraphrase(name, vocabulary):
+        """Names sharing few characters with any concept, left to the dense search"""
+        words = name.split()
+        words[rng.integers(len(words))] = str(rng.choice(vocabulary))
+        return " ".join(reversed(words))
+
+    def make_ontology(df_concepts):
+        medcodeonto = MedCodingOnto(
+            ontolib_name="benchmark",
+            source="benchmark",
+            ontolib_source_file=None,
+            col_text="CONCEPT_NAME",
+            lexical_min_score=args.lexical_min_score,
+        )
+        medcodeonto.df_querylib = df_concepts.sort_values(
+            ["DOMAIN_ID", "VOCABULARY_ID"], kind="stable"
+        ).reset_index(drop=True)
+        return medcodeonto
+
+    def bench(label, medcodeonto, embed_matrix):
+        names = medcodeonto.df_querylib["CONCEPT_NAME"].astype(str).tolist()
+        vocabulary = sorted({word for name in names for word in name.split()})
+        # the placeholders searched are conditions
+        rows_condition = np.flatnonzero(medcodeonto.df_querylib["DOMAIN_ID"] == "Condition")
+        sample = [names[idx] for idx in rng.choice(rows_condition, size=args.n_queries)]
+        query_sets = {
+            "exact": sample,
+            "perturbed": [perturb(name) for name in sample],
+            "paraphrased": [paraphrase(name, vocabulary) for name in sample],
+        }
+
+        start = time.perf_counter()
+        medcodeonto.get_lexical_index()
+        print(
+            f"\n{label}: {len(names)} concepts, lexical index built in "
+            f"{time.perf_counter() - start:.1f} s"
+        )
+
+        medcodeonto.embeddings = [{"model_name": "synthetic", "embed_matrix": embed_matrix}]
+        queries = rng.standard_normal((args.n_queries, embed_matrix.shape[1]), dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        medcodeonto.search_embeddings(queries[:1], top_k=args.top_k, domain_id="Condition")
+        latencies_dense = []
+        for query in queries:
+            start = time.perf_counter()
+            medcodeonto.search_embeddings(query[None, :], top_k=args.top_k, domain_id="Condition")
+            latencies_dense.append(time.perf_counter() - start)
+
+        print(f"{'queries':<12} {'fast path':>10} {'lexical p50 (ms)':>17} {'dense p50 (ms)':>15}")
+        for set_name, query_names in query_sets.items():
+            latencies_lexical = []
+            n_answered = 0
+            for name in query_names:
+                start = time.perf_counter()
+                result = medcodeonto.lexical_lookup(name, args.top_k_prompt, domain_id="Condition")
+                latencies_lexical.append(time.perf_counter() - start)
+                # names with fewer matches are completed by the dense search
+                n_answered += result is not None and (
+                    result[2] or len(result[0]) >= args.top_k_prompt
+                )
+            print(
+                f"{set_name:<12} {n_answered / len(query_names):>10.0%} "
+                f"{np.percentile(latencies_lexical, 50) * 1000:>17.2f} "
+                f"{np.percentile(latencies_dense, 50) * 1000:>15.2f}"
+            )
+
+    # mockup ontology of the repository
+    df_mockup = pd.read_excel(os.path.join(in_folder, "medcodes_mockup.xlsx"))
+    embed_mockup = rng.standard_normal((len(df_mockup), args.dim), dtype=np.float32)
+    bench("Mockup ontology", make_ontology(df_mockup), embed_mockup)
+
+    # synthetic large vocabulary: concept names made of the words of the mockup names
+    if args.n_rows_synthetic > 0:
+        words = sorted(
+            {word for name in df_mockup["CONCEPT_NAME"].astype(str) for word in name.split()}
+        )
+        n_words = rng.integers(2, 6, size=args.n_rows_synthetic)
+        df_synthetic = pd.DataFrame(
+            {
+                "CONCEPT_ID": np.arange(args.n_rows_synthetic),
+                "CONCEPT_NAME": [
+                    " ".join(rng.choice(words, size=n)) + f" {idx}"
+                    for idx, n in enumerate(n_words)
+                ],
+                "DOMAIN_ID": rng.choice(["Condition", "Drug", "Procedure"], args.n_rows_synthetic),
+                "VOCABULARY_ID": "SNOMED",
+            }
+        )
+        embed_synthetic = rng.standard_normal((args.n_rows_synthetic, args.dim), dtype=np.float32)
+        bench("Synthetic vocabulary", make_ontology(df_synthetic), embed_synthetic)
+
+    # the dense path also encodes the name, which the fast path skips
+    if os.path.exists(os.path.join(args.index_dir, "manifest.json")):
+        medcodeonto = QueryLibrary.load_index(args.index_dir)
+        medcodeonto.load_embedding_model(medcodeonto.embeddings[0]["model_name"])
+        medcodeonto.query_embedding_cache = None
+        latencies_encode = []
+        for name in df_mockup["CONCEPT_NAME"].astype(str).tolist()[: args.n_queries]:
+            start = time.perf_counter()
+            medcodeonto.encode_queries([name])
+            latencies_encode.append(time.perf_counter() - start)
+        print(
+            f"\nEncoding of one name with {medcodeonto.embeddings[0]['model_name']}: "
+            f"p50 {np.percentile(latencies_encode, 50) * 1000:.1f} ms"
+        )
+    else:
+        print(f"\nNo ontology index at {args.index_dir}: encoding latency not measured")
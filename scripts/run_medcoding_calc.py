@@ -31,10 +31,93 @@ if __name__ == "__main__":
         help="path where the query lib will be generated",
         type=str,
     )
+    parser.add_argument(
+        "--batch_size",
+        default=64,
+        help="number of texts encoded per forward pass",
+        type=int,
+    )
+    parser.add_argument(
+        "--num_processes",
+        default=None,
+        help="number of CPU processes used to encode the texts",
+        type=int,
+    )
+    parser.add_argument(
+        "--embedding_store_dir",
+        default=os.path.join(out_folder, "embedding_store"),
+        help="folder of the embedding store; only new or edited rows are re-encoded",
+        type=str,
+    )
+    parser.add_argument(
+        "--encoder_backend",
+        default="torch",
+        choices=["torch", "onnx"],
+        help="encoder of the texts and, later, of the queries: PyTorch or ONNX Runtime "
+        "(requires onnxruntime and onnx)",
+        type=str,
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="use int8 weights with the onnx encoder",
+    )
+    parser.add_argument(
+        "--search_backend",
+        default="exact",
+        choices=["exact", "ivf", "hnsw", "int8", "binary", "cascade"],
+        help="search index of the ontology: exact (brute force), approximate (ivf, hnsw), "
+        "quantised (int8, binary) or cascade (truncated embeddings or smaller model) with "
+        "exact rescoring",
+        type=str,
+    )
+    parser.add_argument(
+        "--ivf_n_lists",
+        default=None,
+        help="number of clusters of the ivf index (default: 4 * sqrt(number of concepts))",
+        type=int,
+    )
+    parser.add_argument(
+        "--ivf_n_probe",
+        default=8,
+        help="number of clusters scored per query by the ivf index",
+        type=int,
+    )
+    parser.add_argument(
+        "--hnsw_m",
+        default=32,
+        help="number of neighbours per node of the hnsw graph",
+        type=int,
+    )
+    parser.add_argument(
+        "--hnsw_ef_search",
+        default=128,
+        help="size of the candidate list of the hnsw search",
+        type=int,
+    )
+    parser.add_argument(
+        "--n_rescore",
+        default=100,
+        help="number of candidates of the quantised first pass rescored with float vectors",
+        type=int,
+    )
+    parser.add_argument(
+        "--truncate_dim",
+        default=256,
+        help="number of dimensions scored by the first pass of the cascade",
+        type=int,
+    )
+    parser.add_argument(
+        "--first_pass_model_name",
+        default=None,
+        help="smaller model selecting the candidates of the cascade instead of the truncated "
+        "embeddings (e.g. BAAI/bge-small-en-v1.5)",
+        type=str,
+    )
     args = parser.parse_args()
 
     medcodeonto_source_file = os.path.join(in_folder, "medcodes_mockup.xlsx")
-    medcodeonto_file = os.path.join(out_folder, "medcodes_onto.pkl")
+    medcodeonto_index_dir = os.path.join(out_folder, "medcodes_onto")
 
     medcodeonto = MedCodingOnto(
         ontolib_name="medcodes_mockup",
@@ -44,12 +127,43 @@ if __name__ == "__main__":
     )
 
     print(f"Calculating ontology embeddings from {medcodeonto_source_file}...")
-    medcodeonto.calc_embedding(embedding_model_name="BAAI/bge-large-en-v1.5")
-    medcodeonto.save(querylib_file=medcodeonto_file)
-    print(f"Embedding calculated and saved to {medcodeonto_file}")
+    medcodeonto.calc_embedding(
+        embedding_model_name="BAAI/bge-large-en-v1.5",
+        batch_size=args.batch_size,
+        num_processes=args.num_processes,
+        embedding_store_dir=args.embedding_store_dir,
+        encoder_backend=args.encoder_backend,
+        encoder_params={"quantize": args.quantize} if args.encoder_backend == "onnx" else {},
+    )
+    if args.search_backend == "cascade" and args.first_pass_model_name is not None:
+        print(f"Calculating first-pass embeddings with {args.first_pass_model_name}...")
+        medcodeonto.calc_embedding(
+            embedding_model_name=args.first_pass_model_name,
+            batch_size=args.batch_size,
+            num_processes=args.num_processes,
+            embedding_store_dir=args.embedding_store_dir,
+        )
+    if args.search_backend == "ivf":
+        search_params = {"n_lists": args.ivf_n_lists, "n_probe": args.ivf_n_probe}
+    elif args.search_backend == "hnsw":
+        search_params = {"m": args.hnsw_m, "ef_search": args.hnsw_ef_search}
+    elif args.search_backend in ["int8", "binary"]:
+        search_params = {"n_rescore": args.n_rescore}
+    elif args.search_backend == "cascade":
+        search_params = {
+            "n_rescore": args.n_rescore,
+            "truncate_dim": args.truncate_dim,
+            "first_pass_model_name": args.first_pass_model_name,
+        }
+    else:
+        search_params = {}
+    print(f"Building {args.search_backend} search index...")
+    medcodeonto.build_search_index(backend=args.search_backend, **search_params)
+    medcodeonto.save_index(index_dir=medcodeonto_index_dir)
+    print(f"Embedding calculated and saved to {medcodeonto_index_dir}")
 
-    print(f"Loading embedding from {medcodeonto_file}")
-    medcodeonto = medcodeonto.load(querylib_file=medcodeonto_file)
+    print(f"Loading embedding from {medcodeonto_index_dir}")
+    medcodeonto = medcodeonto.load(querylib_file=medcodeonto_index_dir)
     print(f"Ontology length: {len(medcodeonto)}")
     print("Done")
 
@@ -0,0 +1,58 @@
+import sys
+import os
+import argparse
+import logging
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    from text2sql_epi.offline import MockChatServer
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument(
+        "--latency_ms",
+        default=500,
+        help="response time of each request",
+        type=float,
+    )
+    parser.add_argument(
+        "--throttle_rate",
+        default=0.0,
+        help="share of the requests answered with 429 Too Many Requests",
+        type=float,
+    )
+    parser.add_argument(
+        "--error_rate",
+        default=0.0,
+        help="share of the requests answered with 500 Internal Server Error",
+        type=float,
+    )
+    parser.add_argument(
+        "--retry_after_sec",
+        default=1,
+        help="Retry-After header of the throttled responses",
+        type=float,
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        default=None,
+        help="number of requests processed at once (default: unlimited)",
+        type=int,
+    )
+    args = parser.parse_args()
+
+    server = MockChatServer(
+        latency_ms=args.latency_ms,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+        retry_after_sec=args.retry_after_sec,
+        max_concurrency=args.max_concurrency,
+    )
+    server.run(host=args.host, port=args.port)
@@ -0,0 +1,116 @@
+import sys
+import os
+import argparse
+import tempfile
+import time
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    import numpy as np
+    import pandas as pd
+
+    from text2sql_epi.parallel_search import parallel_search
+    from text2sql_epi.query_library import QueryLibrary
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--index_dir",
+        default=None,
+        help="query library or ontology index folder (default: synthetic embeddings)",
+        type=str,
+    )
+    parser.add_argument(
+        "--n_rows_synthetic",
+        default=200000,
+        help="number of rows of the synthetic embedding matrix",
+        type=int,
+    )
+    parser.add_argument(
+        "--dim_synthetic",
+        default=1024,
+        help="dimension of the synthetic embeddings (bge-large: 1024)",
+        type=int,
+    )
+    parser.add_argument("--n_queries", default=5000, type=int)
+    parser.add_argument("--top_k", default=10, type=int)
+    parser.add_argument(
+        "--max_rows", default=250, help="number of queries sent to a worker at once", type=int
+    )
+    parser.add_argument(
+        "--n_processes",
+        default=[1, 2, 4, 8],
+        nargs="+",
+        type=int,
+        help="pool sizes compared (1: search in the main process)",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    if args.index_dir is not None:
+        querylib = QueryLibrary.load_index(args.index_dir)
+    else:
+        embed_matrix = rng.standard_normal(
+            (args.n_rows_synthetic, args.dim_synthetic), dtype=np.float32
+        )
+        embed_matrix /= np.linalg.norm(embed_matrix, axis=1, keepdims=True)
+        querylib = QueryLibrary("synthetic", "synthetic", None, "QUESTION", "QUESTION", "QUERY")
+        querylib.df_querylib = pd.DataFrame(
+            {
+                "QUESTION": [f"question {idx}" for idx in range(len(embed_matrix))],
+                "QUERY": "",
+            }
+        )
+        querylib.embeddings = [{"model_name": "synthetic", "embed_matrix": embed_matrix}]
+        # the workers memory-map the saved matrix instead of receiving a copy
+        index_dir = os.path.join(tempfile.mkdtemp(), "querylib_synthetic")
+        querylib.save_index(index_dir)
+        querylib = QueryLibrary.load_index(index_dir)
+
+    embed_matrix = querylib.embeddings[0]["embed_matrix"]
+    queries = np.asarray(embed_matrix[rng.choice(embed_matrix.shape[0], size=args.n_queries)])
+    queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    print(
+        f"Index: {embed_matrix.shape[0]} rows x {embed_matrix.shape[1]} dims, "
+        f"{args.n_queries} queries, {os.cpu_count()} cores"
+    )
+    print(
+        f"\n{'n_processes':>12} {'first call (s)':>15} {'time (s)':>10} {'queries/s':>10} "
+        f"{'speed-up':>10}"
+    )
+
+    time_single = None
+    idx_single = None
+    for n_processes in args.n_processes:
+        times = []
+        # the first call of a pool size includes the start of the pool and the loading of the
+        # index by the workers, the next calls reuse the pool
+        for _ in range(2):
+            start = time.perf_counter()
+            if n_processes == 1:
+                idx_records, _ = querylib.search_embeddings(queries, top_k=args.top_k)
+            else:
+                idx_records, _ = parallel_search(
+                    querylib,
+                    queries,
+                    top_k=args.top_k,
+                    n_processes=n_processes,
+                    max_rows=args.max_rows,
+                )
+            times.append(time.perf_counter() - start)
+        elapsed = times[-1]
+
+        if time_single is None:
+            time_single, idx_single = elapsed, idx_records
+        elif not np.array_equal(idx_records, idx_single):
+            print(f"  results of {n_processes} processes differ from the first run")
+        print(
+            f"{n_processes:>12} {times[0]:>15.2f} {elapsed:>10.2f} "
+            f"{args.n_queries / elapsed:>10.0f} {time_single / elapsed:>10.2f}"
+        )
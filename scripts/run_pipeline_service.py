@@ -0,0 +1,169 @@
+import sys
+import os
+import argparse
+import logging
+from contextlib import contextmanager
+from os.path import join, dirname
+
+if __name__ == "__main__":
+    main_path = dirname(os.getcwd())
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    from dotenv import load_dotenv
+
+    load_dotenv(join(main_path, ".env.local"))
+
+    from text2sql_epi.concept_cache import ConceptResolutionCache
+    from text2sql_epi.pipeline_service import PipelineService
+    from text2sql_epi.query_library import QueryLibrary
+    from text2sql_epi.rag import AgentRag
+    from text2sql_epi.retrieval_executor import RetrievalExecutor
+
+    logging.basicConfig(level=logging.INFO)
+
+    out_folder = os.path.join(main_path, "data_out")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="answer with local stand-ins of the LLM and of the database (no network access)",
+    )
+    parser.add_argument(
+        "--llm_latency_ms",
+        default=500,
+        help="response time of the offline LLM",
+        type=float,
+    )
+    parser.add_argument(
+        "--db_latency_ms",
+        default=200,
+        help="execution time of the queries of the offline database",
+        type=float,
+    )
+    parser.add_argument(
+        "--med_coding",
+        action="store_true",
+        help="load the ontology to fill the placeholders of the SQL templates",
+    )
+    parser.add_argument(
+        "--use_db",
+        action="store_true",
+        help="run the queries (Snowflake, or the offline database with --offline)",
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        default=64,
+        help="maximum number of questions answered at once",
+        type=int,
+    )
+    parser.add_argument(
+        "--retrieval_workers",
+        default=2,
+        help="Number of threads encoding and searching the query library and the ontology",
+        type=int,
+    )
+    parser.add_argument(
+        "--concept_cache_file",
+        default=os.path.join(out_folder, "concept_cache.sqlite"),
+        help="SQLite cache of the concepts retrieved for the medical entities",
+        type=str,
+    )
+    parser.add_argument(
+        "--deployment_pool",
+        default=None,
+        nargs="+",
+        help="equivalent assistant types whose deployments share the LLM calls, e.g. "
+        "gpt4turbo gpt4turbo-south (routed by latency and throttling, with failover)",
+        type=str,
+    )
+    parser.add_argument(
+        "--embedding_server",
+        default=None,
+        help="URL of a shared embedding server (see run_embedding_server.py)",
+        type=str,
+    )
+    args = parser.parse_args()
+
+    QueryLibrary.retrieval_executor = RetrievalExecutor(max_workers=args.retrieval_workers)
+
+    if args.offline:
+        from text2sql_epi.offline import OfflineAssistant, OfflineDatabase
+
+        deployment_pool = None
+
+        def assistant_factory():
+            return OfflineAssistant(latency_ms=args.llm_latency_ms)
+
+        offline_database = OfflineDatabase(latency_ms=args.db_latency_ms)
+
+        @contextmanager
+        def database_factory():
+            yield offline_database
+
+    else:
+        from text2sql_epi.assistants import (
+            create_assistant,
+            create_openai_client,
+            get_engine_from_assistant_type,
+        )
+        from text2sql_epi.deployment_pool import create_deployment_pool
+        from text2sql_epi.settings import settings
+        from text2sql_epi.snowflake_session import get_db
+
+        deployment_pool, openai_client = None, None
+        if args.deployment_pool:
+            deployment_pool = create_deployment_pool(
+                [get_engine_from_assistant_type(name) for name in args.deployment_pool],
+                name="+".join(args.deployment_pool),
+            )
+        else:
+            # one connection pool for the LLM calls of all the questions
+            openai_client = create_openai_client()
+
+        def assistant_factory():
+            return create_assistant(
+                assistant_type="gpt4turbo", client=openai_client, deployment_pool=deployment_pool
+            )
+
+        # the sessions share the pooled engine of snowflake_session
+        database_factory = contextmanager(lambda: get_db(settings.SNOWFLAKE_DATABASE))
+
+    rag_agent = AgentRag(
+        main_path=main_path,
+        log_folder=out_folder,
+        querylib_file=os.path.join(out_folder, "querylib"),
+        embedding_server_url=args.embedding_server,
+        deployment_pool=deployment_pool,
+        assistant=assistant_factory(),
+        assistant_answers=assistant_factory(),
+    )
+
+    medcodeonto = None
+    if args.med_coding:
+        medcodeonto = QueryLibrary.load_index(os.path.join(out_folder, "medcodes_onto"))
+        if args.embedding_server is not None:
+            medcodeonto.encoder_backend = "remote"
+            medcodeonto.encoder_params = {"url": args.embedding_server}
+        medcodeonto.warm_up(background=True)
+
+    service = PipelineService(
+        rag_agent,
+        assistant_factory=assistant_factory,
+        medcodeonto=medcodeonto,
+        database_factory=database_factory if args.use_db else None,
+        # the entries of previous ontology versions are deleted
+        concept_cache=(
+            ConceptResolutionCache(
+                args.concept_cache_file, fingerprint=medcodeonto.get_fingerprint()
+            )
+            if args.med_coding
+            else None
+        ),
+        max_concurrency=args.max_concurrency,
+    )
+    service.run(host=args.host, port=args.port)
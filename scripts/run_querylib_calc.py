@@ -30,10 +30,41 @@ if __name__ == "__main__":
         help="path where the query lib will be generated",
         type=str,
     )
+    parser.add_argument(
+        "--batch_size",
+        default=64,
+        help="number of texts encoded per forward pass",
+        type=int,
+    )
+    parser.add_argument(
+        "--num_processes",
+        default=None,
+        help="number of CPU processes used to encode the texts",
+        type=int,
+    )
+    parser.add_argument(
+        "--embedding_store_dir",
+        default=os.path.join(out_folder, "embedding_store"),
+        help="folder of the embedding store; only new or edited rows are re-encoded",
+        type=str,
+    )
+    parser.add_argument(
+        "--encoder_backend",
+        default="torch",
+        choices=["torch", "onnx"],
+        help="encoder of the texts and, later, of the queries: PyTorch or ONNX Runtime "
+        "(requires onnxruntime and onnx)",
+        type=str,
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="use int8 weights with the onnx encoder",
+    )
     args = parser.parse_args()
 
     querylib_source_file = os.path.join(in_folder, "text2sql_epi_dataset_omop.xlsx")
-    querylib_file = os.path.join(out_folder, "querylib.pkl")
+    querylib_index_dir = os.path.join(out_folder, "querylib")
 
     querylib = QueryLibrary(
         querylib_name="patient_counts",
@@ -46,11 +77,18 @@ if __name__ == "__main__":
     )
 
     print(f"Calculating query library from {querylib_source_file}...")
-    querylib.calc_embedding(embedding_model_name="BAAI/bge-large-en-v1.5")
-    querylib.save(querylib_file=querylib_file)
-    print(f"Embedding calculated and saved to {querylib_file}")
+    querylib.calc_embedding(
+        embedding_model_name="BAAI/bge-large-en-v1.5",
+        batch_size=args.batch_size,
+        num_processes=args.num_processes,
+        embedding_store_dir=args.embedding_store_dir,
+        encoder_backend=args.encoder_backend,
+        encoder_params={"quantize": args.quantize} if args.encoder_backend == "onnx" else {},
+    )
+    querylib.save_index(index_dir=querylib_index_dir)
+    print(f"Embedding calculated and saved to {querylib_index_dir}")
 
-    print(f"Loading embedding from {querylib_file}")
-    querylib = querylib.load(querylib_file=querylib_file)
+    print(f"Loading embedding from {querylib_index_dir}")
+    querylib = querylib.load(querylib_file=querylib_index_dir)
     print(f"Query library length: {len(querylib)}")
     print("Done")
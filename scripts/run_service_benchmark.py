@@ -0,0 +1,80 @@
+import sys
+import os
+import argparse
+import asyncio
+import json
+import time
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    import aiohttp
+    import numpy as np
+    import pandas as pd
+
+    in_folder = os.path.join(main_path, "dataset")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--url",
+        default="http://127.0.0.1:8080",
+        help="URL of the service (see run_pipeline_service.py)",
+        type=str,
+    )
+    parser.add_argument("--n_questions", default=200, type=int)
+    parser.add_argument(
+        "--concurrency", default=32, help="number of questions in flight", type=int
+    )
+    parser.add_argument("--med_coding", action="store_true")
+    parser.add_argument("--use_db", action="store_true")
+    args = parser.parse_args()
+
+    df_querylib = pd.read_excel(os.path.join(in_folder, "text2sql_epi_dataset_omop.xlsx"))
+    questions = df_querylib["QUESTION"].astype(str).tolist()
+    questions = [questions[idx % len(questions)] for idx in range(args.n_questions)]
+
+    async def run():
+        latencies = []
+        n_errors = 0
+        queue = asyncio.Queue()
+        for question in questions:
+            queue.put_nowait(question)
+
+        async def worker(session):
+            nonlocal n_errors
+            while not queue.empty():
+                question = queue.get_nowait()
+                start = time.perf_counter()
+                async with session.post(
+                    f"{args.url}/predict",
+                    json={
+                        "question": question,
+                        "med_coding": args.med_coding,
+                        "use_db": args.use_db,
+                    },
+                ) as response:
+                    await response.read()
+                    n_errors += response.status != 200
+                latencies.append(time.perf_counter() - start)
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+            start = time.perf_counter()
+            await asyncio.gather(*[worker(session) for _ in range(args.concurrency)])
+            elapsed = time.perf_counter() - start
+            async with session.get(f"{args.url}/stats") as response:
+                stats = await response.json()
+
+        latencies = np.array(latencies) * 1000
+        print(
+            f"{len(questions)} questions, {args.concurrency} in flight: "
+            f"{len(questions) / elapsed:.1f} questions/s, {n_errors} errors, latency p50 "
+            f"{np.percentile(latencies, 50):.0f} ms, p95 {np.percentile(latencies, 95):.0f} ms, "
+            f"p99 {np.percentile(latencies, 99):.0f} ms"
+        )
+        print("Server statistics:")
+        print(json.dumps(stats, indent=2))
+
+    asyncio.run(run())
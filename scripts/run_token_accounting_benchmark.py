@@ -0,0 +1,109 @@
+import sys
+import os
+import argparse
+import time
+from os.path import join
+
+if __name__ == "__main__":
+    main_path = os.path.join(os.path.dirname(os.getcwd()))
+    src_folder = os.path.join(main_path, "text2sql_epi")
+    sys.path.append(main_path)
+    sys.path.append(src_folder)
+
+    from dotenv import load_dotenv
+
+    load_dotenv(join(main_path, ".env.local"))
+
+    import tiktoken
+
+    from text2sql_epi import helpers, prompts
+    from text2sql_epi.assistants import GPTAssistant
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--n_messages",
+        default=[10, 50, 200],
+        nargs="+",
+        help="numbers of messages added after the prompt of the pipeline",
+        type=int,
+    )
+    parser.add_argument(
+        "--message_chars",
+        default=1500,
+        help="length of the added messages (SQL templates, answers)",
+        type=int,
+    )
+    parser.add_argument("--repeats", default=3, type=int)
+    args = parser.parse_args()
+
+    class FullRecountAssistant(GPTAssistant):
+        """Previous accounting: the encoding is looked up and the whole conversation is
+        encoded again on every add_message"""
+
+        def num_tokens_from_messages(self, messages):
+            encoding = tiktoken.encoding_for_model("gpt-4-32k")
+            num_tokens = 0
+            for message in messages:
+                num_tokens += 4
+                for key, value in message.items():
+                    num_tokens += len(encoding.encode(value))
+                    if key == "name":
+                        num_tokens += -1
+            num_tokens += 2
+            return num_tokens
+
+        def add_message(self, role, message):
+            self.conversation.append({"role": role, "content": message})
+            self.manage_conversation_length()
+
+        def manage_conversation_length(self):
+            conv_history_tokens = self.num_tokens_from_messages(self.conversation)
+            while conv_history_tokens + self.max_response_tokens >= self.token_limit:
+                del self.conversation[1]
+                conv_history_tokens = self.num_tokens_from_messages(self.conversation)
+
+    sql_example = (
+        "SELECT COUNT(DISTINCT p.person_id) FROM person p JOIN condition_occurrence co "
+        "ON p.person_id = co.person_id WHERE co.condition_concept_id IN (<CONDITION_ID>) "
+    )
+
+    def bench(assistant_class, n_messages, repeat):
+        # no request is sent: the client is not used
+        assistant = assistant_class(engine="benchmark", client=False)
+        initial_prompt = helpers.prepare_prediction(
+            f"How many patients with condition {repeat}?", prompt=prompts.prompt_gpt
+        )
+        assistant.add_message("user", initial_prompt)
+        start = time.perf_counter()
+        for idx in range(n_messages):
+            role = "user" if idx % 2 == 0 else "assistant"
+            text = f"{repeat} {idx} " + sql_example * (args.message_chars // len(sql_example))
+            assistant.add_message(role, text)
+        return (time.perf_counter() - start) / n_messages * 1000, assistant
+
+    get_encoding_start = time.perf_counter()
+    tiktoken.encoding_for_model("gpt-4-32k")
+    print(f"First tiktoken.encoding_for_model: {time.perf_counter() - get_encoding_start:.3f} s")
+
+    print(
+        f"\nadd_message, {len(prompts.prompt_gpt)} chars pipeline prompt then messages of "
+        f"{args.message_chars} chars, token limit {GPTAssistant(client=False).token_limit}"
+    )
+    print(f"{'messages':>9} {'full recount (ms)':>18} {'incremental (ms)':>17} {'speed-up':>9}")
+    for n_messages in args.n_messages:
+        ms_full, ms_incremental = [], []
+        for repeat in range(args.repeats):
+            ms, assistant_full = bench(FullRecountAssistant, n_messages, repeat)
+            ms_full.append(ms)
+            ms, assistant = bench(GPTAssistant, n_messages, repeat)
+            ms_incremental.append(ms)
+            # both accountings trim the conversation the same way
+            assert assistant.conversation == assistant_full.conversation
+            assert assistant.get_conversation_tokens() == assistant.num_tokens_from_messages(
+                assistant.conversation
+            )
+        ms_full, ms_incremental = min(ms_full), min(ms_incremental)
+        print(
+            f"{n_messages:>9} {ms_full:>18.3f} {ms_incremental:>17.3f} "
+            f"{ms_full / ms_incremental:>8.1f}x"
+        )
@@ -0,0 +1,90 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# text2sql_epi.settings reads the credentials from the environment: dummy values for the tests,
+# which never connect to Snowflake or Azure
+for name in [
+    "SNOWFLAKE_USER",
+    "SNOWFLAKE_PASSWORD",
+    "SNOWFLAKE_ACCOUNT_IDENTIFIER",
+    "SNOWFLAKE_WAREHOUSE",
+    "SNOWFLAKE_DATABASE",
+    "OPENAI_API_KEY",
+    "OPENAI_API_VERSION",
+    "OPENAI_API_BASE",
+    "AZURE_CLIENT_ID",
+    "AZURE_CLIENT_SECRET",
+    "AZURE_TENANT_ID",
+]:
+    os.environ.setdefault(name, "test")
+
+
+class HashingEncoder:
+    """Deterministic encoder: the embedding of a text is the sum of random vectors of its words"""
+
+    def __init__(self, dim=32) -> None:
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, normalize_embeddings=False, **kwargs):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in str(text).lower().split():
+                seed = int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % 2**32
+                embeddings[row] += np.random.default_rng(seed).standard_normal(self.dim)
+        if normalize_embeddings:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
+
+
+@pytest.fixture
+def encoder():
+    return HashingEncoder()
+
+
+@pytest.fixture
+def make_library(encoder):
+    """
+    Factory of the query libraries and ontologies of the tests, embedded with the hashing encoder
+
+    :param texts: questions of the query library, concept names of the ontology
+    :param ontology: True for a MedCodingOnto, False for a QueryLibrary
+    :param name: name of the library
+    :param columns: dict of other columns of the data frame
+    :param embed_matrix: embeddings of the texts (default: those of the hashing encoder), None
+        with embed=False
+    :param embed: False to leave the library without embeddings, as before calc_embedding
+    :return: the library
+    """
+    # the test modules import the package after conftest has set the environment
+    from text2sql_epi.query_library import MedCodingOnto, QueryLibrary
+
+    def make_library(
+        texts, ontology=False, name="test", columns=None, embed_matrix=None, embed=True
+    ):
+        if ontology:
+            library = MedCodingOnto(
+                ontolib_name=name, source="test", ontolib_source_file=None, col_text="CONCEPT_NAME"
+            )
+            data = {"CONCEPT_ID": np.arange(len(texts)), "CONCEPT_NAME": list(texts)}
+        else:
+            library = QueryLibrary(name, "test", None, "QUESTION", "QUESTION", "QUERY")
+            data = {"QUESTION": list(texts), "QUERY": "SELECT 1"}
+        library.df_querylib = pd.DataFrame({**data, **(columns or {})})
+        if not embed:
+            return library
+        if embed_matrix is None:
+            embed_matrix = encoder.encode(list(texts), normalize_embeddings=True)
+        library.embeddings = [{"model_name": encoder.name, "embed_matrix": embed_matrix}]
+        library.embedding_model = encoder
+        library.query_embedding_cache = None
+        return library
+
+    return make_library
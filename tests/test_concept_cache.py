@@ -0,0 +1,80 @@
+import asyncio
+
+from text2sql_epi.concept_cache import ConceptResolutionCache
+from text2sql_epi.sql_post_processor import MedicalSQLProcessor
+
+
+def test_entries_of_other_ontology_versions_are_deleted_on_open(tmp_path):
+    cache_file = str(tmp_path / "concepts.sqlite")
+    cache = ConceptResolutionCache(cache_file)
+    for fingerprint in ["old", "current"]:
+        cache.put(fingerprint, cache.get_request_key("Asthma", "Condition", None), [{"id": 1}])
+    assert len(cache) == 2
+
+    cache = ConceptResolutionCache(cache_file, fingerprint="current")
+    assert len(cache) == 1
+    assert cache.get("current", cache.get_request_key("Asthma", "Condition", None)) == [
+        {"id": 1}
+    ]
+
+
+def test_oldest_entries_are_evicted(tmp_path):
+    cache = ConceptResolutionCache(str(tmp_path / "concepts.sqlite"), max_entries=3)
+    request_keys = [
+        cache.get_request_key(name, None, None) for name in ["a", "b", "c", "d", "e"]
+    ]
+    for request_key in request_keys:
+        cache.put("current", request_key, [])
+
+    assert len(cache) == 3
+    assert cache.get("current", request_keys[0]) is None
+    assert cache.get("current", request_keys[-1]) == []
+
+
+def test_concepts_are_cached_until_the_ontology_changes(make_library, tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "concepts.sqlite")
+    searched = []
+
+    def make_onto(concept_names):
+        medcodeonto = make_library(
+            concept_names,
+            ontology=True,
+            columns={"DOMAIN_ID": "Condition", "VOCABULARY_ID": "SNOMED"},
+        )
+        resolve_concepts = medcodeonto.resolve_concepts
+
+        def record_search(concept_requests, **kwargs):
+            searched.extend(concept_requests)
+            return resolve_concepts(concept_requests, **kwargs)
+
+        monkeypatch.setattr(medcodeonto, "resolve_concepts", record_search)
+        return medcodeonto
+
+    def resolve(medcodeonto):
+        # a new process: the cache is opened with the fingerprint of the loaded ontology
+        cache = ConceptResolutionCache(cache_file, fingerprint=medcodeonto.get_fingerprint())
+        resolved = asyncio.run(
+            MedicalSQLProcessor(concept_cache=cache).resolve_placeholders(
+                [("condition", "asthma")], None, medcodeonto
+            )
+        )
+        records = resolved[("condition", "asthma")]["asthma"]
+        return cache, [record["CONCEPT_NAME"] for record in records]
+
+    medcodeonto = make_onto(["Asthma", "Essential hypertension"])
+    cache, concept_names = resolve(medcodeonto)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert len(searched) == 1
+
+    cache, concept_names_cached = resolve(make_onto(["Asthma", "Essential hypertension"]))
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert len(searched) == 1
+    assert concept_names_cached == concept_names
+
+    # a concept added to the ontology changes its fingerprint
+    medcodeonto = make_onto(["Asthma", "Essential hypertension", "Allergic asthma"])
+    cache, concept_names = resolve(medcodeonto)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert len(searched) == 2
+    assert "Allergic asthma" in concept_names
+    assert len(cache) == 1
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+from text2sql_epi.deployment_pool import Deployment, DeploymentPool, create_deployment_pool
+from text2sql_epi.offline import MockChatServer
+from text2sql_epi.rate_limiter import RateLimiter
+
+MESSAGES = [{"role": "user", "content": "How many patients?"}]
+
+
+async def start_servers(servers):
+    """:return: runners of the mock deployments, endpoints of create_deployment_pool"""
+    runners, endpoints = [], {}
+    for engine, server in servers.items():
+        runner = web.AppRunner(server.create_app())
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        runners.append(runner)
+        endpoints[engine] = {
+            "azure_endpoint": f"http://127.0.0.1:{runner.addresses[0][1]}",
+            "api_key": "test",
+            "api_version": "2024-02-01",
+        }
+    return runners, endpoints
+
+
+async def run_requests(pool, n_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request():
+        async with semaphore:
+            return await pool.create_chat_completion(messages=MESSAGES, temperature=0)
+
+    return await asyncio.gather(*[request() for _ in range(n_requests)])
+
+
+def test_traffic_moves_to_the_faster_deployment():
+    async def main():
+        servers = {
+            "test-fast": MockChatServer(latency_ms=20, max_concurrency=4),
+            "test-slow": MockChatServer(latency_ms=200, max_concurrency=4),
+        }
+        runners, endpoints = await start_servers(servers)
+        try:
+            pool = create_deployment_pool(
+                list(servers), endpoints=endpoints, name="test-latency", rate_limits={}
+            )
+            responses = await run_requests(pool, n_requests=60, concurrency=4)
+        finally:
+            for runner in runners:
+                await runner.cleanup()
+        return servers, pool, responses
+
+    servers, pool, responses = asyncio.run(main())
+    assert len(responses) == 60
+    assert servers["test-fast"].n_requests > 3 * servers["test-slow"].n_requests
+    stats = {deployment["engine"]: deployment for deployment in pool.get_stats()}
+    assert stats["test-fast"]["latency_ms"] < stats["test-slow"]["latency_ms"]
+
+
+def test_failing_deployment_is_taken_out_and_brought_back():
+    async def main():
+        servers = {
+            "test-healthy": MockChatServer(latency_ms=300),
+            "test-failing": MockChatServer(latency_ms=10, error_rate=1.0),
+        }
+        runners, endpoints = await start_servers(servers)
+        try:
+            pool = create_deployment_pool(
+                list(servers),
+                endpoints=endpoints,
+                name="test-failover",
+                rate_limits={},
+                failure_cooldown_sec=2,
+            )
+            failing = pool.deployments[1]
+            # the failing deployment is tried, then skipped during its cooldown
+            responses = await run_requests(pool, n_requests=8, concurrency=4)
+            stats_failing = servers["test-failing"].get_stats()
+            is_taken_out = not failing.is_available(time.monotonic())
+
+            # once recovered, it gets requests again after its cooldown
+            servers["test-failing"].error_rate = 0.0
+            await asyncio.sleep(max(failing.unavailable_until - time.monotonic(), 0))
+            responses += await run_requests(pool, n_requests=20, concurrency=4)
+        finally:
+            for runner in runners:
+                await runner.cleanup()
+        return servers, responses, stats_failing, is_taken_out
+
+    servers, responses, stats_failing, is_taken_out = asyncio.run(main())
+    # all the requests were answered by failing over to the healthy deployment
+    assert len(responses) == 28
+    assert is_taken_out
+    # only the requests sent before the first failure reached the failing deployment
+    assert stats_failing["requests"] == stats_failing["errors"] <= 4
+    # the recovered deployment is faster: it answers most of the later requests
+    assert servers["test-failing"].n_requests - stats_failing["requests"] > 10
+
+
+def test_requests_avoid_a_deployment_without_budget():
+    # 6 requests per minute, one request of burst
+    limited = Deployment("limited", client=None, rate_limiter=RateLimiter(requests_per_minute=6))
+    other = Deployment("other", client=None, rate_limiter=RateLimiter(), initial_latency_sec=2.0)
+    pool = DeploymentPool([limited, other])
+
+    assert pool.select()[0] is limited
+    asyncio.run(limited.rate_limiter.acquire())
+    # the next request of limited waits about 10 s for its budget, other answers in 2 s
+    assert limited.get_expected_latency() > 9.0
+    assert pool.select()[0] is other
+
+
+def test_requests_avoid_a_deployment_without_token_budget():
+    limited = Deployment(
+        "limited", client=None, rate_limiter=RateLimiter(tokens_per_minute=6000)
+    )
+    other = Deployment("other", client=None, initial_latency_sec=2.0)
+    pool = DeploymentPool([limited, other])
+
+    # 1000 tokens of budget: a small request fits, a large one waits for the bucket to refill
+    assert pool.select(n_tokens=100)[0] is limited
+    assert pool.select(n_tokens=1000)[0] is limited
+    asyncio.run(limited.rate_limiter.acquire(900))
+    assert pool.select(n_tokens=50)[0] is limited
+    assert pool.select(n_tokens=800)[0] is other
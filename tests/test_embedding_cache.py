@@ -0,0 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from text2sql_epi.embedding_cache import QueryEmbeddingCache
+
+
+def test_counters_of_concurrent_lookups(encoder):
+    cache = QueryEmbeddingCache(max_size=100)
+    texts = [f"question {idx}" for idx in range(20)]
+
+    def encode(start):
+        return cache.encode(encoder, encoder.name, texts[start : start + 5])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(encode, list(range(16)) * 25))
+
+    stats = cache.get_stats()
+    assert stats["hits"] + stats["misses"] == 5 * 16 * 25
+    assert stats["size"] == 20
+    np.testing.assert_allclose(
+        results[0], encoder.encode(texts[:5], normalize_embeddings=False), rtol=1e-6
+    )
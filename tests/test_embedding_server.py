@@ -0,0 +1,84 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from aiohttp import web
+
+from text2sql_epi.embedding_server import EmbeddingServer
+from text2sql_epi.encoders import RemoteEncoder
+
+
+@pytest.fixture
+def start_server():
+    """Runs embedding servers on an event loop of a background thread, as in their own process"""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runners = []
+
+    def start_server(server):
+        async def start():
+            runner = web.AppRunner(server.create_app())
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", 0).start()
+            runners.append(runner)
+            return f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+        return asyncio.run_coroutine_threadsafe(start(), loop).result()
+
+    yield start_server
+    for runner in runners:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_concurrent_requests_are_encoded_in_one_batch(encoder, start_server):
+    batches = []
+    encode = encoder.encode
+
+    def record_batch(texts, **kwargs):
+        batches.append(list(texts))
+        return encode(texts, **kwargs)
+
+    encoder.encode = record_batch
+    texts_by_client = [
+        [f"patients with condition {client} {idx}" for idx in range(3)] for client in range(4)
+    ]
+    # the batch is encoded once the 12 texts are waiting, long before max_wait_ms
+    server = EmbeddingServer(encoder, "hashing", max_batch_size=12, max_wait_ms=10000)
+    url = start_server(server)
+
+    def run_client(texts):
+        return RemoteEncoder("hashing", url=url).encode(texts)
+
+    with ThreadPoolExecutor(max_workers=len(texts_by_client)) as executor:
+        embeddings = list(executor.map(run_client, texts_by_client))
+
+    assert len(batches) == 1
+    assert sorted(batches[0]) == sorted(text for texts in texts_by_client for text in texts)
+    # each client gets the embeddings of its own texts, in its order
+    for texts, client_embeddings in zip(texts_by_client, embeddings):
+        np.testing.assert_allclose(
+            client_embeddings, encode(texts, normalize_embeddings=True), rtol=1e-6
+        )
+    info = server.get_info()
+    assert (info["requests"], info["texts"], info["batches"]) == (4, 12, 1)
+
+
+def test_batches_do_not_wait_beyond_max_wait_ms(encoder, start_server):
+    server = EmbeddingServer(encoder, "hashing", max_batch_size=64, max_wait_ms=5)
+    remote_encoder = RemoteEncoder("hashing", url=start_server(server))
+
+    texts = ["asthma", "type 2 diabetes mellitus", "metformin"]
+    for text in texts:
+        embedding = encoder.encode([text], normalize_embeddings=True)[0]
+        np.testing.assert_allclose(remote_encoder.encode(text), embedding, rtol=1e-6)
+    np.testing.assert_allclose(
+        remote_encoder.encode(texts), encoder.encode(texts, normalize_embeddings=True), rtol=1e-6
+    )
+    # sequential requests are not held back for a batch that never fills
+    assert server.get_info()["batches"] == 4
@@ -0,0 +1,36 @@
+
+from text2sql_epi import query_library
+
+
+def test_libraries_sharing_a_store_dir_keep_their_embeddings(
+    make_library, encoder, tmp_path, monkeypatch
+):
+    encoded = []
+
+    class CountingEncoder(type(encoder)):
+        def encode(self, texts, **kwargs):
+            encoded.extend(texts)
+            return super().encode(texts, **kwargs)
+
+    monkeypatch.setattr(
+        query_library, "create_encoder", lambda model_name, **kwargs: CountingEncoder()
+    )
+    store_dir = str(tmp_path / "embedding_store")
+    questions = {
+        "patient_counts": ["How many patients have asthma?", "How many patients take metformin?"],
+        "medcodes": ["Asthma", "Metformin", "Type 2 diabetes mellitus"],
+    }
+
+    for name in ["patient_counts", "medcodes"]:
+        make_library(questions[name], name=name, embed=False).calc_embedding(
+            "hashing", embedding_store_dir=store_dir
+        )
+    assert len(encoded) == 5
+
+    # rebuilding both libraries reuses all their embeddings
+    encoded.clear()
+    for name in ["patient_counts", "medcodes"]:
+        querylib = make_library(questions[name], name=name, embed=False)
+        querylib.calc_embedding("hashing", embedding_store_dir=store_dir)
+        assert querylib.embeddings[0]["embed_matrix"].shape == (len(questions[name]), 32)
+    assert encoded == []
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from text2sql_epi.query_library import encode_texts
+
+# lengths in a random order, several chunks of 16 batches of 2 texts
+TEXTS = [
+    " ".join(f"word{(idx * 7 + word) % 50}" for word in range(length))
+    for idx, length in enumerate(np.random.default_rng(0).integers(1, 30, size=100))
+]
+
+
+def test_rows_keep_the_order_of_the_texts(encoder):
+    batches = []
+    encode = encoder.encode
+
+    def record_batch(texts, **kwargs):
+        batches.append(list(texts))
+        return encode(texts, **kwargs)
+
+    encoder.encode = record_batch
+    embed_matrix = encode_texts(encoder, TEXTS, batch_size=2, show_progress_bar=False)
+
+    np.testing.assert_allclose(
+        embed_matrix, encode(TEXTS, normalize_embeddings=True), rtol=1e-5, atol=1e-6
+    )
+    # the texts were encoded by decreasing length, in chunks of 16 batches
+    assert [len(batch) for batch in batches] == [32, 32, 32, 4]
+    lengths = [len(text) for batch in batches for text in batch]
+    assert lengths == sorted(lengths, reverse=True)
+
+
+@pytest.mark.parametrize("sort_by_length", [True, False])
+def test_rows_of_the_worker_processes_keep_the_order_of_the_texts(encoder, sort_by_length):
+    class PoolEncoder(type(encoder)):
+        """Encoder whose multi-process pool encodes in this process, without normalising"""
+
+        def start_multi_process_pool(self, target_devices):
+            return {"n_processes": len(target_devices)}
+
+        def encode_multi_process(self, texts, pool, batch_size=32, chunk_size=None):
+            return self.encode(texts)
+
+        def stop_multi_process_pool(self, pool):
+            pass
+
+    embed_matrix = encode_texts(
+        PoolEncoder(),
+        TEXTS,
+        sort_by_length=sort_by_length,
+        num_processes=2,
+        show_progress_bar=False,
+    )
+    np.testing.assert_allclose(
+        embed_matrix, encoder.encode(TEXTS, normalize_embeddings=True), rtol=1e-5, atol=1e-6
+    )
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("sentence_transformers")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from text2sql_epi.encoders import OnnxEncoder, SentenceTransformerEncoder  # noqa: E402
+
+TEXTS = [
+    "How many patients have asthma?",
+    "Type 2 diabetes mellitus",
+    "metformin",
+    "Number of patients with essential hypertension treated with atorvastatin after 2015",
+]
+
+
+@pytest.fixture(scope="module", params=["mean", "cls"])
+def model_dir(request, tmp_path_factory):
+    """Small randomly initialised SentenceTransformer model, saved locally (no download)"""
+    from sentence_transformers import SentenceTransformer, models
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    model_dir = tmp_path_factory.mktemp(f"model_{request.param}")
+    words = sorted({word for text in TEXTS for word in text.lower().replace("?", " ?").split()})
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words
+    vocab_file = model_dir / "vocab.txt"
+    vocab_file.write_text("\n".join(vocab))
+
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        max_position_embeddings=64,
+    )
+    transformer_dir = str(model_dir / "transformer")
+    BertModel(config).save_pretrained(transformer_dir)
+    BertTokenizerFast(vocab_file=str(vocab_file)).save_pretrained(transformer_dir)
+
+    transformer = models.Transformer(transformer_dir, max_seq_length=32)
+    pooling = models.Pooling(32, pooling_mode=request.param)
+    st_dir = str(model_dir / "sentence_transformer")
+    SentenceTransformer(modules=[transformer, pooling]).save(st_dir)
+    return st_dir
+
+
+def test_onnx_encoder_matches_the_torch_encoder(model_dir, tmp_path):
+    torch_encoder = SentenceTransformerEncoder(model_dir)
+    onnx_encoder = OnnxEncoder(model_dir, onnx_dir=str(tmp_path / "onnx"))
+    assert onnx_encoder.get_sentence_embedding_dimension() == 32
+    assert onnx_encoder.name == f"{model_dir}@onnx"
+
+    for normalize_embeddings in [False, True]:
+        embeddings = onnx_encoder.encode(
+            TEXTS, batch_size=2, normalize_embeddings=normalize_embeddings
+        )
+        np.testing.assert_allclose(
+            embeddings,
+            torch_encoder.encode(TEXTS, normalize_embeddings=normalize_embeddings),
+            atol=1e-5,
+        )
+    # a single text is encoded to a vector, as with SentenceTransformer.encode
+    np.testing.assert_allclose(
+        onnx_encoder.encode(TEXTS[2], normalize_embeddings=True), embeddings[2], atol=1e-6
+    )
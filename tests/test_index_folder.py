@@ -0,0 +1,99 @@
+import json
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from text2sql_epi.query_library import INDEX_MANIFEST_FILE, QueryLibrary
+
+QUESTIONS = [
+    "How many patients have asthma?",
+    "How many patients take metformin?",
+    "Number of patients with type 2 diabetes mellitus",
+]
+
+
+@pytest.fixture
+def querylib(make_library):
+    querylib = make_library(
+        QUESTIONS,
+        columns={
+            "N_PATIENTS": np.array([120, 45, 3000], dtype=np.int64),
+            "SCORE": np.array([0.5, np.nan, 1.0]),
+            "IS_VALIDATED": [True, False, True],
+            "DATE_LABELLED": pd.to_datetime(["2023-01-05", "2023-02-10", None]),
+            "COMMENT": ["checked", None, "to review"],
+        },
+    )
+    querylib.date_live = date(2024, 3, 1)
+    querylib.encoder_backend = "onnx"
+    querylib.encoder_params = {"quantize": True}
+    return querylib
+
+
+def test_save_and_load_keep_the_library(querylib, encoder, tmp_path):
+    querylib.save_index(str(tmp_path))
+    querylib_loaded = QueryLibrary.load_index(str(tmp_path))
+
+    assert type(querylib_loaded) is QueryLibrary
+    for attribute in [
+        "querylib_name",
+        "source",
+        "date_live",
+        "col_question",
+        "col_question_masked",
+        "col_query_w_placeholders",
+        "col_query_executable",
+        "encoder_backend",
+        "encoder_params",
+    ]:
+        assert getattr(querylib_loaded, attribute) == getattr(querylib, attribute)
+    # same columns, values and dtypes
+    pd.testing.assert_frame_equal(querylib_loaded.df_querylib, querylib.df_querylib)
+
+    with open(tmp_path / INDEX_MANIFEST_FILE, "r") as in_file:
+        manifest = json.load(in_file)
+    assert manifest["n_rows"] == len(QUESTIONS)
+    assert manifest["embeddings"][0]["shape"] == [len(QUESTIONS), encoder.dim]
+    assert manifest["embeddings"][0]["rows_normalized"]
+
+    # the embeddings are memory-mapped read-only, not read in memory
+    embed_matrix = querylib_loaded.embeddings[0]["embed_matrix"]
+    assert isinstance(embed_matrix, np.memmap)
+    assert embed_matrix.mode == "r" and embed_matrix.dtype == np.float32
+    assert not embed_matrix.flags.writeable
+    np.testing.assert_array_equal(embed_matrix, querylib.embeddings[0]["embed_matrix"])
+
+    querylib_loaded.embedding_model = encoder
+    querylib_loaded.query_embedding_cache = None
+    idx_records, _ = querylib_loaded.get_similar_questions(
+        [[QUESTIONS[1]]], top_k=1, return_arrays=True
+    )
+    assert idx_records.tolist() == [[1]]
+
+
+def test_load_index_in_memory(querylib, tmp_path):
+    querylib.save_index(str(tmp_path))
+    embed_matrix = QueryLibrary.load_index(str(tmp_path), mmap_mode=None).embeddings[0][
+        "embed_matrix"
+    ]
+    assert not isinstance(embed_matrix, np.memmap)
+    np.testing.assert_array_equal(embed_matrix, querylib.embeddings[0]["embed_matrix"])
+
+
+def test_mixed_type_columns_are_saved_as_strings(querylib, tmp_path):
+    querylib.df_querylib["N_PATIENTS"] = [120, "unknown", 3000]
+    querylib.save_index(str(tmp_path))
+    df_loaded = QueryLibrary.load_index(str(tmp_path)).df_querylib
+    assert df_loaded["N_PATIENTS"].tolist() == ["120", "unknown", "3000"]
+
+
+def test_newer_format_versions_are_refused(querylib, tmp_path):
+    querylib.save_index(str(tmp_path))
+    manifest_file = tmp_path / INDEX_MANIFEST_FILE
+    manifest = json.loads(manifest_file.read_text())
+    manifest["format_version"] += 1
+    manifest_file.write_text(json.dumps(manifest))
+    with pytest.raises(ValueError, match="not supported"):
+        QueryLibrary.load_index(str(tmp_path))
@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from text2sql_epi import assistants
+from text2sql_epi.assistants import GPTAssistant
+from text2sql_epi.llm_cache import LLMCacheMiss, LLMResponseCache
+
+
+@pytest.fixture
+def make_assistant(monkeypatch):
+    """Factory of GPT assistants whose LLM answers with the number of calls so far"""
+    # no tiktoken encoding to download: the tokens are not checked by these tests
+    monkeypatch.setattr(assistants, "count_text_tokens", len)
+    llm_calls = []
+
+    def make_assistant(response_cache):
+        assistant = GPTAssistant(engine="test", client=object(), response_cache=response_cache)
+
+        async def create_chat_completion(messages, message_tokens, **kwargs):
+            llm_calls.append(messages)
+            content = f"answer {len(llm_calls)}"
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None
+            )
+
+        assistant.create_chat_completion = create_chat_completion
+        return assistant
+
+    make_assistant.llm_calls = llm_calls
+    return make_assistant
+
+
+def test_replay_answers_from_the_cache_and_raises_on_a_miss(make_assistant, tmp_path):
+    cache_file = str(tmp_path / "llm_cache.sqlite")
+    recorded = asyncio.run(
+        make_assistant(LLMResponseCache(cache_file)).get_response("How many patients?")
+    )
+    assert len(make_assistant.llm_calls) == 1
+
+    cache = LLMResponseCache(cache_file, mode="replay")
+    assistant = make_assistant(cache)
+    assert asyncio.run(assistant.get_response("How many patients?")) == recorded
+    with pytest.raises(LLMCacheMiss):
+        asyncio.run(assistant.get_response("How many patients have asthma?"))
+    # the miss neither called the LLM nor stored a response
+    assert len(make_assistant.llm_calls) == 1
+    assert len(cache) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_write_only_calls_the_llm_and_refreshes_the_cache(make_assistant, tmp_path):
+    cache_file = str(tmp_path / "llm_cache.sqlite")
+    asyncio.run(make_assistant(LLMResponseCache(cache_file)).get_response("How many patients?"))
+
+    cache = LLMResponseCache(cache_file, mode="write_only")
+    assistant = make_assistant(cache)
+    # the cached response is not read
+    assert asyncio.run(assistant.get_response("How many patients?")) == "answer 2"
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert len(cache) == 1
+
+    replay_assistant = make_assistant(LLMResponseCache(cache_file, mode="replay"))
+    assert asyncio.run(replay_assistant.get_response("How many patients?")) == "answer 2"
+    assert len(make_assistant.llm_calls) == 2
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from text2sql_epi.query_library import MedCodingOnto, QueryLibrary
+from text2sql_epi.search_index import EmbeddingIndex
+
+CONCEPT_NAMES = [
+    ("Type 2 diabetes mellitus", "Condition", "SNOMED"),
+    ("Type 1 diabetes mellitus", "Condition", "SNOMED"),
+    ("Essential hypertension", "Condition", "SNOMED"),
+    ("Asthma", "Condition", "SNOMED"),
+    ("Chronic kidney disease", "Condition", "ICD10CM"),
+    ("Metformin", "Drug", "RxNorm"),
+    ("Insulin glargine", "Drug", "RxNorm"),
+    ("Atorvastatin", "Drug", "RxNorm"),
+]
+
+
+@pytest.fixture
+def medcodeonto(make_library):
+    return make_library(
+        [name for name, _, _ in CONCEPT_NAMES],
+        ontology=True,
+        columns={
+            "DOMAIN_ID": [domain_id for _, domain_id, _ in CONCEPT_NAMES],
+            "VOCABULARY_ID": [vocabulary_id for _, _, vocabulary_id in CONCEPT_NAMES],
+        },
+    )
+
+
+def load_onto(medcodeonto, index_dir, encoder):
+    medcodeonto.save_index(str(index_dir))
+    medcodeonto_loaded = QueryLibrary.load_index(str(index_dir))
+    medcodeonto_loaded.embedding_model = encoder
+    medcodeonto_loaded.query_embedding_cache = None
+    return medcodeonto_loaded
+
+
+def test_lexical_settings_survive_save_and_load(medcodeonto, encoder, tmp_path):
+    medcodeonto.lexical_min_score = 0.8
+    medcodeonto.resolve_concepts(
+        [("asthma", None, None)], top_k_screening=5, top_k_prompt=1, sim_threshold=None
+    )
+    medcodeonto_loaded = load_onto(medcodeonto, tmp_path / "index", encoder)
+
+    assert isinstance(medcodeonto_loaded, MedCodingOnto)
+    assert medcodeonto_loaded.lexical_min_score == 0.8
+    assert medcodeonto_loaded.get_lexical_stats()["lexical"] == 0
+
+    [df_concepts] = medcodeonto_loaded.resolve_concepts(
+        [("ASTHMA", "Condition", None)], top_k_screening=5, top_k_prompt=1, sim_threshold=None
+    )
+    assert df_concepts["CONCEPT_NAME"].tolist() == ["Asthma"]
+    assert medcodeonto_loaded.get_lexical_stats() == {
+        "lexical": 1,
+        "dense": 0,
+        "lexical_rate": 1.0,
+    }
+
+
+def test_exact_matches_skip_the_dense_search(medcodeonto, encoder, tmp_path):
+    medcodeonto_loaded = load_onto(medcodeonto, tmp_path / "index", encoder)
+    # the name is not encoded: an encoder call would fail
+    medcodeonto_loaded.embedding_model = None
+    medcodeonto_loaded.load_embedding_model = None
+    [df_concepts] = medcodeonto_loaded.resolve_concepts(
+        [("Type 2 Diabetes-Mellitus", "Condition", None)],
+        top_k_screening=5,
+        top_k_prompt=3,
+        sim_threshold=0.99,
+    )
+
+    # the exact match is padded with its trigram neighbours, whatever their score
+    assert df_concepts["CONCEPT_NAME"].tolist()[:2] == [
+        "Type 2 diabetes mellitus",
+        "Type 1 diabetes mellitus",
+    ]
+    assert df_concepts["Score"].iloc[0] == 1.0
+    assert df_concepts["CONCEPT_NAME"].is_unique
+    assert (df_concepts["DOMAIN_ID"] == "Condition").all()
+    assert medcodeonto_loaded.get_lexical_stats()["dense"] == 0
+
+
+def test_lexical_matches_are_completed_by_the_dense_search(medcodeonto, encoder, tmp_path):
+    medcodeonto_loaded = load_onto(medcodeonto, tmp_path / "index", encoder)
+    # the dense search only keeps scores above sim_threshold, not the lexical matches
+    [df_concepts] = medcodeonto_loaded.resolve_concepts(
+        [("type 2 diabetes melitus", "Condition", None)],
+        top_k_screening=5,
+        top_k_prompt=3,
+        sim_threshold=0.0,
+    )
+
+    assert len(df_concepts) == 3
+    assert df_concepts["CONCEPT_NAME"].iloc[0] == "Type 2 diabetes mellitus"
+    assert df_concepts["Score"].iloc[0] > 0.9
+    assert df_concepts["CONCEPT_NAME"].is_unique
+    assert (df_concepts["DOMAIN_ID"] == "Condition").all()
+    assert medcodeonto_loaded.get_lexical_stats()["dense"] == 1
+
+
+def test_lexical_path_disabled(medcodeonto, encoder, tmp_path):
+    medcodeonto.lexical_min_score = None
+    medcodeonto_loaded = load_onto(medcodeonto, tmp_path / "index", encoder)
+
+    assert medcodeonto_loaded.lexical_lookup("Asthma", 1) is None
+    medcodeonto_loaded.resolve_concepts(
+        [("Asthma", None, None)], top_k_screening=5, top_k_prompt=1, sim_threshold=None
+    )
+    assert medcodeonto_loaded.get_lexical_stats()["dense"] == 1
+
+
+def test_answer_counters_of_concurrent_retrievals(medcodeonto):
+    from concurrent.futures import ThreadPoolExecutor
+
+    names = [name for name, _, _ in CONCEPT_NAMES] + ["diabetes", "kidney failure"]
+
+    def resolve(name):
+        return medcodeonto.resolve_concepts(
+            [(name, None, None)], top_k_screening=5, top_k_prompt=1, sim_threshold=None
+        )
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(resolve, names * 50))
+
+    stats = medcodeonto.get_lexical_stats()
+    assert stats["lexical"] + stats["dense"] == len(names) * 50
+    assert stats["lexical"] >= len(CONCEPT_NAMES) * 50
+
+
+@pytest.mark.parametrize("backend", ["exact", "int8", "cascade"])
+def test_partition_indices_are_views_of_the_search_index(medcodeonto, encoder, tmp_path, backend):
+    params = {"truncate_dim": 16} if backend == "cascade" else {}
+    medcodeonto.build_search_index(backend=backend, **params)
+    medcodeonto_loaded = load_onto(medcodeonto, tmp_path / "index", encoder)
+
+    search_index = medcodeonto_loaded.get_search_index()
+    partition_indices = medcodeonto_loaded.get_partition_indices(domain_id="Condition")
+    assert sum(len(partition_index) for partition_index in partition_indices) == 5
+    for partition_index in partition_indices:
+        assert np.shares_memory(partition_index.embed_matrix, search_index.embed_matrix)
+        if backend != "exact":
+            assert np.shares_memory(partition_index.codes, search_index.codes)
+
+    queries = encoder.encode(["diabetes", "metformin"], normalize_embeddings=True)
+    idx_records, _ = medcodeonto_loaded.search_embeddings(queries, top_k=3, domain_id="Condition")
+    idx_exact, _ = EmbeddingIndex(medcodeonto.embeddings[0]["embed_matrix"][:5]).search(
+        queries, top_k=3
+    )
+    np.testing.assert_array_equal(idx_records, idx_exact)
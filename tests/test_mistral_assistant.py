@@ -0,0 +1,148 @@
+import asyncio
+import socket
+import time
+
+import pytest
+from aiohttp import web
+
+from text2sql_epi import assistants
+from text2sql_epi.assistants import MistralAssistant
+from text2sql_epi.rate_limiter import RateLimiter
+
+
+@pytest.fixture(autouse=True)
+def word_token_counts(monkeypatch):
+    # the tiktoken encoding is downloaded at its first use: the tests count words instead
+    monkeypatch.setattr(assistants, "count_text_tokens", lambda text: len(text.split()))
+
+
+class ScriptedChatServer:
+    """Chat completions endpoint answering with a list of (status, delay in seconds, headers)"""
+
+    def __init__(self, script) -> None:
+        self.script = list(script)
+        self.n_requests = 0
+
+    async def handle(self, request):
+        await request.json()
+        status, delay_sec, headers = self.script[min(self.n_requests, len(self.script) - 1)]
+        self.n_requests += 1
+        await asyncio.sleep(delay_sec)
+        if status != 200:
+            return web.Response(status=status, text="mock error", headers=headers)
+        return web.json_response(
+            {"choices": [{"message": {"role": "assistant", "content": "SELECT 1"}}]}
+        )
+
+
+async def start_server(server, port=0):
+    """:return: (AppRunner of the server, port)"""
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, runner.addresses[0][1]
+
+
+def create_assistant(port, **assistant_kwargs):
+    return MistralAssistant(
+        "mistral-small",
+        mistral_api_key="test",
+        url=f"http://127.0.0.1:{port}/v1/chat/completions",
+        backoff_sec=0.01,
+        rate_limiter=RateLimiter(),
+        **assistant_kwargs,
+    )
+
+
+async def call_server(script, prompt="How many patients?", **assistant_kwargs):
+    """:return: (response or exception, server, assistant)"""
+    server = ScriptedChatServer(script)
+    runner, port = await start_server(server)
+    assistant = create_assistant(port, **assistant_kwargs)
+    try:
+        result = await assistant.get_response(prompt)
+    except Exception as err:
+        result = err
+    finally:
+        await assistant.aclose()
+        await runner.cleanup()
+    return result, server, assistant
+
+
+def test_success():
+    result, server, assistant = asyncio.run(call_server([(200, 0, {})]))
+    assert result == "SELECT 1"
+    assert server.n_requests == 1
+    assert assistant.rate_limiter.n_requests == 1
+
+
+@pytest.mark.parametrize("status", [500, 502, 503, 504])
+def test_server_errors_are_retried(status):
+    result, server, _ = asyncio.run(call_server([(status, 0, {}), (200, 0, {})]))
+    assert result == "SELECT 1"
+    assert server.n_requests == 2
+
+
+def test_throttled_request_waits_for_retry_after():
+    start = time.monotonic()
+    result, server, assistant = asyncio.run(
+        call_server([(429, 0, {"Retry-After": "0.3"}), (200, 0, {})])
+    )
+    assert result == "SELECT 1"
+    assert server.n_requests == 2
+    assert time.monotonic() - start >= 0.3
+    # the other callers of the model are paused as well
+    assert assistant.rate_limiter.n_throttled == 1
+
+
+def test_timeout_is_retried():
+    result, server, _ = asyncio.run(
+        call_server([(200, 1.0, {}), (200, 0, {})], timeout_sec=0.2)
+    )
+    assert result == "SELECT 1"
+    assert server.n_requests == 2
+
+
+def test_gives_up_after_max_retries():
+    result, server, _ = asyncio.run(call_server([(503, 0, {})], max_retries=2))
+    assert isinstance(result, RuntimeError)
+    assert "503" in str(result)
+    assert server.n_requests == 3
+
+
+def test_client_errors_are_not_retried():
+    result, server, _ = asyncio.run(call_server([(400, 0, {}), (200, 0, {})]))
+    assert isinstance(result, RuntimeError)
+    assert "400" in str(result)
+    assert server.n_requests == 1
+
+
+def test_session_of_a_previous_event_loop_is_closed():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    assistant = create_assistant(port)
+
+    async def get_response():
+        runner, _ = await start_server(ScriptedChatServer([(200, 0, {})]), port)
+        try:
+            return await assistant.get_response("How many patients?"), assistant._own_session
+        finally:
+            await runner.cleanup()
+
+    async def get_response_and_close():
+        async with assistant:
+            return await get_response()
+
+    result, first_session = asyncio.run(get_response())
+    assert result == "SELECT 1"
+    # kept for the next requests of the event loop
+    assert not first_session.closed
+
+    result, second_session = asyncio.run(get_response_and_close())
+    assert result == "SELECT 1"
+    assert second_session is not first_session
+    assert first_session.closed
+    assert second_session.closed
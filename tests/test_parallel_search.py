@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from text2sql_epi import parallel_search as parallel_search_module
+from text2sql_epi.parallel_search import parallel_search
+from text2sql_epi.query_library import QueryLibrary
+
+
+@pytest.fixture
+def querylib(make_library):
+    embed_matrix = np.random.default_rng(0).standard_normal((500, 16), dtype=np.float32)
+    embed_matrix /= np.linalg.norm(embed_matrix, axis=1, keepdims=True)
+    return make_library(
+        [f"question {idx}" for idx in range(len(embed_matrix))], embed_matrix=embed_matrix
+    )
+
+
+def test_parallel_search_requires_an_index_folder(querylib):
+    with pytest.raises(ValueError, match="save_index"):
+        parallel_search(querylib, querylib.embeddings[0]["embed_matrix"][:5], top_k=3)
+
+
+def test_parallel_search_reuses_its_pool(querylib, tmp_path):
+    querylib.save_index(str(tmp_path))
+    querylib_loaded = QueryLibrary.load_index(str(tmp_path))
+    queries = np.asarray(querylib.embeddings[0]["embed_matrix"][:40])
+    try:
+        idx_records, _ = parallel_search(
+            querylib_loaded, queries, top_k=3, n_processes=2, max_rows=10
+        )
+        pools = dict(parallel_search_module._search_pools)
+        idx_records_again, _ = parallel_search(
+            querylib_loaded, queries, top_k=3, n_processes=2, max_rows=10
+        )
+
+        assert len(pools) == 1
+        assert parallel_search_module._search_pools == pools
+        np.testing.assert_array_equal(idx_records[:, 0], np.arange(40))
+        np.testing.assert_array_equal(idx_records_again, idx_records)
+    finally:
+        parallel_search_module.shutdown_search_pools()
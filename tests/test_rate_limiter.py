@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from text2sql_epi.rate_limiter import RateLimiter
+
+
+class FakeClock:
+    """Clock advanced by the sleeps of the limiter only, so that the waits are exact"""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        # let the other callers run, as a real sleep would
+        await asyncio.sleep(0)
+        self.now += delay
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def make_limiter(clock, **budgets):
+    return RateLimiter(clock=clock.monotonic, sleep=clock.sleep, **budgets)
+
+
+def acquire_all(clock, limiter, n_tokens_list):
+    """:return: times at which the requests of n_tokens_list were allowed, one after the other"""
+
+    async def main():
+        times = []
+        for n_tokens in n_tokens_list:
+            await limiter.acquire(n_tokens)
+            times.append(clock.now - 1000.0)
+        return times
+
+    return asyncio.run(main())
+
+
+def test_requests_are_paced_by_the_request_budget(clock):
+    # 1 request per second, bursts of 2 requests
+    limiter = make_limiter(clock, requests_per_minute=60, burst_sec=2)
+    assert acquire_all(clock, limiter, [0] * 5) == pytest.approx([0, 0, 1, 2, 3])
+    assert limiter.get_stats()["requests"] == 5
+    assert limiter.get_stats()["wait_sec"] == pytest.approx(1 + 1 + 1)
+
+
+def test_requests_are_paced_by_the_token_budget(clock):
+    # 10 tokens per second, bursts of 100 tokens
+    limiter = make_limiter(clock, tokens_per_minute=600, burst_sec=10)
+    # the second request waits for 20 tokens, the third, larger than the bucket, for a full one
+    assert acquire_all(clock, limiter, [60, 60, 500]) == pytest.approx([0, 2, 12])
+    assert limiter.get_stats()["tokens"] == 620
+
+
+def test_concurrent_callers_are_served_in_order(clock):
+    limiter = make_limiter(clock, requests_per_minute=60, burst_sec=1)
+    served = []
+
+    async def request(idx):
+        await limiter.acquire()
+        served.append((idx, clock.now - 1000.0))
+
+    async def main():
+        await asyncio.gather(*[request(idx) for idx in range(4)])
+
+    asyncio.run(main())
+    assert [idx for idx, _ in served] == [0, 1, 2, 3]
+    assert [time for _, time in served] == pytest.approx([0, 1, 2, 3])
+
+
+def test_throttled_response_pauses_the_callers(clock):
+    limiter = make_limiter(clock, requests_per_minute=600, tokens_per_minute=60000)
+    assert acquire_all(clock, limiter, [100]) == [0]
+
+    limiter.on_throttled(5)
+    assert limiter.get_expected_wait(100) == pytest.approx(5)
+    # the pause applies whatever budget was left
+    assert acquire_all(clock, limiter, [100, 100]) == pytest.approx([5, 5])
+    stats = limiter.get_stats()
+    assert (stats["throttled"], stats["requests"]) == (1, 3)
+
+    # the budgets restart from empty buckets: 10 requests per second after the pause
+    clock.now += 0.1
+    limiter.on_throttled(0)
+    assert limiter.get_expected_wait() == pytest.approx(0.1)
+
+
+def test_expected_wait_counts_the_waiting_callers(clock):
+    limiter = make_limiter(clock, requests_per_minute=60, burst_sec=1)
+
+    async def main():
+        await limiter.acquire()
+        # two callers wait for the budget of the next 2 seconds
+        waiting = [asyncio.ensure_future(limiter.acquire()) for _ in range(2)]
+        await asyncio.sleep(0)
+        expected_wait = limiter.get_expected_wait()
+        await asyncio.gather(*waiting)
+        return expected_wait
+
+    assert asyncio.run(main()) == pytest.approx(3)
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+from text2sql_epi.retrieval_executor import RetrievalExecutor
+
+
+def test_retrieval_does_not_block_the_event_loop(make_library, monkeypatch):
+    questions = ["How many patients have asthma?", "How many patients take metformin?"]
+    querylib = make_library(questions)
+    querylib.retrieval_executor = RetrievalExecutor(max_workers=1)
+    encoding_started, loop_ran = threading.Event(), threading.Event()
+    encode = querylib.embedding_model.encode
+
+    def blocking_encode(texts, **kwargs):
+        encoding_started.set()
+        # the encoding ends only once the event loop has run another coroutine meanwhile
+        assert loop_ran.wait(timeout=5), "the retrieval blocked the event loop"
+        return encode(texts, **kwargs)
+
+    monkeypatch.setattr(querylib.embedding_model, "encode", blocking_encode)
+
+    async def heartbeat():
+        while not encoding_started.is_set():
+            await asyncio.sleep(0.001)
+        loop_ran.set()
+
+    async def main():
+        return await asyncio.gather(
+            querylib.text_sql_template_for_rag(
+                questions[1], top_k_screening=2, top_k_prompt=1, sim_threshold=None
+            ),
+            heartbeat(),
+        )
+
+    (_, df_recs_list_out), _ = asyncio.run(main())
+    querylib.retrieval_executor.shutdown()
+    assert df_recs_list_out["QUESTION"].tolist() == [questions[1]]
+
+
+def test_retrievals_beyond_max_pending_wait_for_a_slot():
+    executor = RetrievalExecutor(max_workers=1, max_pending=1)
+    release = threading.Event()
+
+    async def main():
+        first = asyncio.ensure_future(executor.run(release.wait, 5))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(executor.run(lambda: "second"))
+        await asyncio.sleep(0.01)
+        # the second retrieval waits on the event loop, not in the queue of the pool
+        assert (executor.n_submitted, executor.n_waiting) == (1, 1)
+        release.set()
+        return await first, await second
+
+    assert asyncio.run(main()) == (True, "second")
+    assert executor.get_stats()["submitted"] == 2
+    executor.shutdown()
@@ -0,0 +1,197 @@
+import numpy as np
+import pytest
+
+from text2sql_epi.query_library import QueryLibrary
+from text2sql_epi.search_index import EmbeddingIndex, create_search_index
+
+
+def random_matrix(n_rows, dim, seed=0):
+    return np.random.default_rng(seed).standard_normal((n_rows, dim), dtype=np.float32)
+
+
+def get_recall(idx_records, idx_exact):
+    return np.mean(
+        [
+            len(np.intersect1d(row, row_exact)) / len(row_exact)
+            for row, row_exact in zip(idx_records, idx_exact)
+        ]
+    )
+
+
+@pytest.fixture(scope="module")
+def clustered_embeddings():
+    """Clustered embeddings and queries close to some of their rows, like concept names"""
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((25, 64), dtype=np.float32)
+    embed_matrix = centers[rng.integers(0, 25, 5000)]
+    embed_matrix += 0.8 * rng.standard_normal(embed_matrix.shape, dtype=np.float32)
+    queries = embed_matrix[rng.choice(5000, size=100)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape, dtype=np.float32)
+    return (
+        EmbeddingIndex.normalize_rows(embed_matrix),
+        EmbeddingIndex.normalize_rows(queries),
+    )
+
+
+@pytest.mark.parametrize(
+    "backend, params, min_recall",
+    [
+        ("ivf", {"n_probe": 8}, 0.9),
+        ("hnsw", {"ef_search": 64}, 0.95),
+        ("int8", {"n_rescore": 50}, 0.95),
+        ("binary", {"n_rescore": 200}, 0.9),
+        ("cascade", {"truncate_dim": 32, "n_rescore": 100}, 0.9),
+    ],
+)
+def test_recall_against_exact_search(clustered_embeddings, backend, params, min_recall):
+    if backend == "hnsw":
+        pytest.importorskip("hnswlib")
+    embed_matrix, queries = clustered_embeddings
+    idx_exact, scores_exact = EmbeddingIndex(embed_matrix).search(queries, top_k=10)
+
+    idx_records, scores = create_search_index(embed_matrix, backend=backend, **params).search(
+        queries, top_k=10
+    )
+
+    assert idx_records.shape == idx_exact.shape
+    assert get_recall(idx_records, idx_exact) >= min_recall
+    # the candidates are scored with the float vectors: the scores are the exact similarities
+    np.testing.assert_allclose(
+        scores, np.einsum("qd,qkd->qk", queries, embed_matrix[idx_records]), atol=1e-3
+    )
+
+
+@pytest.mark.parametrize(
+    "backend, params, min_recall",
+    [
+        ("exact", {}, 1.0),
+        ("ivf", {"n_probe": 8}, 0.9),
+        ("hnsw", {"ef_search": 64}, 0.95),
+        ("int8", {"n_rescore": 50}, 0.95),
+        ("binary", {"n_rescore": 200}, 0.9),
+        ("cascade", {"truncate_dim": 32, "n_rescore": 100}, 0.9),
+    ],
+)
+@pytest.mark.parametrize("start, stop", [(1000, 4000), (4700, 5000)])
+def test_row_range_views_share_the_index(
+    clustered_embeddings, backend, params, min_recall, start, stop
+):
+    if backend == "hnsw":
+        pytest.importorskip("hnswlib")
+    embed_matrix, queries = clustered_embeddings
+    search_index = create_search_index(embed_matrix, backend=backend, **params)
+    view = search_index.get_row_range(start, stop)
+
+    assert len(view) == stop - start
+    assert np.shares_memory(view.embed_matrix, search_index.embed_matrix)
+    if backend in ["ivf", "hnsw"] and stop - start < 0.1 * len(search_index):
+        # the rows of a small range are searched exactly
+        assert type(view) is EmbeddingIndex
+    else:
+        assert type(view) is type(search_index)
+    if hasattr(view, "codes"):
+        assert np.shares_memory(view.codes, search_index.codes)
+    if hasattr(view, "graph"):
+        assert view.graph is search_index.graph
+
+    idx_exact, _ = EmbeddingIndex(embed_matrix[start:stop]).search(queries, top_k=10)
+    idx_records, scores = view.search(queries, top_k=10)
+    assert ((idx_records >= start) & (idx_records < stop)).all()
+    assert get_recall(idx_records - start, idx_exact) >= min_recall
+    np.testing.assert_allclose(
+        scores, np.einsum("qd,qkd->qk", queries, embed_matrix[idx_records]), atol=1e-3
+    )
+    # the index itself still searches all the rows
+    assert len(search_index) == len(embed_matrix)
+
+
+def test_normalize_rows_checks_all_blocks():
+    embed_matrix = random_matrix(100, 16)
+    embed_matrix /= np.linalg.norm(embed_matrix, axis=1, keepdims=True)
+    assert EmbeddingIndex.normalize_rows(embed_matrix, block_size=32) is embed_matrix
+
+    # a single row not normalised, in the last block
+    embed_matrix[-1] *= 2
+    embed_normalized = EmbeddingIndex.normalize_rows(embed_matrix, block_size=32)
+    assert embed_normalized is not embed_matrix
+    np.testing.assert_allclose(np.linalg.norm(embed_normalized, axis=1), 1.0, atol=1e-5)
+
+
+@pytest.mark.parametrize("backend", ["exact", "int8"])
+def test_load_index_does_not_check_the_saved_rows(backend, make_library, tmp_path, monkeypatch):
+    embed_matrix = random_matrix(200, 16)
+    embed_matrix /= np.linalg.norm(embed_matrix, axis=1, keepdims=True)
+    querylib = make_library([f"question {idx}" for idx in range(200)], embed_matrix=embed_matrix)
+    querylib.build_search_index(backend=backend)
+    querylib.save_index(str(tmp_path))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the embedding matrix was read to check its norms")
+
+    monkeypatch.setattr(EmbeddingIndex, "normalize_rows", staticmethod(fail))
+    querylib_loaded = QueryLibrary.load_index(str(tmp_path))
+
+    queries = random_matrix(5, 16, seed=1)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    np.testing.assert_array_equal(
+        querylib_loaded.search_embeddings(queries, top_k=5)[0],
+        querylib.search_embeddings(queries, top_k=5)[0],
+    )
+
+
+def test_hnsw_concurrent_searches_with_different_top_k():
+    pytest.importorskip("hnswlib")
+    from concurrent.futures import ThreadPoolExecutor
+
+    from text2sql_epi.search_index import HNSWIndex
+
+    embed_matrix = random_matrix(2000, 16)
+    index = HNSWIndex(embed_matrix, ef_search=8, num_threads=1)
+    queries = EmbeddingIndex.normalize_rows(random_matrix(50, 16, seed=1))
+
+    def search(top_k):
+        idx_records, _ = index.search(queries, top_k=top_k)
+        return top_k, idx_records
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(search, [1, 100, 5, 100, 1, 100] * 4))
+
+    idx_exact, _ = EmbeddingIndex(embed_matrix).search(queries, top_k=100)
+    for top_k, idx_records in results:
+        assert idx_records.shape == (50, top_k)
+        assert (idx_records >= 0).all()
+        if top_k == 100:
+            # the graph is searched with ef >= top_k, not ef_search
+            assert get_recall(idx_records, idx_exact) > 0.9
+
+
+def test_get_similar_questions_tmp_dir_is_deprecated(make_library, tmp_path):
+    questions = ["How many patients have asthma?", "How many patients take metformin?"]
+    querylib = make_library(questions)
+
+    with pytest.warns(DeprecationWarning, match="tmp_dir"):
+        idx_records, _ = querylib.get_similar_questions(
+            [[questions[1]]],
+            top_k=1,
+            sim_threshold=None,
+            tmp_dir=str(tmp_path),
+            return_arrays=True,
+        )
+    assert idx_records.tolist() == [[1]]
+
+
+def test_get_similar_questions_has_no_threshold_by_default(make_library):
+    questions = ["How many patients have asthma?", "How many patients take metformin?"]
+    querylib = make_library(questions)
+
+    # no question is as similar as 0.95 to the query, the top_k are still returned
+    idx_records, scores = querylib.get_similar_questions(
+        [["Which drugs are given for dermatitis?"]], top_k=2, return_arrays=True
+    )
+    assert (scores < 0.95).all()
+    assert sorted(idx_records[0].tolist()) == [0, 1]
+
+    idx_records, _ = querylib.get_similar_questions(
+        [["Which drugs are given for dermatitis?"]], top_k=2, sim_threshold=0.95, return_arrays=True
+    )
+    assert idx_records.tolist() == [[-1, -1]]
@@ -0,0 +1,65 @@
+import asyncio
+import re
+
+from text2sql_epi.sql_post_processor import MedicalSQLProcessor
+
+CONCEPT_NAMES = [
+    ("Type 2 diabetes mellitus", "Condition", "SNOMED"),
+    ("Asthma", "Condition", "SNOMED"),
+    ("Metformin", "Drug", "RxNorm"),
+    ("Insulin glargine", "Drug", "RxNorm"),
+]
+
+
+def test_placeholders_are_resolved_in_one_batch(make_library, monkeypatch):
+    medcodeonto = make_library(
+        [name for name, _, _ in CONCEPT_NAMES],
+        ontology=True,
+        columns={
+            "DOMAIN_ID": [domain_id for _, domain_id, _ in CONCEPT_NAMES],
+            "VOCABULARY_ID": [vocabulary_id for _, _, vocabulary_id in CONCEPT_NAMES],
+        },
+    )
+    # every name goes through the encoder
+    medcodeonto.lexical_min_score = None
+
+    batches, encoded = [], []
+    resolve_concepts = medcodeonto.resolve_concepts
+
+    def record_batch(concept_requests, **kwargs):
+        batches.append(list(concept_requests))
+        return resolve_concepts(concept_requests, **kwargs)
+
+    encode = medcodeonto.embedding_model.encode
+
+    def record_encode(texts, **kwargs):
+        encoded.append(list(texts))
+        return encode(texts, **kwargs)
+
+    monkeypatch.setattr(medcodeonto, "resolve_concepts", record_batch)
+    monkeypatch.setattr(medcodeonto.embedding_model, "encode", record_encode)
+
+    sql_text = (
+        "SELECT * FROM condition_occurrence WHERE condition_concept_id IN "
+        "([condition@diabetes]) AND person_id IN (SELECT person_id FROM drug_exposure WHERE "
+        "drug_concept_id IN ([drug@diabetes], [drug@metformin])) "
+        "AND condition_concept_id NOT IN ([condition@diabetes])"
+    )
+    sql_filled = asyncio.run(
+        MedicalSQLProcessor().post_process_sql_query(
+            sql_text, explorer_concepts=None, selected_coding={}, medcodeonto=medcodeonto
+        )
+    )
+
+    # the repeated placeholder is resolved once, with the others in a single search
+    assert batches == [
+        [("diabetes", "Condition", None), ("diabetes", "Drug", None), ("metformin", "Drug", None)]
+    ]
+    # the name shared by two entities is encoded once
+    assert encoded == [["diabetes", "metformin"]]
+
+    assert "@" not in sql_filled
+    condition_ids = re.findall(r"\d+", sql_filled.split("condition_concept_id IN")[1].split(")")[0])
+    drug_ids = re.findall(r"\d+", sql_filled.split("drug_concept_id IN")[1].split(")")[0])
+    assert set(condition_ids) <= {"0", "1"}
+    assert set(drug_ids) <= {"2", "3"}
@@ -1,21 +1,75 @@
-import json
+import asyncio
 import logging
 import os
+import random
 from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Optional
 
-import requests
+import aiohttp
 import tiktoken
-from openai import AsyncAzureOpenAI
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncAzureOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
 
+from text2sql_epi.rate_limiter import get_rate_limiter
 from text2sql_epi.settings import settings
 
 logger = logging.getLogger(__name__)
 
+# model whose tokenizer counts the tokens of the conversations
+TOKENIZER_MODEL = "gpt-4-32k"
+
+
+@lru_cache(maxsize=None)
+def get_token_encoding(model_name=TOKENIZER_MODEL):
+    """:return: tiktoken encoding, created once per model"""
+    return tiktoken.encoding_for_model(model_name)
+
+
+@lru_cache(maxsize=4096)
+def count_text_tokens(text):
+    """:return: number of tokens of text; the counts of repeated texts (system prompts,
+    templates) are cached"""
+    return len(get_token_encoding().encode(text))
+
 
 class GPTAssistant:
-    def __init__(self, engine=None):
-        self.engine = engine
+    def __init__(
+        self,
+        engine=None,
+        client=None,
+        response_cache=None,
+        rate_limiter=None,
+        max_retries=5,
+        deployment_pool=None,
+    ):
+        """
+        :param engine: Name of the Azure OpenAI deployment
+        :param client: AsyncAzureOpenAI client shared with other assistants (None: new client);
+            the conversation stays specific to each assistant
+        :param response_cache: LLMResponseCache of the responses (None: no cache)
+        :param rate_limiter: RateLimiter of the deployment (None: the limiter shared by all the
+            assistants of the engine, with the budgets of settings.LLM_RATE_LIMITS)
+        :param max_retries: Number of retries of a throttled, timed out or failed request
+        :param deployment_pool: DeploymentPool routing the requests to equivalent deployments
+            (None: all the requests go to engine); the pool has its own clients, rate limiters
+            and failover
+        """
+        self.deployment_pool = deployment_pool
+        self.engine = engine if deployment_pool is None else deployment_pool.name
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter
+        if deployment_pool is None and rate_limiter is None:
+            self.rate_limiter = get_rate_limiter(
+                engine, **settings.LLM_RATE_LIMITS.get(engine, {})
+            )
+        self.max_retries = max_retries
+        self.backoff_sec = 1.0
         self.system_message = {
             "role": "system",
             "content": "You are a helpful assistant.",
@@ -23,39 +77,128 @@ class GPTAssistant:
         self.max_response_tokens = 4096
         self.token_limit = 8192 * 2
         self.conversation = [self.system_message]
-        self.client = AsyncAzureOpenAI(
-            api_key=settings.OPENAI_API_KEY,
-            api_version=settings.OPENAI_API_VERSION,
-            azure_endpoint=settings.OPENAI_API_BASE,
-        )
+        if client is None and deployment_pool is None:
+            client = create_openai_client()
+        self.client = client
+
+    def num_tokens_from_message(self, message):
+        num_tokens = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        for key, value in message.items():
+            num_tokens += count_text_tokens(value)
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += -1  # role is always required and always 1 token
+        return num_tokens
 
     def num_tokens_from_messages(self, messages):
-        encoding = tiktoken.encoding_for_model("gpt-4-32k")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += (
-                4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            )
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
+        num_tokens = sum(self.num_tokens_from_message(message) for message in messages)
         num_tokens += 2  # every reply is primed with <im_start>assistant
         return num_tokens
 
+    def get_conversation_tokens(self):
+        """
+        :return: number of tokens of the conversation, maintained incrementally by add_message,
+            reset_conversation and manage_conversation_length
+        """
+        message_tokens = getattr(self, "_message_tokens", None)
+        if (
+            message_tokens is None
+            or self._counted_conversation is not self.conversation
+            or len(message_tokens) != len(self.conversation)
+        ):
+            # the conversation was replaced or edited directly: count it again
+            self._counted_conversation = self.conversation
+            self._message_tokens = [
+                self.num_tokens_from_message(message) for message in self.conversation
+            ]
+            self._conversation_tokens = sum(self._message_tokens) + 2
+        return self._conversation_tokens
+
     def add_message(self, role, message):
+        conv_history_tokens = self.get_conversation_tokens()
         self.conversation.append({"role": role, "content": message})
+        self._message_tokens.append(self.num_tokens_from_message(self.conversation[-1]))
+        self._conversation_tokens = conv_history_tokens + self._message_tokens[-1]
         self.manage_conversation_length()
 
     def reset_conversation(self):
         self.conversation = [self.system_message]
 
     def manage_conversation_length(self):
-        conv_history_tokens = self.num_tokens_from_messages(self.conversation)
+        conv_history_tokens = self.get_conversation_tokens()
 
-        while conv_history_tokens + self.max_response_tokens >= self.token_limit:
+        while (
+            conv_history_tokens + self.max_response_tokens >= self.token_limit
+            and len(self.conversation) > 1
+        ):
             del self.conversation[1]
-            conv_history_tokens = self.num_tokens_from_messages(self.conversation)
+            conv_history_tokens -= self._message_tokens.pop(1)
+        self._conversation_tokens = conv_history_tokens
+
+    async def create_chat_completion(self, messages, message_tokens, **kwargs):
+        """
+        Call the deployment within the budgets of its rate limiter; throttled (429), timed out
+        and failed requests are retried with jittered backoff
+
+        :param messages: Messages of the request
+        :param message_tokens: Tokens of the messages (see num_tokens_from_messages)
+        :param kwargs: Other parameters of the request, e.g. response_format
+        :return: ChatCompletion
+        """
+        # the deployment counts max_tokens against its tokens-per-minute budget
+        n_tokens = message_tokens + self.max_response_tokens
+        if self.deployment_pool is not None:
+            return await self.deployment_pool.create_chat_completion(
+                n_tokens=n_tokens,
+                temperature=0,
+                messages=messages,
+                max_tokens=self.max_response_tokens,
+                **kwargs,
+            )
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire(n_tokens)
+            try:
+                return await self.client.chat.completions.create(
+                    model=self.engine,
+                    temperature=0,
+                    messages=messages,
+                    max_tokens=self.max_response_tokens,
+                    **kwargs,
+                )
+            except RateLimitError as err:
+                if attempt == self.max_retries:
+                    raise
+                error = repr(err)
+                delay = get_retry_delay(
+                    attempt, self.backoff_sec, err.response.headers.get("retry-after")
+                )
+                self.rate_limiter.on_throttled(delay)
+            except (APITimeoutError, APIConnectionError, InternalServerError) as err:
+                if attempt == self.max_retries:
+                    raise
+                error = repr(err)
+                delay = get_retry_delay(attempt, self.backoff_sec)
+            logger.warning(f"GPT request to {self.engine} failed: {error}, retrying in {delay:.1f} s")
+            await asyncio.sleep(delay)
+
+    def lookup_response_cache(self, messages, response_format=None):
+        """
+        :return: (request hash, cached response); the response is None when the LLM should be
+            called, the hash is None without cache
+        """
+        if self.response_cache is None:
+            return None, None
+        request_hash, content = self.response_cache.lookup(
+            self.engine, messages, response_format, self.max_response_tokens
+        )
+        if content is not None:
+            logger.info(
+                f"Cached GPT response! model: {self.engine}, message:{str(messages)}, response-content: {content}"
+            )
+        return request_hash, content
+
+    def store_response_cache(self, request_hash, content):
+        if self.response_cache is not None:
+            self.response_cache.store(request_hash, self.engine, content)
 
     async def get_response(self, prompt: Optional[str] = None):
         messages = (
@@ -63,25 +206,27 @@ class GPTAssistant:
             if prompt is not None
             else self.conversation
         )
-        try:
-            response = await self.client.chat.completions.create(
-                model=self.engine,
-                temperature=0,
-                messages=messages,
-                max_tokens=self.max_response_tokens,
+        request_hash, content = self.lookup_response_cache(messages)
+        if content is None:
+            message_tokens = (
+                self.get_conversation_tokens()
+                if prompt is None
+                else self.num_tokens_from_messages(messages)
             )
-        except Exception as err:
-            logger.exception("An error occurred.")
-            raise err
-        logger.info(
-            f"Successful GPT response! endpoint: {settings.OPENAI_API_BASE}, model: {self.engine}, usage: {str(response.usage)}, utc-timestamp: {datetime.now(timezone.utc).strftime('%Y.%m.%d %H:%M')}, message:{str(messages)}, response-content: {response.choices[0].message.content}"
-        )
-        if prompt is None:
-            self.add_message(
-                role="assistant", message=response.choices[0].message.content
+            try:
+                response = await self.create_chat_completion(messages, message_tokens)
+            except Exception as err:
+                logger.exception("An error occurred.")
+                raise err
+            content = response.choices[0].message.content
+            logger.info(
+                f"Successful GPT response! endpoint: {settings.OPENAI_API_BASE}, model: {self.engine}, usage: {str(response.usage)}, utc-timestamp: {datetime.now(timezone.utc).strftime('%Y.%m.%d %H:%M')}, message:{str(messages)}, response-content: {content}"
             )
+            self.store_response_cache(request_hash, content)
+        if prompt is None:
+            self.add_message(role="assistant", message=content)
 
-        return response.choices[0].message.content
+        return content
 
     async def get_response_json(self, prompt: Optional[str] = None):
         messages = (
@@ -89,59 +234,226 @@ class GPTAssistant:
             if prompt is not None
             else self.conversation
         )
-        logger.info(
-            f"Sending GPT request... endpoint: {settings.OPENAI_API_BASE}, model: {self.engine}, message-tokens: {self.num_tokens_from_messages(messages)}, max_response_tokens: {self.max_response_tokens}, utc-timestamp: {datetime.now(timezone.utc).strftime('%Y.%m.%d %H:%M')}, message:{str(messages)}"
+        message_tokens = (
+            self.get_conversation_tokens()
+            if prompt is None
+            else self.num_tokens_from_messages(messages)
         )
-        try:
-            response = await self.client.chat.completions.create(
-                model=self.engine,
-                response_format={"type": "json_object"},
-                temperature=0,
-                messages=messages,
-                max_tokens=self.max_response_tokens,
-            )
-        except Exception as err:
-            logger.exception("An error occurred")
-            raise err
         logger.info(
-            f"Successful GPT response! endpoint: {settings.OPENAI_API_BASE}, model: {self.engine}, message-tokens: {self.num_tokens_from_messages(messages)}, max_response_tokens: {self.max_response_tokens}, utc-timestamp: {datetime.now(timezone.utc).strftime('%Y.%m.%d %H:%M')}, message:{str(messages)}, response-content: {response.choices[0].message.content}"
+            f"Sending GPT request... endpoint: {settings.OPENAI_API_BASE}, model: {self.engine}, message-tokens: {message_tokens}, max_response_tokens: {self.max_response_tokens}, utc-timestamp: {datetime.now(timezone.utc).strftime('%Y.%m.%d %H:%M')}, message:{str(messages)}"
         )
-        if prompt is None:
-            self.add_message(
-                role="assistant", message=response.choices[0].message.content
+        response_format = {"type": "json_object"}
+        request_hash, content = self.lookup_response_cache(messages, response_format)
+        if content is None:
+            try:
+                response = await self.create_chat_completion(
+                    messages, message_tokens, response_format=response_format
+                )
+            except Exception as err:
+                logger.exception("An error occurred")
+                raise err
+            content = response.choices[0].message.content
+            logger.info(
+                f"Successful GPT response! endpoint: {settings.OPENAI_API_BASE}, model: {self.engine}, message-tokens: {message_tokens}, max_response_tokens: {self.max_response_tokens}, utc-timestamp: {datetime.now(timezone.utc).strftime('%Y.%m.%d %H:%M')}, message:{str(messages)}, response-content: {content}"
             )
+            self.store_response_cache(request_hash, content)
+        if prompt is None:
+            self.add_message(role="assistant", message=content)
 
-        return response.choices[0].message.content
+        return content
 
 
-class MistralAssistant:
-    def __init__(self, model, mistral_api_key=None):
+MISTRAL_API_URL = "https://api.mistral.ai/v1/chat/completions"
+
+# statuses worth retrying: timeout, throttling, server errors
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+def get_retry_delay(attempt, backoff_sec, retry_after=None):
+    """
+    :param attempt: Number of the failed attempt (0: first)
+    :param backoff_sec: Delay after the first failure, doubled after each failure
+    :param retry_after: Value of the Retry-After header of the response, if any
+    :return: delay in seconds, with jitter so that concurrent retries do not fire together
+    """
+    if retry_after is not None:
+        try:
+            return float(retry_after) + random.uniform(0, backoff_sec)
+        except ValueError:
+            pass
+    return backoff_sec * 2**attempt * random.uniform(0.5, 1.5)
 
+
+class MistralAssistant:
+    def __init__(
+        self,
+        model,
+        mistral_api_key=None,
+        url=None,
+        session=None,
+        timeout_sec=120,
+        max_retries=4,
+        backoff_sec=1.0,
+        max_connections=16,
+        rate_limiter=None,
+    ):
+        """
+        :param model: Name of the Mistral model, e.g. "mistral-small"
+        :param mistral_api_key: API key (None: MISTRAL_API_KEY environment variable)
+        :param url: Chat completions endpoint (None: MISTRAL_API_URL environment variable or the
+            Mistral API), e.g. a local mock endpoint (see offline.MockChatServer)
+        :param session: aiohttp.ClientSession shared with other assistants (None: the assistant
+            opens its own keep-alive connection pool at the first request, closed by aclose or
+            at the end of "async with assistant:")
+        :param timeout_sec: Timeout of a request in seconds
+        :param max_retries: Number of retries after a timeout, a connection error or a
+            retryable status (429, 5xx)
+        :param backoff_sec: Delay before the first retry, doubled after each failure (jittered)
+        :param max_connections: Size of the connection pool opened by the assistant
+        :param rate_limiter: RateLimiter of the model (None: the limiter shared by all the
+            assistants of the model, with the budgets of settings.LLM_RATE_LIMITS)
+        """
         if mistral_api_key is None:
             self.mistral_api_key = os.getenv("MISTRAL_API_KEY")
         else:
             self.mistral_api_key = mistral_api_key
-        self.url = "https://api.mistral.ai/v1/chat/completions"
+        self.url = url or os.getenv("MISTRAL_API_URL", MISTRAL_API_URL)
         self.model = model
+        self.timeout_sec = timeout_sec
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        self.max_connections = max_connections
+        self.system_message = {
+            "role": "system",
+            "content": "You are a helpful assistant.",
+        }
+        self.conversation = [self.system_message]
+        self.rate_limiter = rate_limiter or get_rate_limiter(
+            model, **settings.LLM_RATE_LIMITS.get(model, {})
+        )
+        self.session = session
+        self._own_session = None
+        self._own_session_loop = None
+
+    def add_message(self, role, message):
+        self.conversation.append({"role": role, "content": message})
+
+    def reset_conversation(self):
+        self.conversation = [self.system_message]
+
+    async def __aenter__(self):
+        return self
 
-    def get_response(self, message):
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.aclose()
+
+    async def get_session(self):
+        if self.session is not None:
+            return self.session
+        # a session is bound to its event loop: open a new one for each asyncio.run
+        loop = asyncio.get_running_loop()
+        if self._own_session is not None and self._own_session_loop is not loop:
+            await self._close_previous_session()
+        if self._own_session is None or self._own_session.closed:
+            self._own_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout_sec),
+            )
+            self._own_session_loop = loop
+        return self._own_session
+
+    async def _close_previous_session(self):
+        """Close the session opened in another event loop, not closed with aclose"""
+        session, loop = self._own_session, self._own_session_loop
+        self._own_session, self._own_session_loop = None, None
+        if session.closed:
+            return
+        if loop.is_closed():
+            # its connections ended with their loop: closing only releases the connector
+            await session.close()
+        else:
+            # the loop still runs (e.g. in another thread): the session is closed on it
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+    async def aclose(self):
+        """Close the connection pool opened by the assistant (not the session it was given)"""
+        if self._own_session is not None and not self._own_session.closed:
+            await self._own_session.close()
+        self._own_session, self._own_session_loop = None, None
+
+    async def post_chat_completion(self, data):
+        """
+        :return: content of the response; the requests wait for the budgets of the rate limiter,
+            timeouts, connection errors and retryable statuses are retried with jittered
+            exponential backoff
+        """
+        n_tokens = sum(count_text_tokens(message["content"]) + 4 for message in data["messages"])
         headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
             "Authorization": f"Bearer {self.mistral_api_key}",
         }
+        session = await self.get_session()
+        for attempt in range(self.max_retries + 1):
+            status, retry_after = None, None
+            await self.rate_limiter.acquire(n_tokens)
+            try:
+                async with session.post(
+                    self.url,
+                    headers=headers,
+                    json=data,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout_sec),
+                ) as response:
+                    status = response.status
+                    if status == 200:
+                        payload = await response.json()
+                        return payload["choices"][0]["message"]["content"]
+                    error = f"Mistral API status {status}: {await response.text()}"
+                    if status not in RETRY_STATUSES:
+                        raise RuntimeError(error)
+                    retry_after = response.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                error = f"Mistral API request failed: {err!r}"
+            if attempt == self.max_retries:
+                logger.error(f"{error}, giving up after {attempt + 1} attempts")
+                raise RuntimeError(error)
+            delay = get_retry_delay(attempt, self.backoff_sec, retry_after)
+            if status == 429:
+                self.rate_limiter.on_throttled(delay)
+            logger.warning(f"{error}, retrying in {delay:.1f} s")
+            await asyncio.sleep(delay)
 
-        data = {"model": self.model, "messages": [{"role": "user", "content": message}]}
+    async def get_response(self, prompt: Optional[str] = None, response_format=None):
+        messages = (
+            [{"role": "user", "content": prompt}]
+            if prompt is not None
+            else self.conversation
+        )
+        data = {"model": self.model, "temperature": 0, "messages": messages}
+        if response_format is not None:
+            data["response_format"] = response_format
+        content = await self.post_chat_completion(data)
+        logger.info(
+            f"Successful Mistral response! url: {self.url}, model: {self.model}, utc-timestamp: {datetime.now(timezone.utc).strftime('%Y.%m.%d %H:%M')}, message:{str(messages)}, response-content: {content}"
+        )
+        if prompt is None:
+            self.add_message(role="assistant", message=content)
 
-        response = requests.post(self.url, headers=headers, data=json.dumps(data))
+        return content
 
-        if response.status_code == 200:
-            return response.json()["choices"][0]["message"]["content"]
-        else:
-            return response.text
+    async def get_response_json(self, prompt: Optional[str] = None):
+        return await self.get_response(prompt, response_format={"type": "json_object"})
 
-    def reset_conversation(self):
-        pass
+
+def create_openai_client():
+    """:return: AsyncAzureOpenAI client, whose connection pool can be shared by assistants"""
+    return AsyncAzureOpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        api_version=settings.OPENAI_API_VERSION,
+        azure_endpoint=settings.OPENAI_API_BASE,
+        # throttled and failed requests are retried by the assistants, within the rate limits
+        max_retries=0,
+    )
 
 
 def get_engine_from_assistant_type(assistant_type):
@@ -158,9 +470,18 @@ def get_engine_from_assistant_type(assistant_type):
     return assistant_engine
 
 
-def create_assistant(assistant_type):
+def create_assistant(assistant_type, client=None, response_cache=None, deployment_pool=None):
+    """
+    :param assistant_type: e.g. "gpt4turbo" or "mistral-small"
+    :param client: AsyncAzureOpenAI client shared by the GPT assistants, or aiohttp.ClientSession
+        shared by the Mistral assistants (None: new client)
+    :param response_cache: LLMResponseCache shared by the GPT assistants (None: no cache)
+    :param deployment_pool: DeploymentPool of the GPT assistants, replacing the deployment of
+        assistant_type (see deployment_pool.create_deployment_pool)
+    """
     assistant_classes = {
         "gpt4turbo": GPTAssistant,
+        "gpt4turbo-south": GPTAssistant,
         "gpt4": GPTAssistant,
         "gpt35": GPTAssistant,
         "mistral-tiny": MistralAssistant,
@@ -177,13 +498,18 @@ def create_assistant(assistant_type):
             or assistant_type == "gpt4turbo-south"
             or assistant_type == "gpt35"
         ):
-            assistant = assistant_classes[assistant_type](engine=engine)
+            assistant = assistant_classes[assistant_type](
+                engine=engine,
+                client=client,
+                response_cache=response_cache,
+                deployment_pool=deployment_pool,
+            )
         elif (
             assistant_type == "mistral-tiny"
             or assistant_type == "mistral-small"
             or assistant_type == "mistral-medium"
         ):
-            assistant = assistant_classes[assistant_type](model=assistant_type)
+            assistant = assistant_classes[assistant_type](model=assistant_type, session=client)
         else:
             assistant = assistant_classes[assistant_type]()
         return assistant
@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ConceptResolutionCache:
+    """
+    SQLite cache of the concepts retrieved for a medical entity name.
+
+    Entries are keyed by the fingerprint of the ontology (see MedCodingOnto.get_fingerprint), so
+    that rebuilding the ontology or changing its embedding model invalidates them automatically.
+    """
+
+    def __init__(
+        self, cache_file=None, lowercase=False, fingerprint=None, max_entries=100000
+    ) -> None:
+        """
+        :param cache_file: SQLite file of the cache (None: in memory, for the process only)
+        :param lowercase: True to lowercase the names (only for uncased embedding models)
+        :param fingerprint: Fingerprint of the current ontology, the entries of other ontology
+            versions are deleted when the cache is opened (None: kept)
+        :param max_entries: Maximum number of entries kept, the oldest are evicted
+        """
+        self.cache_file = cache_file
+        self.lowercase = lowercase
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if cache_file is not None:
+            directory = os.path.dirname(cache_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(
+            cache_file if cache_file is not None else ":memory:", check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS concepts (fingerprint TEXT, request TEXT, records TEXT, "
+            "PRIMARY KEY (fingerprint, request))"
+        )
+        self._db.commit()
+        if fingerprint is not None:
+            self.prune(fingerprint)
+        self.evict()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM concepts").fetchone()[0]
+
+    def normalize_name(self, name):
+        name = " ".join(str(name).split())
+        return name.lower() if self.lowercase else name
+
+    def get_request_key(self, name, domain_id, vocabularies, **retrieval_params):
+        """
+        :param retrieval_params: Parameters changing the retrieved concepts (top_k, threshold)
+        """
+        return json.dumps(
+            {
+                "name": self.normalize_name(name),
+                "domain_id": domain_id,
+                "vocabularies": sorted(vocabularies) if vocabularies is not None else None,
+                **retrieval_params,
+            },
+            sort_keys=True,
+        )
+
+    def get(self, fingerprint, request_key):
+        """
+        :return: list of concept records, or None if the request is not cached
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT records FROM concepts WHERE fingerprint = ? AND request = ?",
+                (fingerprint, request_key),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, fingerprint, request_key, records):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO concepts VALUES (?, ?, ?)",
+                (fingerprint, request_key, json.dumps(records, default=str)),
+            )
+            self._db.commit()
+            n_entries = self._db.execute("SELECT COUNT(*) FROM concepts").fetchone()[0]
+        if n_entries > self.max_entries:
+            self.evict()
+
+    def prune(self, fingerprint):
+        """Delete the entries of all other ontology versions"""
+        with self._lock:
+            n_deleted = self._db.execute(
+                "DELETE FROM concepts WHERE fingerprint != ?", (fingerprint,)
+            ).rowcount
+            self._db.commit()
+        if n_deleted:
+            logger.info(f"{n_deleted} concept cache entries of other ontology versions deleted")
+        return n_deleted
+
+    def evict(self):
+        """Delete the oldest entries beyond max_entries"""
+        with self._lock:
+            # INSERT OR REPLACE gives a new rowid: the smallest rowids are the oldest entries
+            n_deleted = self._db.execute(
+                "DELETE FROM concepts WHERE rowid IN (SELECT rowid FROM concepts "
+                "ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+            self._db.commit()
+        if n_deleted:
+            logger.info(f"{n_deleted} concept cache entries evicted")
+        return n_deleted
+
+    def get_stats(self):
+        n_entries = len(self)
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / n_lookups if n_lookups else 0.0,
+                "size": n_entries,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM concepts")
+            self._db.commit()
+            self.hits = 0
+            self.misses = 0
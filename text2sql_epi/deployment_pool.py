@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import time
+
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncAzureOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
+
+from text2sql_epi.rate_limiter import get_rate_limiter
+from text2sql_epi.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Deployment:
+    """Azure OpenAI deployment of a pool, with its observed latency, load and health"""
+
+    def __init__(self, engine, client, rate_limiter=None, initial_latency_sec=1.0) -> None:
+        """
+        :param engine: Name of the deployment
+        :param client: AsyncAzureOpenAI client of its endpoint, shared by the deployments of the
+            endpoint
+        :param rate_limiter: RateLimiter of the deployment (None: no budget)
+        :param initial_latency_sec: Latency assumed before the first response
+        """
+        self.engine = engine
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.latency_sec = initial_latency_sec
+        self.in_flight = 0
+        self.unavailable_until = 0.0
+        self.consecutive_failures = 0
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.n_errors = 0
+
+    def is_available(self, now):
+        return now >= self.unavailable_until
+
+    def get_expected_latency(self, n_tokens=0):
+        """
+        :param n_tokens: Estimated tokens of the request
+        :return: latency expected for a new request, given the requests in flight and the wait
+            for the budgets of the rate limiter
+        """
+        latency_sec = self.latency_sec * (1 + self.in_flight)
+        if self.rate_limiter is not None:
+            latency_sec += self.rate_limiter.get_expected_wait(n_tokens)
+        return latency_sec
+
+    def get_stats(self):
+        return {
+            "engine": self.engine,
+            "latency_ms": self.latency_sec * 1000,
+            "in_flight": self.in_flight,
+            "requests": self.n_requests,
+            "throttled": self.n_throttled,
+            "errors": self.n_errors,
+            "available": self.is_available(time.monotonic()),
+        }
+
+
+class DeploymentPool:
+    """
+    Equivalent Azure OpenAI deployments answering the same requests.
+
+    Each call goes to the available deployment with the lowest expected latency (moving average
+    of its latency times its requests in flight, plus the wait for the requests-per-minute and
+    tokens-per-minute budgets of its rate limiter). A throttled deployment is skipped for its
+    Retry-After delay and a failing one for an increasing cooldown; the call fails over to the
+    next deployment.
+    """
+
+    def __init__(
+        self,
+        deployments,
+        name="pool",
+        latency_alpha=0.2,
+        failure_cooldown_sec=5,
+        max_failure_cooldown_sec=60,
+        max_attempts=6,
+        max_wait_sec=30,
+    ) -> None:
+        """
+        :param deployments: List of Deployment
+        :param name: Name of the pool, used as the engine of the response cache
+        :param latency_alpha: Weight of the last latency in the moving average
+        :param failure_cooldown_sec: Cooldown after an error, doubled after each consecutive one
+        :param max_failure_cooldown_sec: Maximum cooldown after an error
+        :param max_attempts: Maximum number of attempts of a call, across the deployments
+        :param max_wait_sec: A call fails instead of waiting longer for a deployment to be
+            available again
+        """
+        if not deployments:
+            raise ValueError("A deployment pool needs at least one deployment")
+        self.deployments = deployments
+        self.name = name
+        self.latency_alpha = latency_alpha
+        self.failure_cooldown_sec = failure_cooldown_sec
+        self.max_failure_cooldown_sec = max_failure_cooldown_sec
+        self.max_attempts = max_attempts
+        self.max_wait_sec = max_wait_sec
+
+    def select(self, n_tokens=0):
+        """
+        :param n_tokens: Estimated tokens of the request
+        :return: (deployment to call, seconds to wait before calling it)
+        """
+        now = time.monotonic()
+        available = [deployment for deployment in self.deployments if deployment.is_available(now)]
+        if available:
+            return (
+                min(
+                    available,
+                    key=lambda deployment: deployment.get_expected_latency(n_tokens),
+                ),
+                0.0,
+            )
+        # all deployments are throttled or failing: wait for the first one back
+        deployment = min(self.deployments, key=lambda deployment: deployment.unavailable_until)
+        return deployment, deployment.unavailable_until - now
+
+    def record_latency(self, deployment, latency_sec):
+        deployment.latency_sec += self.latency_alpha * (latency_sec - deployment.latency_sec)
+        deployment.consecutive_failures = 0
+
+    def record_throttled(self, deployment, retry_after_sec):
+        deployment.n_throttled += 1
+        deployment.unavailable_until = max(
+            deployment.unavailable_until, time.monotonic() + retry_after_sec
+        )
+        if deployment.rate_limiter is not None:
+            deployment.rate_limiter.on_throttled(retry_after_sec)
+
+    def record_failure(self, deployment):
+        deployment.n_errors += 1
+        now = time.monotonic()
+        if not deployment.is_available(now):
+            # concurrent requests failing during the cooldown do not extend it
+            return
+        cooldown = min(
+            self.failure_cooldown_sec * 2**deployment.consecutive_failures,
+            self.max_failure_cooldown_sec,
+        )
+        deployment.consecutive_failures += 1
+        deployment.unavailable_until = now + cooldown
+
+    async def create_chat_completion(self, n_tokens=0, **kwargs):
+        """
+        :param n_tokens: Estimated tokens of the request, for the rate limiters
+        :param kwargs: Parameters of chat.completions.create, except model
+        :return: ChatCompletion of the first deployment answering
+        """
+        error = None
+        for attempt in range(self.max_attempts):
+            deployment, delay = self.select(n_tokens)
+            if delay > self.max_wait_sec:
+                raise RuntimeError(
+                    f"No deployment of {self.name} available before {delay:.0f} s, "
+                    f"last error: {error}"
+                )
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if deployment.rate_limiter is not None:
+                await deployment.rate_limiter.acquire(n_tokens)
+            deployment.in_flight += 1
+            deployment.n_requests += 1
+            start = time.monotonic()
+            try:
+                response = await deployment.client.chat.completions.create(
+                    model=deployment.engine, **kwargs
+                )
+            except RateLimitError as err:
+                retry_after = err.response.headers.get("retry-after")
+                try:
+                    retry_after_sec = float(retry_after)
+                except (TypeError, ValueError):
+                    retry_after_sec = self.failure_cooldown_sec
+                self.record_throttled(deployment, retry_after_sec)
+                error = repr(err)
+            except (APITimeoutError, APIConnectionError, InternalServerError) as err:
+                self.record_failure(deployment)
+                error = repr(err)
+            else:
+                self.record_latency(deployment, time.monotonic() - start)
+                return response
+            finally:
+                deployment.in_flight -= 1
+            if attempt == self.max_attempts - 1:
+                raise RuntimeError(
+                    f"All the attempts of {self.name} failed, last error: {error}"
+                )
+            logger.warning(f"{deployment.engine} failed: {error}, failing over")
+
+    def get_stats(self):
+        return [deployment.get_stats() for deployment in self.deployments]
+
+
+def create_deployment_pool(
+    engines, endpoints=None, name="pool", rate_limits=None, timeout_sec=120, **kwargs
+):
+    """
+    :param engines: Names of the equivalent deployments
+    :param endpoints: dict of engine to dict of azure_endpoint, api_key and api_version (None:
+        the endpoint of settings); the deployments of one endpoint share one client
+    :param name: Name of the pool
+    :param rate_limits: dict of engine to the keyword arguments of its RateLimiter (None:
+        settings.LLM_RATE_LIMITS)
+    :param timeout_sec: Timeout of a request in seconds, after which the pool fails over
+    :param kwargs: Other parameters of DeploymentPool
+    :return: DeploymentPool
+    """
+    endpoints = endpoints or {}
+    rate_limits = rate_limits if rate_limits is not None else settings.LLM_RATE_LIMITS
+    clients = {}
+    deployments = []
+    for engine in engines:
+        endpoint = {
+            "azure_endpoint": settings.OPENAI_API_BASE,
+            "api_key": settings.OPENAI_API_KEY,
+            "api_version": settings.OPENAI_API_VERSION,
+            **endpoints.get(engine, {}),
+        }
+        client_key = (endpoint["azure_endpoint"], endpoint["api_key"], endpoint["api_version"])
+        if client_key not in clients:
+            # retries are handled by the pool, across the deployments
+            clients[client_key] = AsyncAzureOpenAI(
+                **endpoint, max_retries=0, timeout=timeout_sec
+            )
+        deployments.append(
+            Deployment(
+                engine,
+                clients[client_key],
+                rate_limiter=get_rate_limiter(engine, **rate_limits.get(engine, {})),
+            )
+        )
+    return DeploymentPool(deployments, name=name, **kwargs)
@@ -0,0 +1,141 @@
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class QueryEmbeddingCache:
+    """Bounded, thread-safe LRU cache of query embeddings keyed by (model name, normalised text)"""
+
+    def __init__(self, max_size=10000, cache_file=None, lowercase=False) -> None:
+        """
+        :param max_size: Maximum number of embeddings kept in memory
+        :param cache_file: SQLite file where the embeddings are also persisted (None: memory only)
+        :param lowercase: True to lowercase the texts (only for uncased embedding models)
+        """
+        self.max_size = max_size
+        self.lowercase = lowercase
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self._embeddings = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if cache_file is not None:
+            directory = os.path.dirname(cache_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(cache_file, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings "
+                "(model_name TEXT, text TEXT, embedding BLOB, PRIMARY KEY (model_name, text))"
+            )
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._embeddings)
+
+    def normalize_text(self, text):
+        text = " ".join(str(text).split())
+        return text.lower() if self.lowercase else text
+
+    def _get(self, key):
+        # called with the lock held
+        embedding = self._embeddings.get(key)
+        if embedding is not None:
+            self._embeddings.move_to_end(key)
+            return embedding
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT embedding FROM query_embeddings WHERE model_name = ? AND text = ?",
+                key,
+            ).fetchone()
+            if row is not None:
+                embedding = np.frombuffer(row[0], dtype=np.float32)
+                self._put(key, embedding, persist=False)
+                return embedding
+        return None
+
+    def _put(self, key, embedding, persist=True):
+        # called with the lock held
+        self._embeddings[key] = embedding
+        self._embeddings.move_to_end(key)
+        while len(self._embeddings) > self.max_size:
+            self._embeddings.popitem(last=False)
+        if persist and self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                (*key, embedding.tobytes()),
+            )
+
+    def encode(self, embedding_model, model_name, texts, **encode_kwargs):
+        """
+        Return the embeddings of texts, encoding in one batch only the texts not in the cache.
+
+        :param embedding_model: Model with a SentenceTransformer-like encode method
+        :param model_name: Name of the embedding model, part of the cache key
+        :param texts: List of strings
+        :param encode_kwargs: Arguments passed to embedding_model.encode
+        :return: embedding matrix, one row per text
+        """
+        keys = [(str(model_name), self.normalize_text(text)) for text in texts]
+        embeddings = [None] * len(keys)
+
+        # the lookups and the counters are updated under one lock: the retrieval threads share
+        # the cache
+        with self._lock:
+            for idx, key in enumerate(keys):
+                embeddings[idx] = self._get(key)
+            idx_missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+            self.hits += len(keys) - len(idx_missing)
+            self.misses += len(idx_missing)
+
+        keys_missing = list(dict.fromkeys(keys[idx] for idx in idx_missing))
+        if keys_missing:
+            embed_missing = np.asarray(
+                embedding_model.encode([key[1] for key in keys_missing], **encode_kwargs),
+                dtype=np.float32,
+            )
+            embed_by_key = dict(zip(keys_missing, embed_missing))
+            with self._lock:
+                for key, embedding in embed_by_key.items():
+                    self._put(key, embedding)
+                if self._db is not None:
+                    self._db.commit()
+            for idx in idx_missing:
+                embeddings[idx] = embed_by_key[keys[idx]]
+
+        if not embeddings:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack(embeddings)
+
+    def get_stats(self):
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / n_lookups if n_lookups else 0.0,
+                "size": len(self._embeddings),
+                "max_size": self.max_size,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._embeddings.clear()
+            self.hits = 0
+            self.misses = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM query_embeddings")
+                self._db.commit()
+
+
+# shared by all query libraries and ontologies of the process (the model name is part of the key)
+default_query_embedding_cache = QueryEmbeddingCache()
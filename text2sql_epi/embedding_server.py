@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingServer:
+    """
+    Local HTTP server sharing one encoder between processes.
+
+    Concurrent encode requests are gathered for up to max_wait_ms (or until max_batch_size texts
+    are waiting) and encoded in one batch. Embeddings are returned as raw float32 bytes.
+    """
+
+    def __init__(self, encoder, model_name, max_batch_size=64, max_wait_ms=5) -> None:
+        """
+        :param encoder: Encoder (see text2sql_epi.encoders)
+        :param model_name: Name of the SentenceTransformer model of the encoder
+        :param max_batch_size: Maximum number of texts encoded together
+        :param max_wait_ms: Time the first waiting request waits for others to join its batch
+        """
+        self.encoder = encoder
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.n_requests = 0
+        self.n_texts = 0
+        self.n_batches = 0
+        self._queue = None
+        self._batcher = None
+        # the encoder runs on one thread: batches are encoded one after the other
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="encoder")
+
+    def get_info(self):
+        return {
+            "model_name": self.model_name,
+            "encoder_name": getattr(self.encoder, "name", self.model_name),
+            "dim": self.encoder.get_sentence_embedding_dimension(),
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "requests": self.n_requests,
+            "texts": self.n_texts,
+            "batches": self.n_batches,
+            "mean_batch_size": self.n_texts / self.n_batches if self.n_batches else 0.0,
+        }
+
+    async def _run_batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            texts, future = await self._queue.get()
+            batch = [(texts, future)]
+            n_texts = len(texts)
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while n_texts < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    texts, future = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append((texts, future))
+                n_texts += len(texts)
+
+            texts_batch = [text for texts, _ in batch for text in texts]
+            try:
+                embeddings = await loop.run_in_executor(
+                    self._executor,
+                    lambda: np.asarray(
+                        self.encoder.encode(texts_batch, normalize_embeddings=True),
+                        dtype=np.float32,
+                    ),
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.n_batches += 1
+            self.n_texts += len(texts_batch)
+            start = 0
+            for texts, future in batch:
+                if not future.done():
+                    future.set_result(embeddings[start : start + len(texts)])
+                start += len(texts)
+
+    async def encode(self, texts):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((texts, future))
+        return await future
+
+    async def handle_encode(self, request):
+        payload = await request.json()
+        texts = [str(text) for text in payload["texts"]]
+        self.n_requests += 1
+        embeddings = await self.encode(texts) if texts else np.empty((0, 0), dtype=np.float32)
+        return web.Response(
+            body=embeddings.tobytes(),
+            content_type="application/octet-stream",
+            headers={"X-Embedding-Shape": json.dumps(list(embeddings.shape))},
+        )
+
+    async def handle_info(self, request):
+        return web.json_response(self.get_info())
+
+    async def _start_batcher(self, app):
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batcher())
+
+    async def _stop_batcher(self, app):
+        self._batcher.cancel()
+        self._executor.shutdown(wait=False)
+
+    def create_app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/encode", self.handle_encode)
+        app.router.add_get("/info", self.handle_info)
+        app.on_startup.append(self._start_batcher)
+        app.on_cleanup.append(self._stop_batcher)
+        return app
+
+    def run(self, host="127.0.0.1", port=8765, unix_socket=None):
+        """
+        :param host: Interface of the HTTP server (localhost only by default)
+        :param port: Port of the HTTP server
+        :param unix_socket: Path of a Unix socket to listen on instead of host and port
+        """
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            logger.info(f"Embedding server of {self.model_name} listening on {unix_socket}")
+            web.run_app(self.create_app(), path=unix_socket, access_log=None)
+        else:
+            logger.info(f"Embedding server of {self.model_name} listening on {host}:{port}")
+            web.run_app(self.create_app(), host=host, port=port, access_log=None)
@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import os
+import re
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """Embeddings of one embedding model keyed by the hash of the embedded text"""
+
+    def __init__(self, model_name: str) -> None:
+        self.model_name = model_name
+        self.hashes = np.array([], dtype="U40")
+        self.embed_matrix = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha1(str(text).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get_store_file(store_dir, model_name, library_name):
+        """
+        :param store_dir: Folder of the embedding stores
+        :param model_name: Name of the embedding model
+        :param library_name: Name of the embedded library: get_embeddings drops the texts of
+            other libraries, so that libraries sharing store_dir need their own store
+        :return: path of the store file
+        """
+        model_name_clean = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        library_name_clean = re.sub(r"[^A-Za-z0-9_.-]+", "_", library_name)
+        return os.path.join(
+            store_dir, f"embedding_store_{library_name_clean}_{model_name_clean}.npz"
+        )
+
+    def get_embeddings(self, texts, encode_fn):
+        """
+        Return the embedding matrix of texts, encoding only the texts not already in the store.
+
+        After the call the store only contains the embeddings of texts, so that deleted rows
+        are dropped at the next save: a store holds the embeddings of one library only (see
+        get_store_file).
+
+        :param texts: List of strings to embed
+        :param encode_fn: Function mapping a list of strings to an embedding matrix
+        :return: embedding matrix, one row per input text
+        """
+        if len(texts) == 0:
+            dim = self.embed_matrix.shape[1] if self.embed_matrix is not None else 0
+            self.hashes = np.array([], dtype="U40")
+            self.embed_matrix = None
+            return np.empty((0, dim), dtype=np.float32)
+
+        text_hashes = np.array([self.hash_text(text) for text in texts], dtype="U40")
+        unique_hashes, idx_first, idx_inverse = np.unique(
+            text_hashes, return_index=True, return_inverse=True
+        )
+
+        if self.embed_matrix is not None and len(self.hashes) > 0:
+            row_in_store = dict(zip(self.hashes.tolist(), range(len(self.hashes))))
+        else:
+            row_in_store = {}
+        idx_stored = np.array(
+            [row_in_store.get(text_hash, -1) for text_hash in unique_hashes.tolist()],
+            dtype=np.int64,
+        )
+        is_missing = idx_stored < 0
+
+        logger.info(
+            f"Embedding store for {self.model_name}: {int((~is_missing).sum())} texts reused, "
+            f"{int(is_missing.sum())} texts to encode, "
+            f"{len(row_in_store) - int((~is_missing).sum())} texts dropped"
+        )
+
+        embed_missing = None
+        if is_missing.any():
+            embed_missing = np.asarray(
+                encode_fn([texts[idx] for idx in idx_first[is_missing]]),
+                dtype=np.float32,
+            )
+
+        if embed_missing is not None:
+            dim = embed_missing.shape[1]
+        else:
+            dim = self.embed_matrix.shape[1]
+
+        embed_unique = np.empty((len(unique_hashes), dim), dtype=np.float32)
+        if (~is_missing).any():
+            embed_unique[~is_missing] = self.embed_matrix[idx_stored[~is_missing]]
+        if embed_missing is not None:
+            embed_unique[is_missing] = embed_missing
+
+        self.hashes = unique_hashes
+        self.embed_matrix = embed_unique
+
+        return embed_unique[idx_inverse.reshape(-1)]
+
+    def save(self, store_file):
+        directory = os.path.dirname(store_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with open(store_file, "wb") as out_file:
+            np.savez(
+                out_file,
+                model_name=np.array(self.model_name),
+                hashes=self.hashes,
+                embed_matrix=(
+                    self.embed_matrix
+                    if self.embed_matrix is not None
+                    else np.empty((0, 0), dtype=np.float32)
+                ),
+            )
+        logger.info(f"Embedding store with {len(self)} texts saved to {store_file}")
+
+    @staticmethod
+    def load(store_file, model_name):
+        store = EmbeddingStore(model_name=model_name)
+        if not os.path.exists(store_file):
+            logger.info(f"No embedding store found at {store_file}, starting empty")
+            return store
+
+        with np.load(store_file) as data:
+            if str(data["model_name"]) != model_name:
+                logger.warning(
+                    f"Embedding store {store_file} was built with {data['model_name']}, "
+                    f"not {model_name}: starting empty"
+                )
+                return store
+            store.hashes = data["hashes"]
+            store.embed_matrix = data["embed_matrix"] if len(store.hashes) else None
+
+        logger.info(f"Embedding store with {len(store)} texts read from {store_file}")
+        return store
@@ -0,0 +1,380 @@
+import http.client
+import inspect
+import json
+import logging
+import os
+import re
+import socket
+import threading
+from urllib.parse import urlparse
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_MODEL_INT8_FILE = "model_int8.onnx"
+ONNX_CONFIG_FILE = "encoder_config.json"
+DEFAULT_ONNX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "text2sql_epi", "onnx")
+
+
+class SentenceTransformerEncoder:
+    """PyTorch encoder of a SentenceTransformer model"""
+
+    backend = "torch"
+
+    def __init__(self, model_name) -> None:
+        self.model_name = model_name
+        # imported here: sentence_transformers and torch take seconds to import
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+
+    @classmethod
+    def get_name(cls, model_name, **params):
+        """Name of the encoder in the embedding caches and stores"""
+        return str(model_name)
+
+    @property
+    def name(self):
+        return self.get_name(self.model_name)
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts, **encode_kwargs):
+        return self.model.encode(texts, **encode_kwargs)
+
+    def start_multi_process_pool(self, **kwargs):
+        return self.model.start_multi_process_pool(**kwargs)
+
+    def encode_multi_process(self, texts, pool, **kwargs):
+        return self.model.encode_multi_process(texts, pool, **kwargs)
+
+    def stop_multi_process_pool(self, pool):
+        self.model.stop_multi_process_pool(pool)
+
+
+def get_onnx_dir(model_name, onnx_dir=None):
+    if onnx_dir is not None:
+        return onnx_dir
+    return os.path.join(DEFAULT_ONNX_DIR, re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name))
+
+
+def export_onnx(model_name, onnx_dir, opset_version=17):
+    """
+    Export the transformer of a SentenceTransformer model to ONNX, with its tokenizer and the
+    pooling configuration.
+
+    :param model_name: Name of the SentenceTransformer model
+    :param onnx_dir: Folder where the model is exported
+    :param opset_version: ONNX opset of the exported graph
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0]
+    pooling_config = next(
+        module for module in model if isinstance(module, Pooling)
+    ).get_config_dict()
+    # sentence-transformers 2.x stores one flag per pooling mode, later versions a string
+    if pooling_config.get("pooling_mode") == "cls" or pooling_config.get("pooling_mode_cls_token"):
+        pooling_mode = "cls"
+    elif pooling_config.get("pooling_mode") == "mean" or pooling_config.get(
+        "pooling_mode_mean_tokens"
+    ):
+        pooling_mode = "mean"
+    else:
+        raise ValueError(f"Pooling of {model_name} is not supported by the ONNX encoder")
+
+    dummy_inputs = model.tokenizer(["an example question"], return_tensors="pt")
+    input_names = list(dummy_inputs.keys())
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(input_names, inputs)), return_dict=True)[
+                "last_hidden_state"
+            ]
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript exporter handles the dynamic axes of the transformer
+        export_kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(transformer.auto_model).eval(),
+            tuple(dummy_inputs[name] for name in input_names),
+            os.path.join(onnx_dir, ONNX_MODEL_FILE),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                **{name: {0: "batch", 1: "sequence"} for name in input_names},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=opset_version,
+            **export_kwargs,
+        )
+
+    model.tokenizer.save_pretrained(onnx_dir)
+    with open(os.path.join(onnx_dir, ONNX_CONFIG_FILE), "w") as out_file:
+        json.dump(
+            {
+                "model_name": model_name,
+                "pooling_mode": pooling_mode,
+                "normalize": any(isinstance(module, Normalize) for module in model),
+                "max_seq_length": transformer.max_seq_length,
+                "dim": model.get_sentence_embedding_dimension(),
+            },
+            out_file,
+            indent=2,
+        )
+    logger.info(f"{model_name} exported to ONNX in {onnx_dir}")
+
+
+def quantize_onnx(onnx_dir):
+    """Dynamic int8 quantisation of the weights of an exported model"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(
+        os.path.join(onnx_dir, ONNX_MODEL_FILE),
+        os.path.join(onnx_dir, ONNX_MODEL_INT8_FILE),
+        weight_type=QuantType.QInt8,
+    )
+    logger.info(f"ONNX model in {onnx_dir} quantised to int8")
+
+
+class OnnxEncoder:
+    """
+    ONNX Runtime CPU encoder of a SentenceTransformer model (requires the optional onnxruntime
+    and onnx packages). The model is exported, and optionally quantised, at the first use.
+    """
+
+    backend = "onnx"
+
+    def __init__(self, model_name, onnx_dir=None, quantize=False, num_threads=None) -> None:
+        """
+        :param model_name: Name of the SentenceTransformer model
+        :param onnx_dir: Folder of the exported model (default: in ~/.cache/text2sql_epi/onnx)
+        :param quantize: True to use int8 weights
+        :param num_threads: Number of threads of ONNX Runtime (None: one per core)
+        """
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(
+                "The onnx encoder requires onnxruntime: pip install onnxruntime onnx"
+            ) from e
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.quantize = quantize
+        self.onnx_dir = get_onnx_dir(model_name, onnx_dir)
+
+        if not os.path.exists(os.path.join(self.onnx_dir, ONNX_CONFIG_FILE)):
+            export_onnx(model_name, self.onnx_dir)
+        model_file = ONNX_MODEL_INT8_FILE if quantize else ONNX_MODEL_FILE
+        if quantize and not os.path.exists(os.path.join(self.onnx_dir, model_file)):
+            quantize_onnx(self.onnx_dir)
+
+        with open(os.path.join(self.onnx_dir, ONNX_CONFIG_FILE), "r") as in_file:
+            self.config = json.load(in_file)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.onnx_dir)
+
+        session_options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(self.onnx_dir, model_file),
+            session_options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    @classmethod
+    def get_name(cls, model_name, quantize=False, **params):
+        """Name of the encoder in the embedding caches and stores"""
+        return f"{model_name}@onnx" + ("-int8" if quantize else "")
+
+    @property
+    def name(self):
+        return self.get_name(self.model_name, quantize=self.quantize)
+
+    def get_sentence_embedding_dimension(self):
+        return self.config["dim"]
+
+    def _encode_batch(self, texts):
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.config["max_seq_length"],
+            return_tensors="np",
+        )
+        hidden_states = self.session.run(
+            None, {name: inputs[name].astype(np.int64) for name in self.input_names}
+        )[0]
+        if self.config["pooling_mode"] == "cls":
+            return hidden_states[:, 0]
+        mask = inputs["attention_mask"][:, :, None].astype(np.float32)
+        return (hidden_states * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+    def encode(
+        self,
+        texts,
+        batch_size=32,
+        normalize_embeddings=False,
+        convert_to_numpy=True,
+        show_progress_bar=False,
+        **kwargs,
+    ):
+        """Same interface as SentenceTransformer.encode, always returns numpy arrays"""
+        is_single_text = isinstance(texts, str)
+        if is_single_text:
+            texts = [texts]
+
+        embeddings = np.empty((len(texts), self.config["dim"]), dtype=np.float32)
+        # batches of texts of similar length, as SentenceTransformer.encode does
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            idx_batch = order[start : start + batch_size]
+            embeddings[idx_batch] = self._encode_batch([texts[idx] for idx in idx_batch])
+
+        if normalize_embeddings or self.config["normalize"]:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.maximum(norms, 1e-12)
+        return embeddings[0] if is_single_text else embeddings
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RemoteEncoder:
+    """
+    Client of an embedding server (see text2sql_epi.embedding_server), so that several
+    processes share one model. The server batches the requests of all its clients.
+    """
+
+    backend = "remote"
+
+    def __init__(self, model_name, url="http://127.0.0.1:8765", timeout=60) -> None:
+        """
+        :param model_name: Name of the SentenceTransformer model, checked against the server
+        :param url: URL of the server, "http://host:port" or "unix:///path/to/socket"
+        :param timeout: Timeout of a request in seconds
+        """
+        self.model_name = model_name
+        self.url = url
+        self.timeout = timeout
+        # one keep-alive connection per thread
+        self._local = threading.local()
+
+        self.info = self._request("GET", "/info")[0]
+        if self.info["model_name"] != model_name:
+            raise ValueError(
+                f"The embedding server at {url} serves {self.info['model_name']}, "
+                f"not {model_name}"
+            )
+
+    @classmethod
+    def get_name(cls, model_name, url="http://127.0.0.1:8765", **params):
+        """Name of the encoder of the server in the embedding caches and stores"""
+        return cls(model_name, url=url, **params).name
+
+    @property
+    def name(self):
+        return self.info["encoder_name"]
+
+    def _get_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            url = urlparse(self.url)
+            if url.scheme == "unix":
+                connection = UnixHTTPConnection(url.path, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(
+                    url.hostname, url.port, timeout=self.timeout
+                )
+            self._local.connection = connection
+        return connection
+
+    def _request(self, method, path, payload=None):
+        body = json.dumps(payload) if payload is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        for attempt in range(2):
+            connection = self._get_connection()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # the keep-alive connection was closed by the server: reconnect once
+                connection.close()
+                self._local.connection = None
+                if attempt == 1:
+                    raise
+        if response.status != 200:
+            raise RuntimeError(
+                f"Embedding server at {self.url} answered {response.status}: {data[:200]}"
+            )
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            return json.loads(data), response
+        return data, response
+
+    def get_sentence_embedding_dimension(self):
+        return self.info["dim"]
+
+    def encode(self, texts, batch_size=None, normalize_embeddings=True, **kwargs):
+        """
+        Same interface as SentenceTransformer.encode. The server always returns normalised
+        embeddings and does the batching.
+        """
+        is_single_text = isinstance(texts, str)
+        if is_single_text:
+            texts = [texts]
+        if len(texts) == 0:
+            return np.empty((0, self.info["dim"]), dtype=np.float32)
+
+        data, response = self._request("POST", "/encode", {"texts": list(texts)})
+        shape = json.loads(response.getheader("X-Embedding-Shape"))
+        embeddings = np.frombuffer(data, dtype=np.float32).reshape(shape).copy()
+        return embeddings[0] if is_single_text else embeddings
+
+
+ENCODER_BACKENDS = {
+    encoder_class.backend: encoder_class
+    for encoder_class in [SentenceTransformerEncoder, OnnxEncoder, RemoteEncoder]
+}
+
+
+def create_encoder(model_name, backend="torch", **params):
+    """
+    :param model_name: Name of the SentenceTransformer model
+    :param backend: "torch" (SentenceTransformer), "onnx" (ONNX Runtime) or "remote" (client of
+        an embedding server)
+    :param params: Parameters of the backend (e.g. quantize=True for onnx, url for remote)
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(
+            f"Unknown encoder backend {backend}, use one of {list(ENCODER_BACKENDS)}"
+        )
+    return ENCODER_BACKENDS[backend](model_name, **params)
+
+
+def get_encoder_name(model_name, backend="torch", **params):
+    return ENCODER_BACKENDS[backend].get_name(model_name, **params)
@@ -0,0 +1,104 @@
+import logging
+import re
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_name(name):
+    """Lowercase, replace punctuation by spaces and collapse whitespace"""
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", str(name).lower()).split())
+
+
+class LexicalIndex:
+    """
+    Exact-match hash index and character trigram inverted index over concept names.
+
+    Answers the lookups of names that (nearly) match a concept name without encoding them.
+    """
+
+    def __init__(self, names, domain_ids=None, vocabulary_ids=None) -> None:
+        """
+        :param names: Concept names, in the order of the rows of the ontology
+        :param domain_ids: Domain of each concept (None: no domain filter)
+        :param vocabulary_ids: Vocabulary of each concept (None: no vocabulary filter)
+        """
+        names_normalized = [normalize_name(name) for name in names]
+        self.n_rows = len(names_normalized)
+        self.domain_ids = (
+            np.asarray(domain_ids, dtype=str) if domain_ids is not None else None
+        )
+        self.vocabulary_ids = (
+            np.asarray(vocabulary_ids, dtype=str) if vocabulary_ids is not None else None
+        )
+
+        rows_by_name = {}
+        for row, name in enumerate(names_normalized):
+            rows_by_name.setdefault(name, []).append(row)
+        self._exact = {
+            name: np.array(rows, dtype=np.int64) for name, rows in rows_by_name.items()
+        }
+
+        # imported here: sklearn is only needed once the ontology is searched
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        # tf-idf weighted trigrams: the postings of a trigram are the rows of its column
+        self._vectorizer = TfidfVectorizer(
+            analyzer="char_wb", ngram_range=(3, 3), lowercase=False, dtype=np.float32
+        )
+        try:
+            self._postings = self._vectorizer.fit_transform(names_normalized).T.tocsr()
+        except ValueError:
+            # no name with at least one trigram
+            self._vectorizer = None
+            self._postings = None
+
+    def __len__(self):
+        return self.n_rows
+
+    def _filter_rows(self, rows, domain_id, vocabularies):
+        keep = np.ones(len(rows), dtype=bool)
+        if domain_id is not None and self.domain_ids is not None:
+            keep &= self.domain_ids[rows] == str(domain_id)
+        if vocabularies is not None and self.vocabulary_ids is not None:
+            keep &= np.isin(self.vocabulary_ids[rows], [str(v) for v in vocabularies])
+        return keep
+
+    def lookup(self, name, top_k, domain_id=None, vocabularies=None):
+        """
+        :param name: Name of the medical entity
+        :param top_k: Maximum number of concepts returned
+        :param domain_id: Only return the concepts of this domain
+        :param vocabularies: Only return the concepts of these vocabularies
+        :return: (positions of the concepts, scores, True if the name matches a concept name
+            exactly after normalisation). Exact matches come first with a score of 1, followed
+            by the other concepts scored with the cosine similarity of the trigram vectors, in
+            decreasing order
+        """
+        name_normalized = normalize_name(name)
+
+        rows_exact = self._exact.get(name_normalized, np.empty(0, dtype=np.int64))
+        rows_exact = rows_exact[self._filter_rows(rows_exact, domain_id, vocabularies)][:top_k]
+
+        if self._vectorizer is not None and len(rows_exact) < top_k:
+            # only the postings of the trigrams of the name are read
+            scores_sparse = (self._vectorizer.transform([name_normalized]) @ self._postings).tocsr()
+            rows = scores_sparse.indices.astype(np.int64)
+            scores = scores_sparse.data.astype(np.float32)
+            keep = self._filter_rows(rows, domain_id, vocabularies) & ~np.isin(rows, rows_exact)
+            rows, scores = rows[keep], scores[keep]
+        else:
+            rows = np.empty(0, dtype=np.int64)
+            scores = np.empty(0, dtype=np.float32)
+
+        top_k_trigram = top_k - len(rows_exact)
+        if len(rows) > top_k_trigram:
+            idx_top = np.argpartition(-scores, top_k_trigram - 1)[:top_k_trigram]
+            rows, scores = rows[idx_top], scores[idx_top]
+        order = np.lexsort((rows, -scores))
+        return (
+            np.concatenate([rows_exact, rows[order]]),
+            np.concatenate([np.ones(len(rows_exact), dtype=np.float32), scores[order]]),
+            len(rows_exact) > 0,
+        )
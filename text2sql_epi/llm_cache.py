@@ -0,0 +1,176 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_MODES = ("read_write", "write_only", "replay")
+
+
+class LLMCacheMiss(KeyError):
+    """Raised in replay mode when a prompt has no cached response"""
+
+
+class LLMResponseCache:
+    """
+    SQLite cache of the LLM responses, keyed by the hash of the request (engine, messages,
+    response_format, max_tokens). The assistants call the LLM with temperature=0, so a rerun of
+    an unchanged experiment sends the same requests and can be answered from the cache.
+
+    Modes:
+        - "read_write": return the cached response, call the LLM and store the response on a miss
+        - "write_only": always call the LLM and store the response (refreshes the cache)
+        - "replay": only return cached responses, raise LLMCacheMiss on a miss (no LLM call)
+    """
+
+    def __init__(self, cache_file=None, mode="read_write", max_entries=100000, ttl_sec=None) -> None:
+        """
+        :param cache_file: SQLite file of the cache (None: in memory, for the process only)
+        :param mode: "read_write", "write_only" or "replay"
+        :param max_entries: Maximum number of responses kept, the least recently used are evicted
+        :param ttl_sec: Age in seconds after which a response is evicted (None: no expiry)
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode {mode}, expected one of {CACHE_MODES}")
+        self.cache_file = cache_file
+        self.mode = mode
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if cache_file is not None:
+            directory = os.path.dirname(cache_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(
+            cache_file if cache_file is not None else ":memory:", check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (request_hash TEXT PRIMARY KEY, engine TEXT, "
+            "response TEXT, created_at REAL, accessed_at REAL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+        )
+        self._db.commit()
+        self.evict()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @property
+    def read_enabled(self):
+        return self.mode in ("read_write", "replay")
+
+    @property
+    def write_enabled(self):
+        return self.mode in ("read_write", "write_only")
+
+    @staticmethod
+    def get_request_hash(engine, messages, response_format=None, max_tokens=None):
+        request = json.dumps(
+            {
+                "engine": engine,
+                "messages": messages,
+                "response_format": response_format,
+                "max_tokens": max_tokens,
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, request_hash):
+        """
+        :return: cached response, or None if the request is not cached (or expired)
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, created_at FROM responses WHERE request_hash = ?",
+                (request_hash,),
+            ).fetchone()
+            if row is None or (self.ttl_sec is not None and now - row[1] > self.ttl_sec):
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE responses SET accessed_at = ? WHERE request_hash = ?", (now, request_hash)
+            )
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, request_hash, engine, response):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (request_hash, engine, response, now, now),
+            )
+            self._db.commit()
+            n_entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if n_entries > self.max_entries:
+            self.evict()
+
+    def lookup(self, engine, messages, response_format=None, max_tokens=None):
+        """
+        :return: (request hash, cached response or None); None is only returned when the LLM
+            should be called
+        """
+        request_hash = self.get_request_hash(engine, messages, response_format, max_tokens)
+        if not self.read_enabled:
+            return request_hash, None
+        response = self.get(request_hash)
+        if response is None and self.mode == "replay":
+            raise LLMCacheMiss(
+                f"No cached response for the request {request_hash} of {engine} in replay mode"
+            )
+        return request_hash, response
+
+    def store(self, request_hash, engine, response):
+        if self.write_enabled and response is not None:
+            self.put(request_hash, engine, response)
+
+    def evict(self):
+        """Delete the expired responses and the least recently used beyond max_entries"""
+        with self._lock:
+            n_deleted = 0
+            if self.ttl_sec is not None:
+                n_deleted += self._db.execute(
+                    "DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_sec,)
+                ).rowcount
+            n_deleted += self._db.execute(
+                "DELETE FROM responses WHERE request_hash IN (SELECT request_hash FROM responses "
+                "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+            self._db.commit()
+        if n_deleted:
+            logger.info(f"{n_deleted} LLM cache entries evicted")
+        return n_deleted
+
+    def get_stats(self):
+        n_entries = len(self)
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return {
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / n_lookups if n_lookups else 0.0,
+                "size": n_entries,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+            self.hits = 0
+            self.misses = 0
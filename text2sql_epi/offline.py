@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from typing import Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineAssistant:
+    """
+    Stand-in for GPTAssistant without network access, for load tests of the pipeline.
+
+    Each call waits latency_ms like a remote LLM would. The masking prompt returns the question
+    unchanged, the SQL generation returns the first example query of the RAG prompt (with its
+    placeholders) and the other prompts return a short canned answer.
+    """
+
+    def __init__(self, latency_ms=500) -> None:
+        """
+        :param latency_ms: Simulated response time of the LLM
+        """
+        self.latency_ms = latency_ms
+        self.system_message = {
+            "role": "system",
+            "content": "You are a helpful assistant.",
+        }
+        self.conversation = [self.system_message]
+        self.n_calls = 0
+
+    def add_message(self, role, message):
+        self.conversation.append({"role": role, "content": message})
+
+    def reset_conversation(self):
+        self.conversation = [self.system_message]
+
+    def get_offline_response(self, messages):
+        content = messages[-1]["content"]
+        if content.rstrip().endswith("Masked text:"):
+            # entity masking: the question is kept as is
+            return content.rstrip()[: -len("Masked text:")].rsplit("Input text:", 1)[-1].strip()
+        if "If no DRUG_CLASS detected return unchanged question" in content:
+            return content.rsplit("Input text:", 1)[-1].strip()
+
+        # SQL generation: first example query of the RAG prompt in the conversation
+        for message in messages:
+            match = re.search(r"#SQL query:\n([\s\S]+?)(?:\n\n#Question:|$)", message["content"])
+            if match:
+                return f"```sql\n{match.group(1).strip()}\n```"
+        return "Offline answer: the data retrieved answers the question."
+
+    async def get_response(self, prompt: Optional[str] = None):
+        messages = (
+            [{"role": "user", "content": prompt}]
+            if prompt is not None
+            else self.conversation
+        )
+        self.n_calls += 1
+        await asyncio.sleep(self.latency_ms / 1000)
+        response = self.get_offline_response(messages)
+        if prompt is None:
+            self.add_message(role="assistant", message=response)
+        return response
+
+    async def get_response_json(self, prompt: Optional[str] = None):
+        return await self.get_response(prompt)
+
+
+class OfflineResult:
+    def __init__(self, rows) -> None:
+        self.rows = rows
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def scalar(self):
+        return self.rows[0][0] if self.rows else None
+
+
+class OfflineDatabase:
+    """
+    Stand-in for a Snowflake session (see snowflake_session.get_db): every statement blocks
+    for latency_ms, like a query of the warehouse, and returns the same rows.
+    """
+
+    def __init__(self, latency_ms=200, rows=None) -> None:
+        """
+        :param latency_ms: Simulated execution time of a statement
+        :param rows: Rows returned by every statement (default: one patient count)
+        """
+        self.latency_ms = latency_ms
+        self.rows = rows if rows is not None else [(1234,)]
+        self.n_statements = 0
+
+    def execute(self, statement):
+        self.n_statements += 1
+        time.sleep(self.latency_ms / 1000)
+        return OfflineResult(self.rows)
+
+    def close(self):
+        pass
+
+
+class MockChatServer:
+    """
+    Local chat completions endpoint (OpenAI / Mistral / Azure OpenAI format) answering like
+    OfflineAssistant,
+    with an injected latency and a share of throttled (429) and failed (500) requests, to test
+    the clients, their connection pools and their retries without network access.
+    """
+
+    def __init__(
+        self,
+        latency_ms=500,
+        throttle_rate=0.0,
+        error_rate=0.0,
+        retry_after_sec=1,
+        seed=0,
+        max_concurrency=None,
+    ) -> None:
+        """
+        :param latency_ms: Response time of each request
+        :param throttle_rate: Share of the requests answered with 429
+        :param error_rate: Share of the requests answered with 500
+        :param retry_after_sec: Retry-After header of the 429 responses
+        :param seed: Seed of the random failures
+        :param max_concurrency: Number of requests processed at once, the others wait like on
+            a loaded deployment (None: unlimited)
+        """
+        self.latency_ms = latency_ms
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after_sec = retry_after_sec
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.n_errors = 0
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._rng = random.Random(seed)
+        self._assistant = OfflineAssistant(latency_ms=0)
+
+    def get_stats(self):
+        return {
+            "requests": self.n_requests,
+            "throttled": self.n_throttled,
+            "errors": self.n_errors,
+        }
+
+    async def handle_chat_completions(self, request):
+        payload = await request.json()
+        self.n_requests += 1
+        if self.max_concurrency is None:
+            await asyncio.sleep(self.latency_ms / 1000)
+        else:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            async with self._semaphore:
+                await asyncio.sleep(self.latency_ms / 1000)
+        draw = self._rng.random()
+        if draw < self.throttle_rate:
+            self.n_throttled += 1
+            return web.json_response(
+                {"error": {"code": "429", "message": "Rate limit exceeded"}},
+                status=429,
+                headers={"Retry-After": str(self.retry_after_sec)},
+            )
+        if draw < self.throttle_rate + self.error_rate:
+            self.n_errors += 1
+            return web.json_response({"error": {"message": "Internal error"}}, status=500)
+
+        messages = payload["messages"]
+        content = self._assistant.get_offline_response(messages)
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        return web.json_response(
+            {
+                "id": f"mock-{self.n_requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": payload.get("model", "mock"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": prompt_tokens + len(content) // 4,
+                },
+            }
+        )
+
+    async def handle_stats(self, request):
+        return web.json_response(self.get_stats())
+
+    def create_app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        # Azure OpenAI: the deployment is in the path, every deployment answers the same way
+        app.router.add_post(
+            "/openai/deployments/{deployment}/chat/completions", self.handle_chat_completions
+        )
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    def run(self, host="127.0.0.1", port=8000):
+        """
+        :param host: Interface of the HTTP server (localhost only by default)
+        :param port: Port of the HTTP server
+        """
+        logger.info(f"Mock chat completions endpoint listening on {host}:{port}")
+        web.run_app(self.create_app(), host=host, port=port, access_log=None)
@@ -0,0 +1,130 @@
+import atexit
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from text2sql_epi.query_library import INDEX_MANIFEST_FILE, QueryLibrary
+
+logger = logging.getLogger(__name__)
+
+# library of the worker process, loaded once by the pool initializer
+_worker_querylib = None
+
+# worker pools kept between calls, keyed by (index folder, version of the index, processes)
+_search_pools = {}
+_search_pools_lock = threading.Lock()
+
+
+def _init_worker_from_index_dir(index_dir):
+    global _worker_querylib
+    # the embedding matrix (and the codes of quantised indices) are memory-mapped: all workers
+    # share the page-cached copy of the index folder
+    _worker_querylib = QueryLibrary.load_index(index_dir, mmap_mode="r")
+    _worker_querylib.get_search_index()
+
+
+def get_search_pool(index_dir, n_processes):
+    """
+    :param index_dir: Folder of the index searched by the workers
+    :param n_processes: Number of worker processes
+    :return: pool of workers which loaded the index, started at the first call and reused by
+        the next ones until the index folder is saved again
+    """
+    index_dir = os.path.abspath(index_dir)
+    index_version = os.path.getmtime(os.path.join(index_dir, INDEX_MANIFEST_FILE))
+    with _search_pools_lock:
+        for key in [key for key in _search_pools if key[0] == index_dir]:
+            if key[1] != index_version:
+                # the workers hold the previous version of the index
+                _search_pools.pop(key).shutdown(wait=False)
+        key = (index_dir, index_version, n_processes)
+        if key not in _search_pools:
+            _search_pools[key] = ProcessPoolExecutor(
+                max_workers=n_processes,
+                initializer=_init_worker_from_index_dir,
+                initargs=(index_dir,),
+            )
+            logger.info(f"Search pool of {n_processes} processes started for {index_dir}")
+        return _search_pools[key]
+
+
+@atexit.register
+def shutdown_search_pools():
+    with _search_pools_lock:
+        for executor in _search_pools.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        _search_pools.clear()
+
+
+def _search_chunk(text_embeddings, top_k, sim_threshold, search_filters):
+    return _worker_querylib.search_embeddings(
+        text_embeddings, top_k=top_k, sim_threshold=sim_threshold, **search_filters
+    )
+
+
+def parallel_search(
+    querylib,
+    text_embeddings,
+    top_k,
+    sim_threshold=None,
+    n_processes=2,
+    max_rows=1000,
+    **search_filters,
+):
+    """
+    Score query embeddings against the library with a pool of worker processes.
+
+    The library must have been loaded with QueryLibrary.load_index: the workers memory-map the
+    read-only files of the index folder, and only query embeddings and (positions, scores)
+    arrays are sent between processes. The pool is kept for the next calls (see
+    get_search_pool).
+
+    :param querylib: QueryLibrary or MedCodingOnto loaded with QueryLibrary.load_index
+    :param text_embeddings: Normalised query embeddings, one row per query
+    :param top_k: Number of records retrieved per query
+    :param sim_threshold: Minimum similarity score (None: no threshold)
+    :param n_processes: Number of worker processes
+    :param max_rows: Number of queries sent to a worker at once
+    :param search_filters: Restrictions of the search, see search_embeddings
+    :return: (positions of the records in df_querylib, scores), both of shape (n_queries, top_k)
+    """
+    index_dir = getattr(querylib, "index_dir", None)
+    if index_dir is None:
+        raise ValueError(
+            f"{querylib.querylib_name} has no index folder: save it with save_index and load it "
+            "with QueryLibrary.load_index to search it with several processes"
+        )
+
+    text_embeddings = np.asarray(text_embeddings, dtype=np.float32)
+    chunks = [
+        text_embeddings[start : start + max_rows]
+        for start in range(0, text_embeddings.shape[0], max_rows)
+    ]
+    if not chunks:
+        return np.empty((0, top_k), dtype=np.int64), np.empty((0, top_k), dtype=np.float32)
+
+    executor = get_search_pool(index_dir, n_processes)
+    try:
+        results = list(
+            executor.map(
+                _search_chunk,
+                chunks,
+                [top_k] * len(chunks),
+                [sim_threshold] * len(chunks),
+                [search_filters] * len(chunks),
+            )
+        )
+    except BrokenProcessPool:
+        # a worker died: the next call starts a new pool
+        with _search_pools_lock:
+            for key in [key for key, pool in _search_pools.items() if pool is executor]:
+                del _search_pools[key]
+        raise
+
+    idx_records = np.concatenate([idx for idx, _ in results])
+    scores = np.concatenate([scores for _, scores in results])
+    return idx_records, scores
@@ -0,0 +1,240 @@
+import asyncio
+import copy
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+from aiohttp import web
+
+from text2sql_epi import helpers, prompts
+from text2sql_epi.sql_post_processor import MedicalSQLProcessor
+
+logger = logging.getLogger(__name__)
+
+# vocabularies of the placeholders, as in scripts/prediction_pipeline.py
+DEFAULT_SELECTED_CODING = {
+    "condition": ["SNOMED"],
+    "procedure": ["CPT4", "SNOMED"],
+    "drug": ["RxNorm", "RxNorm Extension"],
+}
+
+
+class LatencyStats:
+    """Latencies of the most recent requests, per pipeline stage, reported as percentiles"""
+
+    def __init__(self, window=10000, percentiles=(50, 90, 95, 99)) -> None:
+        """
+        :param window: Number of latencies kept per stage
+        :param percentiles: Percentiles reported by get_stats
+        """
+        self.window = window
+        self.percentiles = percentiles
+        self._latencies = {}
+        self.n_requests = 0
+        self.n_errors = 0
+
+    def record(self, stage, seconds):
+        self._latencies.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+    def get_stats(self):
+        stats = {"requests": self.n_requests, "errors": self.n_errors, "stages": {}}
+        for stage, latencies in self._latencies.items():
+            latencies_ms = np.array(latencies) * 1000
+            stats["stages"][stage] = {
+                "count": len(latencies_ms),
+                "mean_ms": float(latencies_ms.mean()),
+                **{
+                    f"p{percentile}_ms": float(np.percentile(latencies_ms, percentile))
+                    for percentile in self.percentiles
+                },
+            }
+        return stats
+
+
+class PipelineService:
+    """
+    Resident text-to-SQL service: the query library, the ontology index, the encoders and the
+    LLM and database connection pools are loaded once and shared by all the questions, which
+    are answered concurrently on one event loop (see end2end_pred_pipeline_ds in
+    scripts/prediction_pipeline.py for the one-shot version).
+    """
+
+    def __init__(
+        self,
+        rag,
+        assistant_factory,
+        medcodeonto=None,
+        database_factory=None,
+        concept_cache=None,
+        selected_coding=None,
+        max_concurrency=64,
+    ) -> None:
+        """
+        :param rag: AgentRag, whose query library is shared by the requests
+        :param assistant_factory: Function returning a new assistant; each request has its
+            own conversations, the assistants should share one client (see
+            assistants.create_assistant)
+        :param medcodeonto: MedCodingOnto filling the placeholders (None: no medical coding)
+        :param database_factory: Function returning a context manager yielding a database
+            session, e.g. from a pooled engine (None: queries are not executed)
+        :param concept_cache: ConceptResolutionCache shared by the requests
+        :param selected_coding: Vocabularies of the placeholders of each entity type
+        :param max_concurrency: Maximum number of questions answered at once
+        """
+        self.rag = rag
+        self.assistant_factory = assistant_factory
+        self.medcodeonto = medcodeonto
+        self.database_factory = database_factory
+        self.concept_cache = concept_cache
+        self.selected_coding = (
+            selected_coding if selected_coding is not None else DEFAULT_SELECTED_CODING
+        )
+        self.max_concurrency = max_concurrency
+        self.latency_stats = LatencyStats()
+        self._semaphore = None
+
+    @contextmanager
+    def timed(self, timings, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[stage] = time.perf_counter() - start
+            self.latency_stats.record(stage, timings[stage])
+
+    async def predict(self, question, med_coding=True, use_db=False):
+        """
+        :param question: Question of the user
+        :param med_coding: True to fill the placeholders of the SQL template with concept ids
+        :param use_db: True to run the query and let the LLM answer from the data
+        :return: dict with the masked question, the SQL template and query, the answer and the
+            duration of each stage in ms
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._semaphore:
+            self.latency_stats.n_requests += 1
+            timings = {}
+            try:
+                with self.timed(timings, "total"):
+                    result = await self._predict(question, med_coding, use_db, timings)
+            except Exception:
+                self.latency_stats.n_errors += 1
+                raise
+        result["timings_ms"] = {stage: seconds * 1000 for stage, seconds in timings.items()}
+        return result
+
+    async def _predict(self, question, med_coding, use_db, timings):
+        # the library and its settings are shared, the conversations are not
+        rag_agent = copy.copy(self.rag)
+        rag_agent.assistant = self.assistant_factory()
+        rag_agent.assistant_answers = self.assistant_factory()
+
+        with self.timed(timings, "masking"):
+            question_masked, question_llm = await rag_agent.querylib.get_masked_question(
+                prompts=prompts,
+                question=question,
+                assistant=rag_agent.assistant,
+            )
+        with self.timed(timings, "retrieval"):
+            text_sql_template, df_recs_list_out = await helpers.get_text_sql_template_for_rag(
+                question_masked=question_masked, rag=rag_agent
+            )
+        initial_prompt = helpers.prepare_prediction(question_llm, prompt=rag_agent.prompt)
+        helpers.add_messages_to_assistant(
+            [initial_prompt, text_sql_template], rag_agent.assistant
+        )
+        with self.timed(timings, "sql_generation"):
+            gpt_answer = await rag_agent.assistant.get_response()
+
+        med_sql_processor = MedicalSQLProcessor(
+            assistant=rag_agent.assistant, concept_cache=self.concept_cache
+        )
+        query_template_pred = med_sql_processor.parse_sql_from_response(gpt_answer)
+
+        query_filled_pred = None
+        if med_coding and self.medcodeonto is not None and query_template_pred is not None:
+            with self.timed(timings, "medical_coding"):
+                query_filled_pred = await med_sql_processor.post_process_sql_query(
+                    query_template_pred,
+                    explorer_concepts=None,
+                    selected_coding=self.selected_coding,
+                    rag=rag_agent,
+                    medcodeonto=self.medcodeonto,
+                )
+
+        answer = None
+        if use_db and self.database_factory is not None and query_filled_pred is not None:
+            rwd_request_pred = helpers.prepare_rwd_request(
+                question,
+                query_filled_pred,
+                query_template_pred,
+                question_masked,
+                df_recs_list_out,
+                rag_agent.assistant.conversation,
+            )
+            with self.timed(timings, "database"):
+                with self.database_factory() as db:
+                    await rwd_request_pred.run_query(
+                        query_filled_pred,
+                        db=db,
+                        assistant=rag_agent.assistant,
+                        max_retries=5,
+                        reset_conversation=False,
+                    )
+            with self.timed(timings, "answer"):
+                await rwd_request_pred.get_answer(rag_agent.assistant_answers)
+            answer = rwd_request_pred.answer
+
+        return {
+            "question": question,
+            "question_masked": question_masked,
+            "query_template": query_template_pred,
+            "query_filled": query_filled_pred,
+            "answer": answer,
+        }
+
+    async def handle_predict(self, request):
+        payload = await request.json()
+        if not payload.get("question"):
+            return web.json_response({"error": "question is required"}, status=400)
+        try:
+            result = await self.predict(
+                str(payload["question"]),
+                med_coding=bool(payload.get("med_coding", True)),
+                use_db=bool(payload.get("use_db", False)),
+            )
+        except Exception as e:
+            logger.exception("Prediction failed")
+            return web.json_response({"error": str(e)}, status=500)
+        return web.json_response(result)
+
+    async def handle_stats(self, request):
+        stats = self.latency_stats.get_stats()
+        stats["retrieval_executor"] = self.rag.querylib.retrieval_executor.get_stats()
+        if self.concept_cache is not None:
+            stats["concept_cache"] = self.concept_cache.get_stats()
+        if getattr(self.rag, "deployment_pool", None) is not None:
+            stats["deployments"] = self.rag.deployment_pool.get_stats()
+        return web.json_response(stats)
+
+    async def handle_health(self, request):
+        return web.json_response({"status": "ok"})
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post("/predict", self.handle_predict)
+        app.router.add_get("/stats", self.handle_stats)
+        app.router.add_get("/health", self.handle_health)
+        return app
+
+    def run(self, host="127.0.0.1", port=8080):
+        """
+        :param host: Interface of the HTTP server (localhost only by default)
+        :param port: Port of the HTTP server
+        """
+        logger.info(f"Text-to-SQL service listening on {host}:{port}")
+        web.run_app(self.create_app(), host=host, port=port, access_log=None)
@@ -4,28 +4,147 @@ __maintainer__ = "Angelo Ziletti"
 __email__ = "angelo.ziletti@bayer.com"
 __date__ = "24/11/23"
 
+import hashlib
+import json
 import logging
 import os.path
 import pickle
+import threading
 import time
+import warnings
 from concurrent.futures import as_completed, ThreadPoolExecutor
 from datetime import date
 from typing import Optional
 
 import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from sklearn.preprocessing import normalize
 from tqdm import tqdm
 
+from text2sql_epi.embedding_cache import default_query_embedding_cache
+from text2sql_epi.encoders import create_encoder, get_encoder_name
+from text2sql_epi.embedding_store import EmbeddingStore
+from text2sql_epi.lexical_index import LexicalIndex
+from text2sql_epi.retrieval_executor import default_retrieval_executor
+from text2sql_epi.search_index import (
+    EmbeddingIndex,
+    create_search_index,
+    load_search_index,
+    row_norms,
+    top_k_similar,
+)
+
 tqdm.pandas()
 
 logger = logging.getLogger(__name__)
 
+INDEX_FORMAT_VERSION = 1
+INDEX_MANIFEST_FILE = "manifest.json"
+INDEX_METADATA_FILE = "metadata.parquet"
+# trigram similarity above which a concept name is answered by the lexical index
+LEXICAL_MIN_SCORE = 0.9
+
+
+def encode_texts(
+    embedding_model,
+    texts,
+    batch_size=64,
+    sort_by_length=True,
+    num_processes=None,
+    show_progress_bar=True,
+):
+    """
+    Encode a list of texts into a (len(texts), dim) float32 matrix of normalized embeddings.
+
+    Texts are sorted by length so that each batch holds sequences of similar length and
+    little compute is spent on padding; rows are returned in the original order.
+
+    :param embedding_model: Encoder (see text2sql_epi.encoders) or SentenceTransformer model
+    :param texts: List of strings to encode
+    :param batch_size: Number of texts encoded per forward pass
+    :param sort_by_length: True to sort the texts by length before batching
+    :param num_processes: Number of CPU worker processes (None or 1 to encode in-process)
+    :param show_progress_bar: True to display a progress bar
+    :return: embedding matrix, one row per input text
+    """
+    n_texts = len(texts)
+    dim = embedding_model.get_sentence_embedding_dimension()
+    embed_matrix = np.empty((n_texts, dim), dtype=np.float32)
+    if n_texts == 0:
+        return embed_matrix
+
+    if sort_by_length:
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+    else:
+        order = np.arange(n_texts)
+    texts_sorted = [texts[idx] for idx in order]
+
+    if num_processes is not None and num_processes > 1:
+        if not hasattr(embedding_model, "start_multi_process_pool"):
+            logger.warning(
+                "The encoder has no multi-process pool, encoding in-process (ONNX Runtime "
+                "already uses all cores)"
+            )
+            num_processes = None
+
+    if num_processes is not None and num_processes > 1:
+        pool = embedding_model.start_multi_process_pool(
+            target_devices=["cpu"] * num_processes
+        )
+        try:
+            # each process receives chunks of already length-sorted texts
+            chunk_size = max(batch_size, min(5000, n_texts // (num_processes * 4) + 1))
+            embed_sorted = embedding_model.encode_multi_process(
+                texts_sorted, pool, batch_size=batch_size, chunk_size=chunk_size
+            )
+        finally:
+            embedding_model.stop_multi_process_pool(pool)
+        embed_sorted = np.asarray(embed_sorted, dtype=np.float32)
+        norms = np.linalg.norm(embed_sorted, axis=1, keepdims=True)
+        embed_matrix[order] = embed_sorted / np.maximum(norms, 1e-12)
+        return embed_matrix
+
+    # encode in chunks of several batches to report progress over the whole dataset
+    chunk_size = batch_size * 16
+    for start in tqdm(
+        range(0, n_texts, chunk_size),
+        total=-(-n_texts // chunk_size),
+        disable=not show_progress_bar,
+    ):
+        end = min(start + chunk_size, n_texts)
+        embed_matrix[order[start:end]] = embedding_model.encode(
+            texts_sorted[start:end],
+            batch_size=batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        )
+
+    return embed_matrix
+
+
+def normalize(embeddings):
+    """L2-normalise the rows of embeddings (sklearn is imported at the first call)"""
+    from sklearn.preprocessing import normalize as normalize_rows
+
+    return normalize_rows(embeddings)
+
+
+def get_first_pass_kwargs(first_pass_embeddings):
+    """Keyword arguments of the search of a cascade index (other indices do not take them)"""
+    if first_pass_embeddings is None:
+        return {}
+    return {"first_pass_embeddings": first_pass_embeddings}
+
 
 class QueryLibrary:
     """Collection of queries for retrieval augmented generation"""
 
+    # cache of the query embeddings, shared by all libraries (None to disable)
+    query_embedding_cache = default_query_embedding_cache
+    # thread pool running the retrieval of the async methods, shared by all libraries
+    retrieval_executor = default_retrieval_executor
+    # guards the lazy loading of the model and of the search index by concurrent retrievals
+    _lazy_init_lock = threading.RLock()
+
     def __init__(
         self,
         querylib_name: str,
@@ -54,27 +173,161 @@ class QueryLibrary:
         self.embeddings = []
 
         self.embedding_model = None
+        # encoder of the first pass of a cascade search index on a smaller model
+        self.first_pass_model = None
+        self.encoder_backend = "torch"
+        self.encoder_params = {}
+        self.search_backend = "exact"
+        self.search_params = {}
+        # folder of the index when the library is loaded with load_index
+        self.index_dir = None
+        self._search_index = None
+        self._search_index_key = None
 
     def __len__(self):
         return len(self.df_querylib)
 
+    def _get_search_index_key(self):
+        return (
+            id(self.embeddings[0]["embed_matrix"]),
+            id(self.df_querylib),
+            len(self.df_querylib),
+        )
+
+    def build_search_index(self, backend="exact", **params):
+        """
+        Build the search index of the first embedding.
+
+        :param backend: "exact" (brute force), "ivf" or "hnsw" (approximate nearest neighbours),
+            "int8" or "binary" (quantised codes, candidates rescored with the float vectors),
+            "cascade" (candidates of truncated embeddings or of a smaller model, rescored with
+            the first embedding, e.g. first_pass_model_name="BAAI/bge-small-en-v1.5" after
+            calc_embedding of that model)
+        :param params: Parameters of the backend, see text2sql_epi.search_index
+        """
+        self.search_backend = backend
+        self.search_params = params
+        self._search_index = create_search_index(
+            self.embeddings[0]["embed_matrix"],
+            backend=backend,
+            model_name=self.embeddings[0]["model_name"],
+            **self.get_first_pass_params(params),
+        )
+        self._search_index_key = self._get_search_index_key()
+        logger.info(
+            f"Search index ({backend}) built with {len(self._search_index)} rows"
+        )
+        return self._search_index
+
+    def get_embedding(self, embedding_model_name):
+        """:return: the embedding computed with embedding_model_name"""
+        for embedding in self.embeddings:
+            if embedding["model_name"] == embedding_model_name:
+                return embedding
+        raise ValueError(
+            f"No embedding of {embedding_model_name} in {self.querylib_name}, compute it with "
+            "calc_embedding first"
+        )
+
+    def get_first_pass_params(self, params):
+        """
+        :param params: Parameters of the search backend
+        :return: params, with the first-pass embedding matrix of a cascade on a smaller model
+        """
+        first_pass_model_name = params.get("first_pass_model_name")
+        if first_pass_model_name is None:
+            return params
+        first_pass_matrix = self.get_embedding(first_pass_model_name)["embed_matrix"]
+        return {**params, "first_pass_matrix": first_pass_matrix}
+
+    def get_search_index(self):
+        """
+        Return the search index of the first embedding, building it if the library changed.
+
+        The index is rebuilt only when the embeddings or df_querylib are replaced.
+        """
+        with self._lazy_init_lock:
+            if (
+                getattr(self, "_search_index", None) is None
+                or self._search_index_key != self._get_search_index_key()
+            ):
+                self.build_search_index(
+                    backend=getattr(self, "search_backend", "exact"),
+                    **getattr(self, "search_params", {}),
+                )
+            return self._search_index
+
+    def invalidate_search_index(self):
+        self._search_index = None
+        self._search_index_key = None
+
     def calc_embedding(
-        self, embedding_model_name="BAAI/bge-large-en-v1.5", use_masked=True
+        self,
+        embedding_model_name="BAAI/bge-large-en-v1.5",
+        use_masked=True,
+        batch_size=64,
+        sort_by_length=True,
+        num_processes=None,
+        embedding_store_dir=None,
+        encoder_backend=None,
+        encoder_params=None,
     ):
+        """
+        :param embedding_model_name: Name of the SentenceTransformer model
+        :param use_masked: True to embed the masked question column
+        :param batch_size: Number of texts encoded per forward pass
+        :param sort_by_length: True to group texts of similar length in the same batch
+        :param num_processes: Number of encoding processes (None or 1 to encode in-process)
+        :param embedding_store_dir: Folder of the content-hash embedding stores. If given, only
+            new or edited rows are encoded, the others are read from the store
+        :param encoder_backend: "torch" or "onnx" (None: keep the backend of the library), also
+            used to encode the queries (see text2sql_epi.encoders)
+        :param encoder_params: Parameters of the encoder backend (e.g. {"quantize": True})
+        """
+        if encoder_backend is not None:
+            self.encoder_backend = encoder_backend
+            self.encoder_params = encoder_params or {}
+        encoder_backend = getattr(self, "encoder_backend", "torch")
+        encoder_params = getattr(self, "encoder_params", {})
+
         # check this: https://github.com/FlagOpen/FlagEmbedding/tree/master/FlagEmbedding/llm_embedder
-        embedding_model = SentenceTransformer(embedding_model_name)
         if use_masked:
             col_txt = self.col_question_masked
         else:
             col_txt = self.col_question
+        texts = self.df_querylib[col_txt].astype(str).tolist()
 
-        embed_series = self.df_querylib[col_txt].progress_apply(
-            lambda x: embedding_model.encode(x, normalize_embeddings=True)
-        )
+        embedding_model = None
+
+        def encode_fn(texts_to_encode):
+            nonlocal embedding_model
+            # the model is only loaded if there is something to encode
+            if embedding_model is None:
+                embedding_model = create_encoder(
+                    embedding_model_name, backend=encoder_backend, **encoder_params
+                )
+            return encode_texts(
+                embedding_model,
+                texts_to_encode,
+                batch_size=batch_size,
+                sort_by_length=sort_by_length,
+                num_processes=num_processes,
+            )
 
-        # as output you get a series of arrays, convert it to a matrix
-        # https://stackoverflow.com/questions/40824601/how-to-convert-a-series-of-arrays-into-a-single-matrix-in-pandas-numpy
-        embed_matrix = np.stack(embed_series.values)
+        if embedding_store_dir is not None:
+            # embeddings of different encoder backends are stored separately
+            encoder_name = get_encoder_name(
+                embedding_model_name, backend=encoder_backend, **encoder_params
+            )
+            # one store per library: the store only keeps the texts of its last call
+            store_file = EmbeddingStore.get_store_file(
+                embedding_store_dir, encoder_name, library_name=self.querylib_name
+            )
+            embedding_store = EmbeddingStore.load(store_file, model_name=encoder_name)
+            embed_matrix = embedding_store.get_embeddings(texts, encode_fn)
+            embedding_store.save(store_file)
+        else:
+            embed_matrix = encode_fn(texts)
 
         logger.info("Dataset embedded. Shape: {}".format(embed_matrix.shape))
 
@@ -83,10 +336,26 @@ class QueryLibrary:
             "embed_matrix": embed_matrix,
         }
         self.embeddings.append(embedding)
+        # the saved index folder no longer matches the library
+        self.index_dir = None
+        self.invalidate_search_index()
 
         logger.info("Embedding calculated with model {}".format(embedding_model_name))
         logger.info(" Embedding matrix shape: {}".format(embed_matrix.shape))
-        self.embedding_model = embedding_model
+        # the queries are encoded with the model of the first embedding (see build_search_index)
+        if embedding_model is not None and len(self.embeddings) == 1:
+            self.embedding_model = embedding_model
+
+    def __getstate__(self):
+        # the embedding model is stored by name only (see self.embeddings)
+        state = self.__dict__.copy()
+        state["embedding_model"] = None
+        state["first_pass_model"] = None
+        state["_warm_up_thread"] = None
+        # the search index is rebuilt at load time
+        state["_search_index"] = None
+        state["_search_index_key"] = None
+        return state
 
     def save(self, querylib_file):
         # Extract the directory part from the file path
@@ -100,15 +369,224 @@ class QueryLibrary:
         with open(querylib_file, "wb") as out_file:
             pickle.dump(self, out_file)
 
+    def save_index(self, index_dir):
+        """
+        Save the library as a versioned index folder: a manifest, the metadata as a parquet file
+        and one float32 .npy file per embedding matrix, which can be memory-mapped by load_index.
+
+        :param index_dir: Folder where the index is written
+        """
+        os.makedirs(index_dir, exist_ok=True)
+
+        df_metadata = self.df_querylib.reset_index(drop=True)
+        for col in df_metadata.columns[df_metadata.dtypes == object]:
+            if df_metadata[col].dropna().map(type).nunique() > 1:
+                logger.warning(f"Column {col} has mixed types, it is saved as string")
+                df_metadata[col] = df_metadata[col].astype(str)
+        df_metadata.to_parquet(os.path.join(index_dir, INDEX_METADATA_FILE), index=False)
+
+        embeddings_manifest = []
+        for idx, embedding in enumerate(self.embeddings):
+            embed_file = f"embed_matrix_{idx}.npy"
+            embed_matrix = np.ascontiguousarray(embedding["embed_matrix"], dtype=np.float32)
+            np.save(os.path.join(index_dir, embed_file), embed_matrix)
+            embeddings_manifest.append(
+                {
+                    "model_name": embedding["model_name"],
+                    "file": embed_file,
+                    "shape": list(embed_matrix.shape),
+                    "dtype": "float32",
+                    # read by load_index, so that loading does not read the whole matrix
+                    "rows_normalized": bool(
+                        np.allclose(row_norms(embed_matrix), 1.0, atol=1e-3)
+                    ),
+                }
+            )
+
+        manifest = {
+            "format_version": INDEX_FORMAT_VERSION,
+            "class": type(self).__name__,
+            "querylib_name": self.querylib_name,
+            "source": self.source,
+            "date_live": self.date_live.isoformat() if self.date_live else None,
+            "col_question": self.col_question,
+            "col_question_masked": self.col_question_masked,
+            "col_query_w_placeholders": self.col_query_w_placeholders,
+            "col_query_executable": self.col_query_executable,
+            "n_rows": len(df_metadata),
+            "metadata_file": INDEX_METADATA_FILE,
+            "embeddings": embeddings_manifest,
+            "encoder": {
+                "backend": getattr(self, "encoder_backend", "torch"),
+                "params": getattr(self, "encoder_params", {}),
+            },
+        }
+        if self.embeddings:
+            manifest["search_index"] = self.get_search_index().save(index_dir)
+        manifest.update(self._save_index_extra(index_dir))
+        # the manifest is written last so that an interrupted save is not picked up as valid
+        with open(os.path.join(index_dir, INDEX_MANIFEST_FILE), "w") as out_file:
+            json.dump(manifest, out_file, indent=2)
+
+        logger.info(f"Index of {len(df_metadata)} rows saved to {index_dir}")
+
+    def _save_index_extra(self, index_dir):
+        """Entries added to the manifest by subclasses"""
+        return {}
+
+    def _load_index_extra(self, index_dir, manifest):
+        """Restore the entries added to the manifest by _save_index_extra"""
+        pass
+
+    @staticmethod
+    def load_index(index_dir, mmap_mode="r"):
+        """
+        Load a library saved with save_index.
+
+        :param index_dir: Folder of the index
+        :param mmap_mode: Memory-map mode for the embedding matrices (None to read them in memory)
+        :return: QueryLibrary or MedCodingOnto, depending on the saved class
+        """
+        with open(os.path.join(index_dir, INDEX_MANIFEST_FILE), "r") as in_file:
+            manifest = json.load(in_file)
+
+        if manifest["format_version"] > INDEX_FORMAT_VERSION:
+            raise ValueError(
+                f"Index format version {manifest['format_version']} in {index_dir} is not "
+                f"supported (max: {INDEX_FORMAT_VERSION})"
+            )
+
+        index_classes = {
+            index_class.__name__: index_class
+            for index_class in [QueryLibrary] + QueryLibrary.__subclasses__()
+        }
+        querylib = index_classes[manifest["class"]].__new__(
+            index_classes[manifest["class"]]
+        )
+        querylib.querylib_name = manifest["querylib_name"]
+        querylib.source = manifest["source"]
+        querylib.date_live = (
+            date.fromisoformat(manifest["date_live"]) if manifest["date_live"] else None
+        )
+        querylib.col_question = manifest["col_question"]
+        querylib.col_question_masked = manifest["col_question_masked"]
+        querylib.col_query_w_placeholders = manifest["col_query_w_placeholders"]
+        querylib.col_query_executable = manifest["col_query_executable"]
+        querylib.df_querylib = pd.read_parquet(
+            os.path.join(index_dir, manifest["metadata_file"])
+        )
+        querylib.embeddings = [
+            {
+                "model_name": embedding["model_name"],
+                "embed_matrix": np.load(
+                    os.path.join(index_dir, embedding["file"]), mmap_mode=mmap_mode
+                ),
+            }
+            for embedding in manifest["embeddings"]
+        ]
+        querylib.embedding_model = None
+        querylib.first_pass_model = None
+        encoder = manifest.get("encoder", {"backend": "torch", "params": {}})
+        querylib.encoder_backend = encoder["backend"]
+        querylib.encoder_params = encoder["params"]
+        querylib.index_dir = os.path.abspath(index_dir)
+        querylib.invalidate_search_index()
+        querylib.search_backend = "exact"
+        querylib.search_params = {}
+        if "search_index" in manifest:
+            querylib.search_backend = manifest["search_index"]["backend"]
+            querylib.search_params = manifest["search_index"]["params"]
+            querylib._search_index = load_search_index(
+                index_dir,
+                manifest["search_index"],
+                querylib.embeddings[0]["embed_matrix"],
+                model_name=querylib.embeddings[0]["model_name"],
+                rows_normalized=manifest["embeddings"][0].get("rows_normalized", False),
+            )
+            querylib._search_index_key = querylib._get_search_index_key()
+        querylib._load_index_extra(index_dir, manifest)
+
+        logger.info(f"Index of {manifest['n_rows']} rows read from {index_dir}")
+        return querylib
+
     def load_embedding_model(self, embedding_model_name):
-        self.embedding_model = SentenceTransformer(embedding_model_name)
+        self.embedding_model = create_encoder(
+            embedding_model_name,
+            backend=getattr(self, "encoder_backend", "torch"),
+            **getattr(self, "encoder_params", {}),
+        )
+
+    def get_embedding_model(self):
+        """
+        :return: encoder of the queries, loaded at the first call (e.g. when all embeddings
+            were read from the embedding store or from an index folder)
+        """
+        with self._lazy_init_lock:
+            if self.embedding_model is None:
+                self.load_embedding_model(self.embeddings[0]["model_name"])
+            return self.embedding_model
+
+    def get_warm_up_steps(self):
+        """:return: list of (name, function) run by warm_up, in order"""
+        return [
+            ("encoder", self.get_embedding_model),
+            ("search_index", self.get_search_index),
+            ("first_pass_encoder", self.get_first_pass_model),
+        ]
+
+    def warm_up(self, background=True):
+        """
+        Load the query encoder and build the search index ahead of the first retrieval, e.g.
+        while the LLM masks the question. Retrievals started meanwhile wait for the loading
+        (see _lazy_init_lock) instead of loading a second copy.
+
+        :param background: True to run in a daemon thread, False to run in this thread
+        :return: the thread of the warm-up, None if not run in background
+        """
+        if not self.embeddings:
+            return None
+        if not background:
+            self._run_warm_up()
+            return None
+        self._warm_up_thread = threading.Thread(
+            target=self._run_warm_up, name=f"warm-up-{self.querylib_name}", daemon=True
+        )
+        self._warm_up_thread.start()
+        return self._warm_up_thread
+
+    def _run_warm_up(self):
+        self.warm_up_timings = {}
+        for name, step in self.get_warm_up_steps():
+            start = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                # the retrieval loads what is missing and reports the error
+                logger.warning(f"Warm-up of {self.querylib_name} failed at {name}: {e}")
+                return
+            self.warm_up_timings[name] = time.perf_counter() - start
+        logger.info(
+            f"{self.querylib_name} warmed up in {sum(self.warm_up_timings.values()):.1f} s"
+        )
+
+    def wait_warm_up(self, timeout=None):
+        """Wait for the warm-up started with warm_up(background=True), if any"""
+        thread = getattr(self, "_warm_up_thread", None)
+        if thread is not None:
+            thread.join(timeout)
 
     @staticmethod
     def load(querylib_file):
         try:
-            with open(querylib_file, "rb") as out_file:
-                query_lib_data = pickle.load(out_file)
-                logger.info("Query library data read from {}".format(querylib_file))
+            if os.path.isdir(querylib_file):
+                query_lib_data = QueryLibrary.load_index(querylib_file)
+            else:
+                with open(querylib_file, "rb") as out_file:
+                    query_lib_data = pickle.load(out_file)
+                    logger.info("Query library data read from {}".format(querylib_file))
+            # build the search index once at load time
+            if query_lib_data.embeddings:
+                query_lib_data.get_search_index()
             return query_lib_data
         except Exception as e:
             logger.exception("An error occured {}".format(e))
@@ -145,91 +623,321 @@ class QueryLibrary:
         self,
         samples,
         top_k=5,
-        sim_threshold=0.95,
+        sim_threshold=None,
         normalize_score=True,
         col_search=None,
         max_rows=1000,
         tmp_dir=None,
         export_txt=False,
+        return_arrays=False,
+        n_processes=None,
+        **search_filters,
     ):
+        """
+        :param samples: List of lists of strings, joined with a separator into one query each
+        :param top_k: Number of records retrieved per query
+        :param sim_threshold: Minimum similarity score (None: no threshold, the top_k records
+            are always returned)
+        :param normalize_score: True to normalise the query embeddings
+        :param col_search: Column of the input dataframe with the query text
+        :param max_rows: Number of queries encoded and scored together
+        :param tmp_dir: Deprecated and ignored, results are returned as compact arrays
+        :param n_processes: Number of worker processes scoring the queries (None: threads of
+            this process). The workers memory-map the index folder of a library loaded with
+            load_index and are kept for the next calls (see parallel_search); other libraries
+            and cascade indices on a smaller model are searched by threads
+        :param export_txt: True to keep the "Class" column in the per-query dataframes
+        :param return_arrays: True to return (positions of the records in df_querylib, scores)
+            arrays of shape (n_queries, top_k) instead of dataframes
+        :param search_filters: Restrictions of the search, see search_embeddings
+        :return: (df_recap_recs, df_recs_list), or (idx_records, scores) if return_arrays
+        """
+        if tmp_dir is not None:
+            warnings.warn(
+                "tmp_dir is ignored: get_similar_questions does not write temporary files "
+                "anymore, the argument will be removed",
+                DeprecationWarning,
+                stacklevel=2,
+            )
         if col_search is None:
             col_search = self.col_question
 
-        df_querylib_selected = self.df_querylib
+        self.get_embedding_model()
 
-        embed_matrix, names_avail = self.extract_embed_matrix(
-            value_rows_to_extract=df_querylib_selected[self.col_question].tolist(),
-            extract_col_name=self.col_question,
-            embedding=self.embeddings[0],
-        )
+        search_index = self.get_search_index()
 
-        # Cast the input samples in a dataframe for convenience
         samples_with_sep = self.add_separator_to_input_entities(samples)
-        df_input_names = pd.DataFrame(samples_with_sep, columns=[self.col_question])
+        # remove leading and trailing spaces
+        texts = [str(text).strip() for text in samples_with_sep]
 
-        df_input_names_list = [
-            df_input_names[i : i + max_rows]
-            for i in range(0, df_input_names.shape[0], max_rows)
-        ]
+        index_dir = getattr(self, "index_dir", None)
+        if n_processes is not None and n_processes > 1 and index_dir is None:
+            logger.warning(
+                f"{self.querylib_name} has no index folder, searched by threads: save it with "
+                "save_index and load it with load_index to search it with several processes"
+            )
+        if (
+            n_processes is not None
+            and n_processes > 1
+            and index_dir is not None
+            and getattr(search_index, "first_pass_model_name", None) is None
+        ):
+            # imported here: parallel_search depends on this module
+            from text2sql_epi.parallel_search import parallel_search
+
+            text_embeddings = self.encode_queries(texts)
+            if normalize_score:
+                text_embeddings = normalize(text_embeddings)
+            idx_records, scores = parallel_search(
+                self,
+                text_embeddings,
+                top_k=top_k,
+                sim_threshold=sim_threshold,
+                n_processes=n_processes,
+                max_rows=max_rows,
+                **search_filters,
+            )
+        else:
+            idx_records, scores = self._search_texts_threads(
+                texts,
+                top_k=top_k,
+                sim_threshold=sim_threshold,
+                normalize_score=normalize_score,
+                max_rows=max_rows,
+                search_index=search_index,
+                **search_filters,
+            )
 
-        df_recap_recs_list = []
-        df_recs_list = []
+        if return_arrays:
+            return idx_records, scores
 
-        outfile_recap_recs_list = []
-        outfile_recs_list = []
+        return self.recs_to_dataframes(
+            texts, idx_records, scores, col_search=col_search, export_txt=export_txt
+        )
+
+    def _search_texts_threads(
+        self,
+        texts,
+        top_k,
+        sim_threshold,
+        normalize_score,
+        max_rows,
+        search_index,
+        **search_filters,
+    ):
+        texts_chunks = [texts[i : i + max_rows] for i in range(0, len(texts), max_rows)]
+        if len(texts_chunks) == 1:
+            # e.g. a single question of the async pipeline: no thread pool needed
+            return self.search_texts(
+                texts_chunks[0],
+                top_k=top_k,
+                sim_threshold=sim_threshold,
+                normalize_score=normalize_score,
+                search_index=search_index,
+                **search_filters,
+            )
 
-        # Parallel processing for get_similar_names
+        idx_records_chunks = [None] * len(texts_chunks)
+        scores_chunks = [None] * len(texts_chunks)
+
+        # Parallel processing of the chunks
         with ThreadPoolExecutor() as executor:
             futures = {
                 executor.submit(
-                    self.get_similar_names,
-                    df_input_chunk,
-                    names_avail,
-                    embed_matrix=embed_matrix,
-                    embedding_model=self.embedding_model,
-                    col_search=col_search,
-                    normalize_score=normalize_score,
+                    self.search_texts,
+                    texts_chunk,
                     top_k=top_k,
                     sim_threshold=sim_threshold,
-                    export_txt=export_txt,
+                    normalize_score=normalize_score,
+                    search_index=search_index,
+                    **search_filters,
                 ): idx
-                for idx, df_input_chunk in enumerate(df_input_names_list)
+                for idx, texts_chunk in enumerate(texts_chunks)
             }
 
             for future in as_completed(futures):
                 idx = futures[future]
-                df_recap_recs, df_recs = future.result()
+                idx_records_chunks[idx], scores_chunks[idx] = future.result()
 
-                if tmp_dir is not None:
-                    outfile_recap_recs = os.path.join(tmp_dir, f"recap_recs_{idx}")
-                    outfile_recs = os.path.join(tmp_dir, f"recs_{idx}")
+        if texts_chunks:
+            idx_records = np.concatenate(idx_records_chunks)
+            scores = np.concatenate(scores_chunks)
+        else:
+            idx_records = np.empty((0, 0), dtype=np.int64)
+            scores = np.empty((0, 0), dtype=np.float32)
 
-                    with open(outfile_recap_recs, "wb") as out_file:
-                        pickle.dump(df_recap_recs, out_file)
+        return idx_records, scores
 
-                    with open(outfile_recs, "wb") as out_file:
-                        pickle.dump(df_recs, out_file)
+    def search_texts(
+        self,
+        texts,
+        top_k,
+        sim_threshold=None,
+        normalize_score=True,
+        search_index=None,
+        **search_filters,
+    ):
+        """
+        :param texts: List of query strings
+        :param top_k: Number of records retrieved per query
+        :param sim_threshold: Minimum similarity score (None: no threshold)
+        :param normalize_score: True to normalise the query embeddings
+        :param search_index: Search index (default: the index of the library)
+        :param search_filters: Restrictions of the search, see search_embeddings
+        :return: (positions of the records in df_querylib, scores), both of shape (n_queries, top_k)
+        """
+        text_embeddings = self.encode_queries(texts)
 
-                    outfile_recap_recs_list.append(outfile_recap_recs)
-                    outfile_recs_list.append(outfile_recs)
+        logger.debug(f"text_embedding shape: {text_embeddings.shape}")
 
-                    del df_recap_recs, df_recs
-                else:
-                    df_recap_recs_list.append(df_recap_recs)
-                    df_recs_list.extend(df_recs)
+        if normalize_score:
+            text_embeddings = normalize(text_embeddings)
 
-        if tmp_dir is not None:
-            df_recap_recs_list = []
-            for outfile_recap in outfile_recap_recs_list:
-                with open(outfile_recap, "rb") as out_file:
-                    df_recap_recs_list.append(pickle.load(out_file))
+        return self.search_embeddings(
+            text_embeddings,
+            top_k=top_k,
+            sim_threshold=sim_threshold,
+            search_index=search_index,
+            first_pass_embeddings=self.encode_first_pass_queries(texts, search_index),
+            **search_filters,
+        )
 
-            df_recs_list = []
-            for outfile_rec in outfile_recs_list:
-                with open(outfile_rec, "rb") as out_file:
-                    df_recs_list.extend(pickle.load(out_file))
+    def encode_queries(self, texts, embedding_model=None, model_name=None):
+        """
+        :param texts: List of query strings
+        :param embedding_model: Encoder (default: the model of the first embedding)
+        :param model_name: Name of the model of embedding_model
+        :return: normalised embeddings, read from the query embedding cache when possible
+        """
+        if embedding_model is None:
+            embedding_model = self.embedding_model
+            model_name = self.embeddings[0]["model_name"]
+        if self.query_embedding_cache is None:
+            return embedding_model.encode(texts, normalize_embeddings=True)
+        # vectors of different encoder backends are cached separately
+        return self.query_embedding_cache.encode(
+            embedding_model,
+            getattr(embedding_model, "name", model_name),
+            texts,
+            normalize_embeddings=True,
+        )
 
-        df_recap_recs = pd.concat(df_recap_recs_list)
+    def encode_first_pass_queries(self, texts, search_index=None):
+        """
+        :param texts: List of query strings
+        :param search_index: Search index (default: the index of the library)
+        :return: normalised embeddings of the first-pass model of a cascade index, None if the
+            index has no first-pass model
+        """
+        if search_index is None:
+            search_index = self.get_search_index()
+        first_pass_model = self.get_first_pass_model(search_index)
+        if first_pass_model is None:
+            return None
+        return normalize(
+            self.encode_queries(
+                texts,
+                embedding_model=first_pass_model,
+                model_name=search_index.first_pass_model_name,
+            )
+        )
+
+    def get_first_pass_model(self, search_index=None):
+        """
+        :param search_index: Search index (default: the index of the library)
+        :return: encoder of the first-pass model of a cascade index, loaded at the first call,
+            None if the index has no first-pass model
+        """
+        if search_index is None:
+            search_index = self.get_search_index()
+        first_pass_model_name = getattr(search_index, "first_pass_model_name", None)
+        if first_pass_model_name is None:
+            return None
+
+        with self._lazy_init_lock:
+            first_pass_model = getattr(self, "first_pass_model", None)
+            if (
+                first_pass_model is None
+                or getattr(first_pass_model, "model_name", None) != first_pass_model_name
+            ):
+                encoder_backend = getattr(self, "encoder_backend", "torch")
+                encoder_params = getattr(self, "encoder_params", {})
+                if encoder_backend == "remote":
+                    # the embedding server only encodes the model of the first embedding
+                    encoder_backend, encoder_params = "torch", {}
+                self.first_pass_model = create_encoder(
+                    first_pass_model_name,
+                    backend=encoder_backend,
+                    **{key: value for key, value in encoder_params.items() if key != "onnx_dir"},
+                )
+            return self.first_pass_model
+
+    def search_embeddings(
+        self,
+        text_embeddings,
+        top_k,
+        sim_threshold=None,
+        search_index=None,
+        first_pass_embeddings=None,
+    ):
+        """
+        :param text_embeddings: Normalised query embeddings, one row per query
+        :param top_k: Number of records retrieved per query
+        :param sim_threshold: Minimum similarity score (None: no threshold)
+        :param search_index: Search index (default: the index of the library)
+        :param first_pass_embeddings: Query embeddings of the first-pass model of a cascade
+            index (see encode_first_pass_queries)
+        :return: (positions of the records in df_querylib, scores), both of shape (n_queries, top_k)
+            Positions are -1 when less than top_k records are above sim_threshold
+        """
+        if search_index is None:
+            search_index = self.get_search_index()
+        return search_index.search(
+            text_embeddings,
+            top_k=top_k,
+            sim_threshold=sim_threshold,
+            **get_first_pass_kwargs(first_pass_embeddings),
+        )
+
+    def recs_to_dataframes(
+        self,
+        texts,
+        idx_records,
+        scores,
+        col_search=None,
+        suffix="unsupervised",
+        export_txt=False,
+    ):
+        """
+        Materialise the retrieved records as a recap dataframe (one row per query) and a list of
+        dataframes with the scores of the retrieved questions (one dataframe per query).
+        """
+        if col_search is None:
+            col_search = self.col_question
+
+        names = self.df_querylib[self.col_question].to_numpy()
+        # positions < 0 mark queries with less than top_k records found
+        is_found = idx_records >= 0
+        names_recs = [
+            names[idx_rec[found]] for idx_rec, found in zip(idx_records, is_found)
+        ]
+        scores = [scores_rec[found] for scores_rec, found in zip(scores, is_found)]
+
+        df_recap_recs = pd.DataFrame({col_search: texts})
+        df_recap_recs[f"rec_{suffix}_questions"] = [
+            names_rec.tolist() for names_rec in names_recs
+        ]
+        df_recap_recs[f"rec_{suffix}_scores"] = [
+            scores_rec.tolist() for scores_rec in scores
+        ]
+
+        df_recs_list = []
+        for names_rec, scores_rec in zip(names_recs, scores):
+            df_class_scores = pd.DataFrame({"Class": names_rec, "Score": scores_rec})
+            df_class_scores[self.col_question] = names_rec
+            if not export_txt:
+                df_class_scores = df_class_scores.drop(["Class"], axis=1)
+            df_recs_list.append(df_class_scores)
 
         return df_recap_recs, df_recs_list
 
@@ -247,8 +955,8 @@ class QueryLibrary:
         top_k_limit=None,
         export_txt=True,
     ):
-        if top_k_limit is None:
-            top_k_limit = len(classes)
+        if top_k_limit is not None:
+            top_k = min(top_k, top_k_limit)
 
         logger.debug("Retrieving the most similar classes")
 
@@ -257,80 +965,66 @@ class QueryLibrary:
 
         # Compute embeddings in batches (assuming embedding_model can handle batch input)
         text_embeddings = embedding_model.encode(
-            df[self.col_question].tolist(), normalize_embeddings=True
+            df[col_search].tolist(), normalize_embeddings=True
         )
 
-        logger.debug(f"Text embedding size: {text_embeddings.nbytes / 10 ** 6} (Mb)")
-        logger.debug(f"text_embedding shape: {text_embeddings.shape}")
-
         if normalize_score:
             text_embeddings = normalize(text_embeddings)
-            embed_matrix = normalize(embed_matrix)
-
-        # Efficient matrix multiplication
-        sim_matrix = text_embeddings @ embed_matrix.T
 
-        logger.debug(f"Similarity matrix size: {sim_matrix.nbytes / 10 ** 6} (Mb)")
-        logger.debug(f"sim_matrix shape: {sim_matrix.shape}")
+        # blocked search, no copy if embed_matrix is already normalised (e.g. the search index matrix)
+        idx_match, scores = EmbeddingIndex(embed_matrix).search(
+            text_embeddings, top_k=top_k, sim_threshold=sim_threshold
+        )
+        is_found = idx_match >= 0
+        classes = np.asarray(classes)
+        classes_match = [
+            classes[idx_rec[found]] for idx_rec, found in zip(idx_match, is_found)
+        ]
+        scores = [scores_rec[found] for scores_rec, found in zip(scores, is_found)]
 
-        # Efficient top-k selection
-        idx_match_sorted = np.argpartition(-sim_matrix, kth=top_k_limit - 1, axis=1)[
-            :, :top_k_limit
+        df[f"rec_{suffix}_questions"] = [
+            classes_rec.tolist() for classes_rec in classes_match
         ]
+        df[f"rec_{suffix}_scores"] = [scores_rec.tolist() for scores_rec in scores]
 
-        matched_classes_list = []
-        scores_list = []
-        code_list = []
         df_class_score_list = []
-
-        for idx_input in range(sim_matrix.shape[0]):
-            idx_match_input = idx_match_sorted[idx_input]
-            sim_matrix_row_sorted = -np.partition(
-                -sim_matrix[idx_input], kth=top_k_limit - 1
-            )[:top_k_limit]
-            class_text_sorted = classes[idx_match_input]
-
-            df_class_scores = pd.DataFrame(
-                zip(class_text_sorted, sim_matrix_row_sorted),
-                columns=["Class", "Score"],
-            )
-            df_class_scores = df_class_scores.nlargest(top_k, "Score")
-
-            matched_classes_list.append(df_class_scores["Class"].tolist())
-            scores_list.append(df_class_scores["Score"].tolist())
-
-            df_class_scores[self.col_question] = df_class_scores["Class"]
-            code_list.append(df_class_scores[self.col_question].tolist())
-
+        for classes_rec, scores_rec in zip(classes_match, scores):
+            df_class_scores = pd.DataFrame({"Class": classes_rec, "Score": scores_rec})
+            df_class_scores[self.col_question] = classes_rec
             if not export_txt:
-                df_class_scores = df_class_scores.drop(
-                    ["Class"], axis=1, errors="ignore"
-                )
-
+                df_class_scores = df_class_scores.drop(["Class"], axis=1)
             df_class_score_list.append(df_class_scores)
 
-        df[f"rec_{suffix}_questions"] = code_list
-        df[f"rec_{suffix}_scores"] = scores_list
-
         return df, df_class_score_list
 
-    def get_df_recs(self, question, top_k, sim_threshold):
-        df_recap_recs, df_recs_list = self.get_similar_questions(
+    def get_df_recs(self, question, top_k, sim_threshold, **search_filters):
+        idx_records, scores = self.get_similar_questions(
             question,
             top_k=top_k,
             sim_threshold=sim_threshold,
+            return_arrays=True,
+            **search_filters,
         )
 
-        # here the list is only one element long because we pass only one question
-        df_recs_list_merged = []
-        for df_recs in df_recs_list:
-            df_merged = df_recs.merge(self.df_querylib, on=self.col_question, how="left")
-            df_recs_list_merged.append(df_merged)
+        # here we only have one question
+        return self.get_df_recs_from_arrays(idx_records[0], scores[0])
 
-        # here we only have one question thus the list is always one element
-        # TO DO: this is not ideal and it should be improve later
-        df_recs_list_out = df_recs_list_merged[0]
-        return df_recs_list_out
+    def get_df_recs_from_arrays(self, idx_records_row, scores_row):
+        """
+        :param idx_records_row: Positions of the records retrieved for one query (-1: none)
+        :param scores_row: Scores of the records retrieved for one query
+        :return: dataframe of the retrieved records, with their score in the first column
+        """
+        # join the records by position in the library
+        is_found = idx_records_row >= 0
+        df_recs_list_out = self.df_querylib.iloc[idx_records_row[is_found]].reset_index(
+            drop=True
+        )
+        df_recs_list_out.insert(0, "Score", scores_row[is_found])
+        cols_out = ["Score", self.col_question] + [
+            col for col in self.df_querylib.columns if col != self.col_question
+        ]
+        return df_recs_list_out[cols_out]
 
     async def text_sql_template_for_rag(
         self,
@@ -342,7 +1036,9 @@ class QueryLibrary:
         rag_random=False,  # Parameter for random retrieval
         drop_first=False,  # Parameter to drop the first element
     ):
-        df_recs_list_out = self.get_df_recs(
+        # encoding and search run on the retrieval executor, not on the event loop
+        df_recs_list_out = await self.retrieval_executor.run(
+            self.get_df_recs,
             [[question_masked]],
             top_k=top_k_screening,
             sim_threshold=sim_threshold,
@@ -383,7 +1079,6 @@ class QueryLibrary:
         prompts,
         question,
         assistant,
-        sleep_sec=3,
         reset_conversation=True,
         mask="DRUG_CLASS",
     ):
@@ -391,7 +1086,6 @@ class QueryLibrary:
         :param prompts: List of prompts
         :param question: User question
         :param assistant: Assistant to use
-        :param sleep_sec: Number of seconds to sleep
         :param reset_conversation: True or False to reset the conversation
         :param mask: Mask to apply
         :return: masked question, question
@@ -414,11 +1108,13 @@ class QueryLibrary:
             masked_question = await assistant.get_response(prompt)
 
         logger.info(f"Masked question: {masked_question}")
-        time.sleep(sleep_sec)
         return masked_question, question
 
 
 class MedCodingOnto(QueryLibrary):
+    # guards the lexical and dense answer counters, updated by the retrieval threads
+    _stats_lock = threading.Lock()
+
     def __init__(
         self,
         ontolib_name: str,
@@ -426,8 +1122,15 @@ class MedCodingOnto(QueryLibrary):
         ontolib_source_file: object,
         col_text: str,
         date_live: Optional[date] = None,
-        # Add any additional parameters specific to your new class here
+        col_domain: Optional[str] = "DOMAIN_ID",
+        col_vocabulary: Optional[str] = "VOCABULARY_ID",
+        lexical_min_score: Optional[float] = LEXICAL_MIN_SCORE,
     ) -> None:
+        """
+        :param lexical_min_score: Trigram similarity above which a name is answered by the
+            lexical index without dense search (exact matches always are), None to always
+            use the dense search
+        """
         super().__init__(
             querylib_name=ontolib_name,
             source=source,
@@ -438,39 +1141,409 @@ class MedCodingOnto(QueryLibrary):
             col_query_w_placeholders=None,
             col_query_executable=None
         )
-        self.querylib_name = ontolib_name
-        self.date_live = date_live
-        self.source = source
-        self.col_question = col_text
-        self.col_question_masked = col_text
-        self.col_query_w_placeholders = None
-        self.col_query_executable = None
+        self.col_domain = col_domain
+        self.col_vocabulary = col_vocabulary
+        self.lexical_min_score = lexical_min_score
+        self._partition_indices = None
+        self._lexical_index = None
+        self._lexical_index_key = None
+        self.n_lexical_answers = 0
+        self.n_dense_answers = 0
+
+        if self.has_partitions():
+            # concepts of the same domain and vocabulary are stored next to each other, so that
+            # each partition of the embedding matrix is a contiguous slice (no copy)
+            self.df_querylib = self.df_querylib.sort_values(
+                [col_domain, col_vocabulary], kind="stable"
+            ).reset_index(drop=True)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_partition_indices"] = None
+        state["_fingerprint"] = None
+        state["_lexical_index"] = None
+        state["_lexical_index_key"] = None
+        return state
+
+    def has_partitions(self):
+        col_domain = getattr(self, "col_domain", None)
+        col_vocabulary = getattr(self, "col_vocabulary", None)
+        return (
+            col_domain in self.df_querylib.columns
+            and col_vocabulary in self.df_querylib.columns
+        )
 
-        if ontolib_source_file:
-            df_querylib = pd.read_excel(ontolib_source_file)
-            self.df_querylib = df_querylib
-        else:
-            self.df_querylib = pd.DataFrame()
+    def get_partitions(self):
+        """
+        :return: dict mapping (domain_id, vocabulary_id) to the positions of its concepts
+        """
+        if not self.has_partitions():
+            return {}
+        return {
+            (str(domain_id), str(vocabulary_id)): rows
+            for (domain_id, vocabulary_id), rows in self.df_querylib.groupby(
+                [self.col_domain, self.col_vocabulary], sort=False
+            ).indices.items()
+        }
 
-        self.embeddings = []
+    def build_search_index(self, backend="exact", **params):
+        """
+        Build the search index of the whole ontology, of which each (domain_id, vocabulary_id)
+        partition is a view (see get_partition_indices).
+        """
+        search_index = super().build_search_index(backend=backend, **params)
+        self._partition_indices = None
+        return search_index
 
-        self.embedding_model = None
-        # Add any additional initialization specific to your new class here
+    def create_partition_indices(self, search_index):
+        """
+        :return: dict mapping (domain_id, vocabulary_id) to the search index of its concepts. The
+            concepts are sorted by partition, so each index is a view of the rows of its
+            partition in search_index, sharing its matrix, graph or codes
+        """
+        partition_indices = {}
+        for partition, rows in self.get_partitions().items():
+            if rows[-1] - rows[0] + 1 == len(rows):
+                partition_indices[partition] = search_index.get_row_range(rows[0], rows[-1] + 1)
+            else:
+                # df_querylib was replaced by unsorted concepts: exact search of a copy
+                logger.warning(
+                    f"The concepts of partition {partition} are not contiguous, they are searched "
+                    "exactly"
+                )
+                partition_indices[partition] = EmbeddingIndex(
+                    search_index.embed_matrix[rows],
+                    idx_records=search_index.idx_records[rows],
+                    model_name=search_index.model_name,
+                    rows_normalized=True,
+                )
+        logger.info(f"Search index views created for {len(partition_indices)} partitions")
+        return partition_indices
+
+    def get_fingerprint(self):
+        """
+        Fingerprint of the ontology content, embeddings and search settings, used to invalidate
+        caches of retrieved concepts (see ConceptResolutionCache)
+        """
+        search_settings = json.dumps(
+            [
+                getattr(self, "search_backend", "exact"),
+                getattr(self, "search_params", {}),
+                getattr(self, "lexical_min_score", None),
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        key = (self._get_search_index_key(), search_settings)
+        fingerprint = getattr(self, "_fingerprint", None)
+        if fingerprint is not None and fingerprint[0] == key:
+            return fingerprint[1]
+
+        embed_matrix = self.embeddings[0]["embed_matrix"]
+        hasher = hashlib.sha1()
+        hasher.update(str(self.embeddings[0]["model_name"]).encode("utf-8"))
+        hasher.update(str(embed_matrix.shape).encode("utf-8"))
+        hasher.update(search_settings.encode("utf-8"))
+        hasher.update(
+            pd.util.hash_pandas_object(self.df_querylib.astype(str), index=False).values.tobytes()
+        )
+        # a sample of rows is enough to tell embeddings of different runs apart
+        step = max(1, embed_matrix.shape[0] // 1000)
+        hasher.update(np.ascontiguousarray(embed_matrix[::step]).tobytes())
+
+        self._fingerprint = (key, hasher.hexdigest())
+        return self._fingerprint[1]
+
+    def get_lexical_index(self):
+        """
+        Return the lexical index of the concept names, building it if the ontology changed.
+        """
+        with self._lazy_init_lock:
+            key = (id(self.df_querylib), len(self.df_querylib))
+            if getattr(self, "_lexical_index", None) is None or self._lexical_index_key != key:
+                start = time.time()
+                self._lexical_index = LexicalIndex(
+                    self.df_querylib[self.col_question].tolist(),
+                    domain_ids=(
+                        self.df_querylib[self.col_domain] if self.has_partitions() else None
+                    ),
+                    vocabulary_ids=(
+                        self.df_querylib[self.col_vocabulary] if self.has_partitions() else None
+                    ),
+                )
+                self._lexical_index_key = key
+                logger.info(
+                    f"Lexical index of {len(self._lexical_index)} concept names built in "
+                    f"{time.time() - start:.1f} s"
+                )
+            return self._lexical_index
+
+    def lexical_lookup(self, name, top_k, domain_id=None, vocabularies=None):
+        """
+        :return: (positions of the concepts, scores, True if the name matches a concept name
+            exactly), None if there is no confident match. A name matching a concept name
+            exactly gets its exact matches followed by its nearest trigram neighbours, up to
+            top_k; otherwise only the concepts with a trigram similarity above
+            lexical_min_score are returned
+        """
+        lexical_min_score = getattr(self, "lexical_min_score", None)
+        if lexical_min_score is None:
+            return None
+        idx_records, scores, is_exact = self.get_lexical_index().lookup(
+            name, top_k, domain_id=domain_id, vocabularies=vocabularies
+        )
+        if is_exact:
+            return idx_records, scores, True
+        # weaker trigram neighbours are left to the dense search, which ranks synonyms better
+        is_confident = scores >= min(lexical_min_score, 1.0)
+        if is_confident.any():
+            return idx_records[is_confident], scores[is_confident], False
+        return None
+
+    def get_warm_up_steps(self):
+        steps = super().get_warm_up_steps()
+        if getattr(self, "lexical_min_score", None) is not None:
+            steps.append(("lexical_index", self.get_lexical_index))
+        return steps
+
+    def get_lexical_stats(self):
+        with self._stats_lock:
+            n_lexical = getattr(self, "n_lexical_answers", 0)
+            n_dense = getattr(self, "n_dense_answers", 0)
+        return {
+            "lexical": n_lexical,
+            "dense": n_dense,
+            "lexical_rate": n_lexical / (n_lexical + n_dense) if n_lexical + n_dense else 0.0,
+        }
+
+    def get_partition_indices(self, domain_id=None, vocabularies=None):
+        """
+        :param domain_id: OMOP domain of the concepts (e.g. "Condition"), None for all domains
+        :param vocabularies: List of OMOP vocabularies (e.g. ["SNOMED"]), None for all vocabularies
+        :return: search indices of the matching partitions
+        """
+        search_index = self.get_search_index()
+        with self._lazy_init_lock:
+            partition_indices = getattr(self, "_partition_indices", None)
+            if partition_indices is None:
+                partition_indices = self.create_partition_indices(search_index)
+                self._partition_indices = partition_indices
+        return [
+            partition_index
+            for (partition_domain, partition_vocabulary), partition_index in (
+                partition_indices.items()
+            )
+            if (domain_id is None or partition_domain == domain_id)
+            and (vocabularies is None or partition_vocabulary in vocabularies)
+        ]
+
+    def search_embeddings(
+        self,
+        text_embeddings,
+        top_k,
+        sim_threshold=None,
+        search_index=None,
+        first_pass_embeddings=None,
+        domain_id=None,
+        vocabularies=None,
+    ):
+        """
+        :param text_embeddings: Normalised query embeddings, one row per query
+        :param top_k: Number of concepts retrieved per query
+        :param sim_threshold: Minimum similarity score (None: no threshold)
+        :param search_index: Search index (default: the index of the whole ontology)
+        :param first_pass_embeddings: Query embeddings of the first-pass model of a cascade
+            index (see encode_first_pass_queries)
+        :param domain_id: Only search the concepts of this OMOP domain (e.g. "Drug")
+        :param vocabularies: Only search the concepts of these OMOP vocabularies (e.g. ["RxNorm"])
+        :return: (positions of the concepts in df_querylib, scores), both of shape (n_queries, top_k)
+        """
+        if (domain_id is None and vocabularies is None) or not self.has_partitions():
+            return super().search_embeddings(
+                text_embeddings,
+                top_k=top_k,
+                sim_threshold=sim_threshold,
+                search_index=search_index,
+                first_pass_embeddings=first_pass_embeddings,
+            )
+
+        results = [
+            partition_index.search(
+                text_embeddings,
+                top_k=top_k,
+                sim_threshold=sim_threshold,
+                **get_first_pass_kwargs(first_pass_embeddings),
+            )
+            for partition_index in self.get_partition_indices(domain_id, vocabularies)
+        ]
+        n_queries = np.asarray(text_embeddings).shape[0]
+        if not results:
+            logger.warning(
+                f"No concepts for domain {domain_id} and vocabularies {vocabularies}"
+            )
+            return np.empty((n_queries, 0), dtype=np.int64), np.empty(
+                (n_queries, 0), dtype=np.float32
+            )
+
+        # merge the top_k of each partition
+        idx_records = np.concatenate([idx for idx, _ in results], axis=1)
+        scores = np.concatenate([scores for _, scores in results], axis=1)
+        scores = np.where(idx_records >= 0, scores, -np.inf)
+        idx_top, scores_top = top_k_similar(scores, top_k)
+        idx_records = np.take_along_axis(idx_records, idx_top, axis=1)
+        return np.where(np.isfinite(scores_top), idx_records, -1), scores_top
+
+    def _save_index_extra(self, index_dir):
+        # the partition indices are views of the saved search index: nothing to save
+        return {
+            "col_domain": self.col_domain,
+            "col_vocabulary": self.col_vocabulary,
+            "lexical_min_score": getattr(self, "lexical_min_score", None),
+        }
+
+    def _load_index_extra(self, index_dir, manifest):
+        self.col_domain = manifest.get("col_domain")
+        self.col_vocabulary = manifest.get("col_vocabulary")
+        self.lexical_min_score = manifest.get("lexical_min_score", LEXICAL_MIN_SCORE)
+        self._lexical_index = None
+        self._lexical_index_key = None
+        self.n_lexical_answers = 0
+        self.n_dense_answers = 0
+        # the views of the loaded search index are created at the first filtered search
+        self._partition_indices = None
 
     async def get_similar_codes_from_onto(
             self,
             question_masked,
             top_k_screening,
             top_k_prompt,
-            sim_threshold
+            sim_threshold,
+            domain_id=None,
+            vocabularies=None,
     ):
-        df_recs_list_out = self.get_df_recs(
-            [[question_masked]],
-            top_k=top_k_screening,
+        """
+        :param question_masked: Name of the medical entity
+        :param top_k_screening: Number of concepts retrieved
+        :param top_k_prompt: Number of concepts returned
+        :param sim_threshold: Minimum similarity score
+        :param domain_id: Only search the concepts of this OMOP domain (e.g. "Condition")
+        :param vocabularies: Only search the concepts of these OMOP vocabularies (e.g. ["SNOMED"])
+        """
+        # lexical lookup, encoding and search run on the retrieval executor, not on the event loop
+        df_recs_list_out = await self.retrieval_executor.run(
+            self.resolve_concepts,
+            [(question_masked, domain_id, vocabularies)],
+            top_k_screening=top_k_screening,
+            top_k_prompt=top_k_prompt,
             sim_threshold=sim_threshold,
         )
 
-        # Keep only the top_k_prompt elements
-        df_recs_list_out = df_recs_list_out.head(top_k_prompt)
+        return df_recs_list_out[0]
+
+    def resolve_concepts(self, concept_requests, top_k_screening, top_k_prompt, sim_threshold):
+        """
+        Retrieve the concepts of several medical entities at once.
+
+        Names matching a concept name exactly, or nearly matching at least top_k_prompt concept
+        names (see lexical_lookup), are answered by the lexical index without encoding them. The
+        other names are de-duplicated and encoded in one batch, then the requests sharing a
+        domain and vocabularies are scored together; their lexical matches come first and the
+        dense results fill the remaining rows.
+
+        :param concept_requests: List of (name, domain_id, vocabularies) tuples, where domain_id
+            and vocabularies can be None (see get_similar_codes_from_onto)
+        :param top_k_screening: Number of concepts retrieved per name
+        :param top_k_prompt: Number of concepts returned per name
+        :param sim_threshold: Minimum similarity score of the dense search (the lexical matches
+            are selected with lexical_min_score)
+        :return: list of the dataframes of concepts, one per request (identical requests
+            share the same dataframe)
+        """
+        request_keys = [
+            (name, domain_id, tuple(vocabularies) if vocabularies is not None else None)
+            for name, domain_id, vocabularies in concept_requests
+        ]
+        concept_keys = list(dict.fromkeys(request_keys))
+
+        concepts = {}
+        lexical_matches = {}
+        for key in concept_keys:
+            result = self.lexical_lookup(
+                key[0],
+                top_k_prompt,
+                domain_id=key[1],
+                vocabularies=list(key[2]) if key[2] is not None else None,
+            )
+            if result is None:
+                continue
+            idx_records_row, scores_row, is_exact = result
+            if is_exact or len(idx_records_row) >= top_k_prompt:
+                concepts[key] = self.get_df_recs_from_arrays(idx_records_row, scores_row)
+            else:
+                lexical_matches[key] = idx_records_row, scores_row
+        n_lexical = len(concepts)
+        concept_keys = [key for key in concept_keys if key not in concepts]
+        with self._stats_lock:
+            self.n_lexical_answers = getattr(self, "n_lexical_answers", 0) + n_lexical
+            self.n_dense_answers = getattr(self, "n_dense_answers", 0) + len(concept_keys)
+        if not concept_keys:
+            return [concepts[key] for key in request_keys]
+
+        self.get_embedding_model()
+
+        names = list(dict.fromkeys(key[0] for key in concept_keys))
+        # a single entity per query: no separator to add (see get_similar_questions)
+        texts = [str(name).strip() for name in names]
+        text_embeddings = normalize(self.encode_queries(texts))
+        first_pass_embeddings = self.encode_first_pass_queries(texts)
+        row_by_name = {name: row for row, name in enumerate(names)}
+
+        keys_by_filter = {}
+        for key in concept_keys:
+            keys_by_filter.setdefault(key[1:], []).append(key)
+
+        for (domain_id, vocabularies), keys in keys_by_filter.items():
+            rows = [row_by_name[key[0]] for key in keys]
+            idx_records, scores = self.search_embeddings(
+                text_embeddings[rows],
+                top_k=top_k_screening,
+                sim_threshold=sim_threshold,
+                first_pass_embeddings=(
+                    first_pass_embeddings[rows] if first_pass_embeddings is not None else None
+                ),
+                domain_id=domain_id,
+                vocabularies=list(vocabularies) if vocabularies is not None else None,
+            )
+            for key, idx_records_row, scores_row in zip(keys, idx_records, scores):
+                if key in lexical_matches:
+                    idx_lexical, scores_lexical = lexical_matches[key]
+                    is_new = ~np.isin(idx_records_row, idx_lexical)
+                    idx_records_row = np.concatenate([idx_lexical, idx_records_row[is_new]])
+                    scores_row = np.concatenate([scores_lexical, scores_row[is_new]])
+                concepts[key] = self.get_df_recs_from_arrays(idx_records_row, scores_row).head(
+                    top_k_prompt
+                )
+
+        logger.info(
+            f"{len(concept_requests)} concept requests resolved with {len(names)} encoded names "
+            f"and {len(keys_by_filter)} searches, {n_lexical} by the lexical index"
+        )
+        return [concepts[key] for key in request_keys]
 
-        return df_recs_list_out
+    async def get_similar_codes_batch(
+            self,
+            concept_requests,
+            top_k_screening,
+            top_k_prompt,
+            sim_threshold,
+    ):
+        """
+        Async version of resolve_concepts, run on the retrieval executor.
+        """
+        return await self.retrieval_executor.run(
+            self.resolve_concepts,
+            concept_requests,
+            top_k_screening=top_k_screening,
+            top_k_prompt=top_k_prompt,
+            sim_threshold=sim_threshold,
+        )
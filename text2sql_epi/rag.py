@@ -1,11 +1,12 @@
 import glob
 import os
 import sys
+import time
 from datetime import datetime
 import logging
 
 from text2sql_epi import prompts
-from text2sql_epi.assistants import create_assistant
+from text2sql_epi.assistants import create_assistant, create_openai_client
 from text2sql_epi.query_library import QueryLibrary
 
 logger = logging.getLogger(__name__)
@@ -14,7 +15,21 @@ logger = logging.getLogger(__name__)
 class Rag:
     querylib = None
 
-    def __init__(self, main_path=None, log_folder=None, querylib_file=None):
+    def __init__(
+        self,
+        main_path=None,
+        log_folder=None,
+        querylib_file=None,
+        embedding_server_url=None,
+        warm_up=True,
+    ):
+        """
+        :param embedding_server_url: URL of a shared embedding server (see
+            text2sql_epi.embedding_server), None to load the embedding model in this process
+        :param warm_up: True to load the embedding model and the search index in a background
+            thread, so that the loading overlaps the first LLM call; False to load them at the
+            first retrieval
+        """
         # Set default main_path if not provided
         self.main_path = main_path if main_path is not None else os.getcwd()
         sys.path.append(self.main_path)
@@ -30,8 +45,14 @@ class Rag:
             # Use the provided querylib_file
             self.querylib_file = querylib_file
         else:
-            # Get a list of all files that match the pattern 'querylib_*.pkl'
-            querylib_files = glob.glob(os.path.join(self.main_path, "querylib_*.pkl"))
+            # Get a list of all pickle files 'querylib_*.pkl' and index folders 'querylib_*'
+            querylib_files = glob.glob(
+                os.path.join(self.main_path, "querylib_*.pkl")
+            ) + glob.glob(os.path.join(self.main_path, "querylib_*", "manifest.json"))
+            querylib_files = [
+                os.path.dirname(filename) if filename.endswith("manifest.json") else filename
+                for filename in querylib_files
+            ]
             # Extract dates from the filenames and sort them
             querylib_files.sort(
                 key=lambda filename: datetime.strptime(
@@ -42,14 +63,20 @@ class Rag:
             # Pick the most recent file if any are found
             self.querylib_file = querylib_files[0] if querylib_files else None
 
-        self.sleep_sec = 2
         self.assistant_type = "gpt4turbo"
         self.top_k_prompt = 2
         self.top_k_screening = 10
         self.sim_threshold = 0.0
 
+        self.embedding_server_url = embedding_server_url
+
+        self.startup_timings = {}
         if Rag.querylib is None:
+            start = time.perf_counter()
             Rag.querylib = self.load_querylib()
+            self.startup_timings["querylib"] = time.perf_counter() - start
+            if warm_up:
+                Rag.querylib.warm_up(background=True)
 
     def load_querylib(self):
         # Assuming QueryLibrary is a class defined elsewhere
@@ -64,14 +91,26 @@ class Rag:
         )
 
         querylib = querylib.load(querylib_file=self.querylib_file)
+        if self.embedding_server_url is not None:
+            querylib.encoder_backend = "remote"
+            querylib.encoder_params = {"url": self.embedding_server_url}
 
-        # Assuming an embedding model and logger are defined elsewhere
-        querylib.load_embedding_model(embedding_model_name="BAAI/bge-large-en-v1.5")
-
+        # the embedding model is loaded by the warm-up or at the first retrieval
         logging.info(f"Embedding loaded from {self.querylib_file}")
 
         return querylib
 
+    def get_startup_report(self):
+        """
+        :return: dict of the startup steps and their duration in seconds; the warm-up steps are
+            None while they are running
+        """
+        report = dict(self.startup_timings)
+        warm_up_timings = getattr(Rag.querylib, "warm_up_timings", {})
+        for name, _ in Rag.querylib.get_warm_up_steps():
+            report[name] = warm_up_timings.get(name)
+        return report
+
 
 class AgentRag(Rag):
     def __init__(self, **kwargs):
@@ -79,9 +118,10 @@ class AgentRag(Rag):
             main_path=kwargs.get("main_path"),
             log_folder=kwargs.get("log_folder"),
             querylib_file=kwargs.get("querylib_file"),
+            embedding_server_url=kwargs.get("embedding_server_url"),
+            warm_up=kwargs.get("warm_up", True),
         )
         # Override specific properties for AgentRag
-        self.sleep_sec = 2
         self.top_k_prompt = 2
         self.top_k_screening = 10
         self.sim_threshold = 0.0
@@ -91,9 +131,22 @@ class AgentRag(Rag):
 
         # Create new instances for the assistant and med_sql_processor
         self.database = kwargs.get("database")
-        self.assistant = kwargs.get(
-            "assistant", create_assistant(assistant_type=self.assistant_type)
-        )
-        self.assistant_answers = kwargs.get(
-            "assistant_answers", create_assistant(assistant_type=self.assistant_type)
+        # the assistants are only created when they are not given
+        # LLMResponseCache shared by the assistants (None: every prompt is sent to the LLM)
+        self.llm_cache = kwargs.get("llm_cache")
+        # DeploymentPool routing the calls of the assistants (None: one deployment)
+        self.deployment_pool = kwargs.get("deployment_pool")
+        assistant_kwargs = {
+            "assistant_type": self.assistant_type,
+            "response_cache": self.llm_cache,
+            "deployment_pool": self.deployment_pool,
+        }
+        if self.deployment_pool is None and not (
+            kwargs.get("assistant") and kwargs.get("assistant_answers")
+        ):
+            # the two assistants share one connection pool
+            assistant_kwargs["client"] = create_openai_client()
+        self.assistant = kwargs.get("assistant") or create_assistant(**assistant_kwargs)
+        self.assistant_answers = kwargs.get("assistant_answers") or create_assistant(
+            **assistant_kwargs
         )
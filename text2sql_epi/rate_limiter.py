@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets of one LLM deployment, shared by all the
+    assistants calling it.
+
+    The budgets are token buckets refilled continuously and holding at most burst_sec seconds of
+    budget, since the quotas are also enforced over short windows. Callers wait in FIFO order; a
+    throttled (429) response pauses all the callers of the deployment.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        burst_sec=10,
+        clock=time.monotonic,
+        sleep=asyncio.sleep,
+    ) -> None:
+        """
+        :param requests_per_minute: Request budget (None: unlimited)
+        :param tokens_per_minute: Token budget, prompt and max_tokens of the response (None:
+            unlimited)
+        :param burst_sec: Seconds of budget that can be spent at once
+        :param clock: Function returning the current time in seconds
+        :param sleep: Coroutine function waiting for a number of seconds, consistent with clock
+        """
+        self.clock = clock
+        self.sleep = sleep
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_sec = burst_sec
+        self.max_requests = (
+            max(requests_per_minute * burst_sec / 60, 1) if requests_per_minute else None
+        )
+        self.max_tokens = tokens_per_minute * burst_sec / 60 if tokens_per_minute else None
+        self._requests = self.max_requests
+        self._tokens = self.max_tokens
+        self._updated = self.clock()
+        self._paused_until = 0.0
+        self._lock = None
+        self._lock_loop = None
+        # callers waiting in acquire, whose requests are not spent yet
+        self._n_waiting = 0
+        self._waiting_tokens = 0
+        self.n_requests = 0
+        self.n_tokens = 0
+        self.n_throttled = 0
+        self.wait_sec = 0.0
+
+    def _get_lock(self):
+        # an asyncio.Lock is bound to its event loop: one per asyncio.run
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.max_requests is not None:
+            self._requests = min(
+                self.max_requests, self._requests + elapsed * self.requests_per_minute / 60
+            )
+        if self.max_tokens is not None:
+            self._tokens = min(self.max_tokens, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def get_delay(self, n_tokens, now, n_requests=1):
+        """:return: seconds until the budgets allow n_requests requests of n_tokens in total"""
+        delay = max(self._paused_until - now, 0.0)
+        if self.max_requests is not None and self._requests < n_requests:
+            delay = max(delay, (n_requests - self._requests) * 60 / self.requests_per_minute)
+        if self.max_tokens is not None:
+            # a request larger than the bucket waits for a full bucket
+            n_tokens = min(n_tokens, self.max_tokens * n_requests)
+            if self._tokens < n_tokens:
+                delay = max(delay, (n_tokens - self._tokens) * 60 / self.tokens_per_minute)
+        return delay
+
+    def get_expected_wait(self, n_tokens=0):
+        """
+        :param n_tokens: Estimated tokens of a new request
+        :return: seconds a new request would wait in acquire, behind the callers already
+            waiting (the budgets are not spent)
+        """
+        now = self.clock()
+        self._refill(now)
+        return self.get_delay(
+            n_tokens + self._waiting_tokens, now, n_requests=self._n_waiting + 1
+        )
+
+    async def acquire(self, n_tokens=0):
+        """
+        Wait until the budgets allow a request, in FIFO order, and spend them
+
+        :param n_tokens: Estimated tokens of the request (prompt and max_tokens of the response)
+        """
+        start = self.clock()
+        self._n_waiting += 1
+        self._waiting_tokens += n_tokens
+        try:
+            async with self._get_lock():
+                while True:
+                    now = self.clock()
+                    self._refill(now)
+                    delay = self.get_delay(n_tokens, now)
+                    if delay <= 0:
+                        break
+                    await self.sleep(delay)
+                if self.max_requests is not None:
+                    self._requests -= 1
+                if self.max_tokens is not None:
+                    self._tokens -= min(n_tokens, self.max_tokens)
+        finally:
+            self._n_waiting -= 1
+            self._waiting_tokens -= n_tokens
+        self.n_requests += 1
+        self.n_tokens += n_tokens
+        self.wait_sec += self.clock() - start
+
+    def on_throttled(self, retry_after_sec):
+        """
+        Pause all the callers after a throttled response
+
+        :param retry_after_sec: Delay before the next request
+        """
+        now = self.clock()
+        self.n_throttled += 1
+        self._refill(now)
+        self._paused_until = max(self._paused_until, now + retry_after_sec)
+        # the budgets were overestimated: restart from empty buckets after the pause
+        if self.max_requests is not None:
+            self._requests = min(self._requests, 0)
+        if self.max_tokens is not None:
+            self._tokens = min(self._tokens, 0)
+
+    def get_stats(self):
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "requests": self.n_requests,
+            "tokens": self.n_tokens,
+            "throttled": self.n_throttled,
+            "waiting": self._n_waiting,
+            "wait_sec": self.wait_sec,
+        }
+
+
+# one limiter per deployment, shared by all the assistants of the process
+rate_limiters = {}
+
+
+def get_rate_limiter(name, requests_per_minute=None, tokens_per_minute=None, **kwargs):
+    """
+    :param name: Name of the deployment or model
+    :param requests_per_minute: Request budget, used when the limiter is created
+    :param tokens_per_minute: Token budget, used when the limiter is created
+    :return: RateLimiter shared by the callers of the deployment
+    """
+    if name not in rate_limiters:
+        rate_limiters[name] = RateLimiter(
+            requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute, **kwargs
+        )
+    return rate_limiters[name]
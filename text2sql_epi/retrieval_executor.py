@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RetrievalExecutor:
+    """
+    Bounded thread pool running the blocking retrieval work (query encoding, similarity search)
+    of async code, so that the event loop keeps serving the LLM and database calls meanwhile.
+    """
+
+    def __init__(self, max_workers=2, max_pending=None) -> None:
+        """
+        :param max_workers: Number of retrieval threads. Encoding and matrix products release
+            the GIL, so a few threads are enough to keep the cores busy
+        :param max_pending: Maximum number of retrievals submitted at once (running or queued),
+            further callers wait before submitting (None: 4 * max_workers)
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending if max_pending is not None else 4 * max_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # asyncio.Semaphore is bound to one event loop: one per loop using the executor
+        self._semaphores = weakref.WeakKeyDictionary()
+        self.n_submitted = 0
+        self.n_waiting = 0
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="retrieval"
+                )
+            return self._executor
+
+    def _get_semaphore(self, loop):
+        with self._executor_lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.max_pending)
+                self._semaphores[loop] = semaphore
+            return semaphore
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) on a retrieval thread and return its result.
+
+        When max_pending retrievals are already submitted, wait (without blocking the event
+        loop) for one of them to finish first.
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self._get_semaphore(loop)
+        if semaphore.locked():
+            self.n_waiting += 1
+            logger.debug(f"{self.max_pending} retrievals pending, waiting for a free slot")
+        async with semaphore:
+            self.n_submitted += 1
+            return await loop.run_in_executor(
+                self._get_executor(), functools.partial(fn, *args, **kwargs)
+            )
+
+    def get_stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "submitted": self.n_submitted,
+            "waited": self.n_waiting,
+        }
+
+    def shutdown(self, wait=True):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+# shared by all query libraries and ontologies of the process
+default_retrieval_executor = RetrievalExecutor()
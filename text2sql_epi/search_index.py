@@ -0,0 +1,883 @@
+import copy
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingIndex:
+    """Search-ready embedding index: L2-normalised contiguous matrix and row to record mapping"""
+
+    backend = "exact"
+
+    def __init__(
+        self,
+        embed_matrix,
+        idx_records=None,
+        model_name=None,
+        memory_budget_mb=256,
+        rows_normalized=False,
+    ) -> None:
+        """
+        :param embed_matrix: Embedding matrix, one row per record
+        :param idx_records: Position in the library of the record of each row (default: all rows in order)
+        :param model_name: Name of the embedding model used to compute embed_matrix
+        :param memory_budget_mb: Maximum size of the blocks of the similarity matrix computed at once
+        :param rows_normalized: True if the rows of embed_matrix are known to have a unit norm
+            (e.g. recorded in the manifest of an index folder), to skip reading the whole
+            matrix to check them
+        """
+        self.model_name = model_name
+        self.memory_budget_mb = memory_budget_mb
+        if rows_normalized:
+            self.embed_matrix = np.ascontiguousarray(embed_matrix, dtype=np.float32)
+        else:
+            self.embed_matrix = self.normalize_rows(embed_matrix)
+        if idx_records is None:
+            idx_records = np.arange(self.embed_matrix.shape[0])
+        self.idx_records = np.asarray(idx_records, dtype=np.int64)
+
+    def __len__(self):
+        return self.embed_matrix.shape[0]
+
+    @staticmethod
+    def normalize_rows(embed_matrix, atol=1e-3, block_size=65536):
+        """
+        Return embed_matrix as a C-contiguous float32 matrix with unit-norm rows.
+
+        Matrices which are already normalised are returned without copy. They are checked in
+        blocks of block_size rows, stopping at the first block which is not normalised.
+        """
+        embed_matrix = np.asarray(embed_matrix)
+        if embed_matrix.ndim != 2 or embed_matrix.shape[0] == 0:
+            return np.ascontiguousarray(embed_matrix, dtype=np.float32)
+
+        if embed_matrix.dtype == np.float32 and embed_matrix.flags["C_CONTIGUOUS"]:
+            is_normalized = all(
+                np.allclose(row_norms(embed_matrix[start : start + block_size]), 1.0, atol=atol)
+                for start in range(0, embed_matrix.shape[0], block_size)
+            )
+            if is_normalized:
+                return embed_matrix
+
+        logger.debug("Normalising embedding matrix of the search index")
+        return np.ascontiguousarray(
+            embed_matrix / np.maximum(row_norms(embed_matrix), 1e-12)[:, None], dtype=np.float32
+        )
+
+    def similarity(self, query_embeddings):
+        """Cosine similarity between the (normalised) query embeddings and all rows of the index"""
+        return np.asarray(query_embeddings, dtype=np.float32) @ self.embed_matrix.T
+
+    def search(self, query_embeddings, top_k, sim_threshold=None):
+        """
+        Blocked exact search: the similarity matrix is computed in tiles of at most
+        memory_budget_mb and a running top_k is kept per query, so peak memory does not depend on
+        the size of the index.
+
+        :param query_embeddings: Normalised query embeddings, one row per query
+        :param top_k: Number of records returned per query
+        :param sim_threshold: Minimum similarity score (None: no threshold)
+        :return: (positions of the records in the library, scores), both of shape
+            (n_queries, top_k). Positions are -1 (and scores -inf) when less than top_k records
+            are above sim_threshold
+        """
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        n_queries, n_rows = query_embeddings.shape[0], len(self)
+        top_k = max(0, min(top_k, n_rows))
+
+        budget_floats = max(1, int(self.memory_budget_mb * 10 ** 6 / 4))
+        min_tile_rows = min(n_rows, max(1024, top_k))
+        query_block_size = max(1, budget_floats // max(1, min_tile_rows))
+
+        idx_out = np.full((n_queries, top_k), -1, dtype=np.int64)
+        scores_out = np.full((n_queries, top_k), -np.inf, dtype=np.float32)
+        for query_start in range(0, n_queries, query_block_size):
+            query_block = query_embeddings[query_start : query_start + query_block_size]
+            tile_rows = max(min_tile_rows, budget_floats // query_block.shape[0])
+
+            idx_running = np.empty((query_block.shape[0], 0), dtype=np.int64)
+            scores_running = np.empty((query_block.shape[0], 0), dtype=np.float32)
+            for tile_start in range(0, n_rows, tile_rows):
+                sim_tile = query_block @ self.embed_matrix[tile_start : tile_start + tile_rows].T
+                if sim_threshold is not None:
+                    # candidates below the threshold never enter the running top_k
+                    sim_tile[sim_tile < sim_threshold] = -np.inf
+                idx_tile, scores_tile = top_k_similar(sim_tile, top_k)
+                idx_running = np.concatenate([idx_running, idx_tile + tile_start], axis=1)
+                scores_running = np.concatenate([scores_running, scores_tile], axis=1)
+                idx_keep, scores_running = top_k_similar(scores_running, top_k)
+                idx_running = np.take_along_axis(idx_running, idx_keep, axis=1)
+
+            query_end = query_start + query_block.shape[0]
+            is_found = np.isfinite(scores_running)
+            idx_out[query_start:query_end] = np.where(
+                is_found, self.idx_records[idx_running], -1
+            )
+            scores_out[query_start:query_end] = scores_running
+
+        return idx_out, scores_out
+
+    def get_params(self):
+        return {"memory_budget_mb": self.memory_budget_mb}
+
+    def get_row_range(self, start, stop):
+        """
+        Index of the rows start:stop, searched with the same backend. The view shares the
+        embedding matrix and the structures of this index (no copy), so that the partitions of
+        an ontology sorted by partition do not duplicate its index.
+        """
+        view = copy.copy(self)
+        view.embed_matrix = self.embed_matrix[start:stop]
+        view.idx_records = self.idx_records[start:stop]
+        return view
+
+    def save(self, index_dir, prefix="search_index"):
+        """
+        Write the index structures to index_dir (nothing for the exact index, which only uses the
+        embedding matrix).
+
+        :return: manifest entry passed to load_search_index
+        """
+        return {"backend": self.backend, "params": self.get_params(), "files": {}}
+
+    @classmethod
+    def load(
+        cls,
+        index_dir,
+        manifest_entry,
+        embed_matrix,
+        idx_records=None,
+        model_name=None,
+        rows_normalized=False,
+    ):
+        return cls(
+            embed_matrix,
+            idx_records=idx_records,
+            model_name=model_name,
+            rows_normalized=rows_normalized,
+            **manifest_entry["params"],
+        )
+
+
+class IVFIndex(EmbeddingIndex):
+    """
+    Inverted file index: rows are clustered with spherical k-means and a query only scores the
+    rows of its n_probe closest clusters. Candidates are scored exactly with the float matrix.
+    """
+
+    backend = "ivf"
+
+    def __init__(
+        self,
+        embed_matrix,
+        idx_records=None,
+        model_name=None,
+        n_lists=None,
+        n_probe=8,
+        n_iter=10,
+        n_train=100000,
+        seed=0,
+        centroids=None,
+        list_offsets=None,
+        list_rows=None,
+        rows_normalized=False,
+    ) -> None:
+        """
+        :param n_lists: Number of clusters (default: 4 * sqrt(number of rows))
+        :param n_probe: Number of clusters scored per query
+        :param n_iter: Number of k-means iterations
+        :param n_train: Maximum number of rows used to train the clusters
+        :param centroids, list_offsets, list_rows: Pre-computed clusters (when loading an index)
+        """
+        super().__init__(
+            embed_matrix,
+            idx_records=idx_records,
+            model_name=model_name,
+            rows_normalized=rows_normalized,
+        )
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.n_train = n_train
+        self.seed = seed
+
+        if centroids is None:
+            if n_lists is None:
+                n_lists = int(4 * np.sqrt(len(self)))
+            n_lists = max(1, min(n_lists, len(self)))
+            centroids, list_offsets, list_rows = self.train(n_lists)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    def assign(self, embed_matrix, block_size=65536):
+        assignment = np.empty(embed_matrix.shape[0], dtype=np.int64)
+        for start in range(0, embed_matrix.shape[0], block_size):
+            block = np.asarray(embed_matrix[start : start + block_size])
+            assignment[start : start + block_size] = np.argmax(
+                block @ self.centroids.T, axis=1
+            )
+        return assignment
+
+    def train(self, n_lists):
+        rng = np.random.default_rng(self.seed)
+        n_rows = len(self)
+        idx_train = np.sort(rng.choice(n_rows, size=min(self.n_train, n_rows), replace=False))
+        train_matrix = np.asarray(self.embed_matrix[idx_train])
+
+        self.centroids = train_matrix[
+            rng.choice(train_matrix.shape[0], size=n_lists, replace=False)
+        ].copy()
+        for _ in range(self.n_iter):
+            assignment = np.argmax(train_matrix @ self.centroids.T, axis=1)
+            centroids = np.zeros_like(self.centroids)
+            np.add.at(centroids, assignment, train_matrix)
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            # empty clusters keep their previous centroid
+            is_empty = norms[:, 0] == 0
+            centroids[is_empty] = self.centroids[is_empty]
+            norms[is_empty] = 1.0
+            self.centroids = (centroids / norms).astype(np.float32)
+
+        assignment = self.assign(self.embed_matrix)
+        list_rows = np.argsort(assignment, kind="stable")
+        list_offsets = np.searchsorted(assignment[list_rows], np.arange(n_lists + 1))
+        logger.info(f"IVF index trained with {n_lists} lists on {len(idx_train)} rows")
+        return self.centroids, list_offsets, list_rows
+
+    def search(self, query_embeddings, top_k, sim_threshold=None):
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        n_probe = min(self.n_probe, self.n_lists)
+        centroid_scores = query_embeddings @ self.centroids.T
+        # the lists of a row range view can be empty: they are probed last
+        centroid_scores[:, np.diff(self.list_offsets) == 0] = -np.inf
+        idx_lists, _ = top_k_similar(centroid_scores, n_probe)
+
+        idx_out = np.full((query_embeddings.shape[0], top_k), -1, dtype=np.int64)
+        scores_out = np.full((query_embeddings.shape[0], top_k), -np.inf, dtype=np.float32)
+        for idx_query, query_lists in enumerate(idx_lists):
+            idx_rows = np.concatenate(
+                [
+                    self.list_rows[self.list_offsets[idx_list] : self.list_offsets[idx_list + 1]]
+                    for idx_list in query_lists
+                ]
+            )
+            scores = self.embed_matrix[idx_rows] @ query_embeddings[idx_query]
+            if sim_threshold is not None:
+                is_above = scores >= sim_threshold
+                idx_rows, scores = idx_rows[is_above], scores[is_above]
+            idx_top, scores_top = top_k_similar(scores[None, :], top_k)
+            n_found = idx_top.shape[1]
+            idx_out[idx_query, :n_found] = self.idx_records[idx_rows[idx_top[0]]]
+            scores_out[idx_query, :n_found] = scores_top[0]
+
+        return idx_out, scores_out
+
+    def get_params(self):
+        return {"n_probe": self.n_probe, "n_iter": self.n_iter, "seed": self.seed}
+
+    def get_row_range(self, start, stop):
+        """
+        The view keeps the clusters of this index, restricted to the rows start:stop, and probes
+        more of them to score as many rows as the index. Small ranges are searched exactly.
+        """
+        if stop - start < MIN_VIEW_FRACTION * len(self):
+            return get_exact_row_range(self, start, stop)
+        view = super().get_row_range(start, stop)
+        view.n_probe = min(self.n_lists, int(np.ceil(self.n_probe * len(self) / len(view))))
+        # the rows of each list are sorted: the rows of the range keep the order of the lists
+        list_ids = np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets))
+        in_range = (self.list_rows >= start) & (self.list_rows < stop)
+        view.list_rows = self.list_rows[in_range] - start
+        view.list_offsets = np.searchsorted(list_ids[in_range], np.arange(self.n_lists + 1))
+        return view
+
+    def save(self, index_dir, prefix="search_index"):
+        files = {
+            "centroids": f"{prefix}_ivf_centroids.npy",
+            "list_offsets": f"{prefix}_ivf_list_offsets.npy",
+            "list_rows": f"{prefix}_ivf_list_rows.npy",
+        }
+        for key, file in files.items():
+            np.save(os.path.join(index_dir, file), getattr(self, key))
+        return {"backend": self.backend, "params": self.get_params(), "files": files}
+
+    @classmethod
+    def load(
+        cls,
+        index_dir,
+        manifest_entry,
+        embed_matrix,
+        idx_records=None,
+        model_name=None,
+        rows_normalized=False,
+    ):
+        arrays = {
+            key: np.load(os.path.join(index_dir, file))
+            for key, file in manifest_entry["files"].items()
+        }
+        return cls(
+            embed_matrix,
+            idx_records=idx_records,
+            model_name=model_name,
+            rows_normalized=rows_normalized,
+            **manifest_entry["params"],
+            **arrays,
+        )
+
+
+class HNSWIndex(EmbeddingIndex):
+    """Hierarchical navigable small world graph index (requires the optional hnswlib package)"""
+
+    backend = "hnsw"
+
+    def __init__(
+        self,
+        embed_matrix,
+        idx_records=None,
+        model_name=None,
+        m=32,
+        ef_construction=200,
+        ef_search=128,
+        num_threads=-1,
+        hnsw_file=None,
+        rows_normalized=False,
+    ) -> None:
+        """
+        :param m: Number of neighbours per node of the graph
+        :param ef_construction: Size of the candidate list when building the graph
+        :param ef_search: Size of the candidate list when searching (higher: better recall, slower)
+        :param num_threads: Number of threads used to build and query the graph (-1: all cores)
+        :param hnsw_file: Pre-computed graph (when loading an index)
+        """
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImportError(
+                "The hnsw search backend requires hnswlib: pip install hnswlib"
+            ) from e
+
+        super().__init__(
+            embed_matrix,
+            idx_records=idx_records,
+            model_name=model_name,
+            rows_normalized=rows_normalized,
+        )
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.num_threads = num_threads
+
+        n_rows, dim = self.embed_matrix.shape
+        self.graph = hnswlib.Index(space="ip", dim=dim)
+        if hnsw_file is not None:
+            self.graph.load_index(hnsw_file, max_elements=n_rows)
+        else:
+            self.graph.init_index(
+                max_elements=n_rows, ef_construction=ef_construction, M=m
+            )
+            self.graph.add_items(
+                self.embed_matrix, np.arange(n_rows), num_threads=num_threads
+            )
+            logger.info(f"HNSW index built with {n_rows} rows")
+        self.graph.set_ef(ef_search)
+        self.row_range = None
+
+    def search(self, query_embeddings, top_k, sim_threshold=None):
+        if self.row_range is not None:
+            return self.search_row_range(query_embeddings, top_k, sim_threshold)
+        top_k = min(top_k, len(self))
+        # ef is only set in __init__: set_ef would race with the searches of other threads, and
+        # hnswlib already searches with max(ef, top_k)
+        idx_rows, distances = self.graph.knn_query(
+            np.asarray(query_embeddings, dtype=np.float32),
+            k=top_k,
+            num_threads=self.num_threads,
+        )
+        # hnswlib returns 1 - inner product for the "ip" space
+        return apply_sim_threshold(
+            self.idx_records[idx_rows.astype(np.int64)],
+            (1.0 - distances).astype(np.float32),
+            sim_threshold,
+        )
+
+    def get_row_range(self, start, stop):
+        """
+        The view searches the graph of this index, keeping only the rows start:stop. Small
+        ranges are searched exactly.
+        """
+        if stop - start < MIN_VIEW_FRACTION * len(self):
+            return get_exact_row_range(self, start, stop)
+        view = super().get_row_range(start, stop)
+        view.row_range = (start, stop)
+        return view
+
+    def search_row_range(self, query_embeddings, top_k, sim_threshold=None):
+        start, stop = self.row_range
+        top_k = min(top_k, len(self))
+        try:
+            # the filter is a Python callback: one thread, the others would wait for the GIL
+            idx_rows, distances = self.graph.knn_query(
+                np.asarray(query_embeddings, dtype=np.float32),
+                k=top_k,
+                num_threads=1,
+                filter=lambda row: start <= row < stop,
+            )
+        except RuntimeError:
+            # hnswlib found less than top_k rows of the range
+            return EmbeddingIndex.search(self, query_embeddings, top_k, sim_threshold)
+        return apply_sim_threshold(
+            self.idx_records[idx_rows.astype(np.int64) - start],
+            (1.0 - distances).astype(np.float32),
+            sim_threshold,
+        )
+
+    def get_params(self):
+        return {
+            "m": self.m,
+            "ef_construction": self.ef_construction,
+            "ef_search": self.ef_search,
+            "num_threads": self.num_threads,
+        }
+
+    def save(self, index_dir, prefix="search_index"):
+        hnsw_file = f"{prefix}_hnsw.bin"
+        self.graph.save_index(os.path.join(index_dir, hnsw_file))
+        return {
+            "backend": self.backend,
+            "params": self.get_params(),
+            "files": {"hnsw_file": hnsw_file},
+        }
+
+    @classmethod
+    def load(
+        cls,
+        index_dir,
+        manifest_entry,
+        embed_matrix,
+        idx_records=None,
+        model_name=None,
+        rows_normalized=False,
+    ):
+        return cls(
+            embed_matrix,
+            idx_records=idx_records,
+            model_name=model_name,
+            rows_normalized=rows_normalized,
+            hnsw_file=os.path.join(index_dir, manifest_entry["files"]["hnsw_file"]),
+            **manifest_entry["params"],
+        )
+
+
+class QuantizedIndex(EmbeddingIndex):
+    """
+    Base class of the quantised indices: a first pass scores compact codes kept in memory, then the
+    n_rescore best candidates are rescored with the exact float vectors, which can stay on disk
+    (memory-mapped embedding matrix).
+    """
+
+    backend = None
+
+    def __init__(
+        self,
+        embed_matrix,
+        idx_records=None,
+        model_name=None,
+        n_rescore=100,
+        block_size=65536,
+        codes=None,
+        rows_normalized=False,
+        **quantization_params,
+    ) -> None:
+        """
+        :param n_rescore: Number of candidates of the first pass rescored with the float vectors
+        :param block_size: Number of rows scored at once by the first pass
+        :param codes: Pre-computed codes (when loading an index)
+        """
+        super().__init__(
+            embed_matrix,
+            idx_records=idx_records,
+            model_name=model_name,
+            rows_normalized=rows_normalized,
+        )
+        self.n_rescore = n_rescore
+        self.block_size = block_size
+        if codes is None:
+            codes, quantization_params = self.quantize(self.embed_matrix)
+            logger.info(
+                f"{self.backend} index built with {len(self)} rows "
+                f"({codes.nbytes / 10 ** 6:.1f} Mb of codes)"
+            )
+        self.codes = codes
+        for key, value in quantization_params.items():
+            setattr(self, key, value)
+
+    def quantize(self, embed_matrix):
+        """:return: codes, dict of the quantisation parameters (saved as arrays)"""
+        raise NotImplementedError
+
+    def score_codes(self, query_embeddings, codes):
+        """First-pass scores (higher is more similar) of the queries against a block of codes"""
+        raise NotImplementedError
+
+    def get_quantization_arrays(self):
+        return {}
+
+    def search(self, query_embeddings, top_k, sim_threshold=None):
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        idx_candidates = self.select_candidates(query_embeddings, top_k)
+        return self.rescore_candidates(query_embeddings, idx_candidates, top_k, sim_threshold)
+
+    def select_candidates(self, query_embeddings, top_k):
+        """
+        First pass on the codes, keeping the best n_rescore rows per query over the blocks.
+
+        :param query_embeddings: Query embeddings scored by score_codes
+        :return: rows of the candidates, of shape (n_queries, n_candidates)
+        """
+        n_candidates = min(max(self.n_rescore, top_k), len(self))
+        idx_candidates = np.empty((query_embeddings.shape[0], 0), dtype=np.int64)
+        scores_candidates = np.empty((query_embeddings.shape[0], 0), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            scores_block = self.score_codes(
+                query_embeddings, self.codes[start : start + self.block_size]
+            )
+            idx_block, scores_block = top_k_similar(scores_block, n_candidates)
+            idx_candidates = np.concatenate([idx_candidates, idx_block + start], axis=1)
+            scores_candidates = np.concatenate([scores_candidates, scores_block], axis=1)
+            idx_keep, scores_candidates = top_k_similar(scores_candidates, n_candidates)
+            idx_candidates = np.take_along_axis(idx_candidates, idx_keep, axis=1)
+        return idx_candidates
+
+    def rescore_candidates(self, query_embeddings, idx_candidates, top_k, sim_threshold=None):
+        """Exact rescoring: only the rows of the candidates are read from the float matrix"""
+        idx_out = np.full((query_embeddings.shape[0], top_k), -1, dtype=np.int64)
+        scores_out = np.full((query_embeddings.shape[0], top_k), -np.inf, dtype=np.float32)
+        for idx_query, idx_rows in enumerate(idx_candidates):
+            idx_rows = np.sort(idx_rows)
+            scores = np.asarray(self.embed_matrix[idx_rows]) @ query_embeddings[idx_query]
+            if sim_threshold is not None:
+                is_above = scores >= sim_threshold
+                idx_rows, scores = idx_rows[is_above], scores[is_above]
+            idx_top, scores_top = top_k_similar(scores[None, :], top_k)
+            n_found = idx_top.shape[1]
+            idx_out[idx_query, :n_found] = self.idx_records[idx_rows[idx_top[0]]]
+            scores_out[idx_query, :n_found] = scores_top[0]
+
+        return idx_out, scores_out
+
+    def get_params(self):
+        return {"n_rescore": self.n_rescore, "block_size": self.block_size}
+
+    def get_row_range(self, start, stop):
+        view = super().get_row_range(start, stop)
+        view.codes = self.codes[start:stop]
+        return view
+
+    def save(self, index_dir, prefix="search_index"):
+        arrays = {"codes": self.codes, **self.get_quantization_arrays()}
+        files = {key: f"{prefix}_{self.backend}_{key}.npy" for key in arrays}
+        for key, array in arrays.items():
+            np.save(os.path.join(index_dir, files[key]), array)
+        return {"backend": self.backend, "params": self.get_params(), "files": files}
+
+    @classmethod
+    def load(
+        cls,
+        index_dir,
+        manifest_entry,
+        embed_matrix,
+        idx_records=None,
+        model_name=None,
+        rows_normalized=False,
+    ):
+        # the codes are memory-mapped as well, so that workers on one host share them
+        arrays = {
+            key: np.load(os.path.join(index_dir, file), mmap_mode="r")
+            for key, file in manifest_entry["files"].items()
+        }
+        return cls(
+            embed_matrix,
+            idx_records=idx_records,
+            model_name=model_name,
+            rows_normalized=rows_normalized,
+            **manifest_entry["params"],
+            **arrays,
+        )
+
+
+class Int8Index(QuantizedIndex):
+    """Scalar int8 quantisation with one scale per dimension (4x smaller than float32)"""
+
+    backend = "int8"
+
+    def quantize(self, embed_matrix):
+        scale = np.zeros(embed_matrix.shape[1], dtype=np.float32)
+        for start in range(0, embed_matrix.shape[0], self.block_size):
+            block = np.asarray(embed_matrix[start : start + self.block_size])
+            scale = np.maximum(scale, np.abs(block).max(axis=0))
+        scale = np.maximum(scale, 1e-12) / 127.0
+
+        codes = np.empty(embed_matrix.shape, dtype=np.int8)
+        for start in range(0, embed_matrix.shape[0], self.block_size):
+            block = np.asarray(embed_matrix[start : start + self.block_size])
+            codes[start : start + self.block_size] = np.clip(
+                np.rint(block / scale), -127, 127
+            )
+        return codes, {"scale": scale}
+
+    def score_codes(self, query_embeddings, codes):
+        query_scaled = query_embeddings * self.scale
+        if query_scaled.shape[0] <= 2:
+            # few queries: avoid converting the whole block of codes to float32
+            return np.einsum("qj,ij->qi", query_scaled, codes, dtype=np.float32)
+        return query_scaled @ codes.astype(np.float32).T
+
+    def get_quantization_arrays(self):
+        return {"scale": self.scale}
+
+
+# number of bits set in each byte value
+POPCOUNT_TABLE = (
+    np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+    .sum(axis=1)
+    .astype(np.uint8)
+)
+
+
+class BinaryIndex(QuantizedIndex):
+    """Sign-bit quantisation scored with the Hamming distance (32x smaller than float32)"""
+
+    backend = "binary"
+
+    def quantize(self, embed_matrix):
+        codes = np.empty(
+            (embed_matrix.shape[0], -(-embed_matrix.shape[1] // 8)), dtype=np.uint8
+        )
+        for start in range(0, embed_matrix.shape[0], self.block_size):
+            block = np.asarray(embed_matrix[start : start + self.block_size])
+            codes[start : start + self.block_size] = np.packbits(block > 0, axis=1)
+        return codes, {}
+
+    def score_codes(self, query_embeddings, codes):
+        query_codes = np.packbits(query_embeddings > 0, axis=1)
+        hamming = np.empty((query_codes.shape[0], codes.shape[0]), dtype=np.int32)
+        # pack 8 bytes per word for the popcount when the number of bytes allows it
+        if codes.shape[1] % 8 == 0 and hasattr(np, "bitwise_count"):
+            codes = np.ascontiguousarray(codes).view(np.uint64)
+            query_codes = query_codes.view(np.uint64)
+        for idx_query, query_code in enumerate(query_codes):
+            xor_codes = np.bitwise_xor(codes, query_code)
+            if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+                hamming[idx_query] = np.bitwise_count(xor_codes).sum(axis=1, dtype=np.int32)
+            else:
+                hamming[idx_query] = POPCOUNT_TABLE[xor_codes].sum(axis=1, dtype=np.int32)
+        return -hamming
+
+
+class CascadeIndex(QuantizedIndex):
+    """
+    Two-stage search: a cheaper first pass selects n_rescore candidates over all rows, which are
+    rescored with the full embeddings. The first pass scores either the first truncate_dim
+    dimensions of the embeddings, or the embeddings of a smaller model (first_pass_matrix),
+    which are then queried with the first_pass_embeddings of search.
+    """
+
+    backend = "cascade"
+
+    def __init__(
+        self,
+        embed_matrix,
+        idx_records=None,
+        model_name=None,
+        n_rescore=100,
+        block_size=65536,
+        codes=None,
+        truncate_dim=256,
+        first_pass_model_name=None,
+        first_pass_matrix=None,
+        rows_normalized=False,
+    ) -> None:
+        """
+        :param truncate_dim: Number of leading dimensions scored by the first pass (without
+            first_pass_model_name)
+        :param first_pass_model_name: Name of the model of first_pass_matrix (None: truncation)
+        :param first_pass_matrix: Embeddings of the same rows with the first-pass model (not
+            needed when loading an index)
+        """
+        self.truncate_dim = truncate_dim
+        self.first_pass_model_name = first_pass_model_name
+        self._first_pass_matrix = first_pass_matrix
+        super().__init__(
+            embed_matrix,
+            idx_records=idx_records,
+            model_name=model_name,
+            n_rescore=n_rescore,
+            block_size=block_size,
+            codes=codes,
+            rows_normalized=rows_normalized,
+        )
+        # the first-pass embeddings are kept as codes
+        self._first_pass_matrix = None
+
+    def quantize(self, embed_matrix):
+        if self.first_pass_model_name is None:
+            return self.normalize_rows(np.asarray(embed_matrix[:, : self.truncate_dim])), {}
+        if self._first_pass_matrix is None:
+            raise ValueError(
+                f"The embeddings of the first-pass model {self.first_pass_model_name} are "
+                "needed to build the cascade index"
+            )
+        if self._first_pass_matrix.shape[0] != embed_matrix.shape[0]:
+            raise ValueError(
+                f"The first-pass embeddings have {self._first_pass_matrix.shape[0]} rows, "
+                f"expected {embed_matrix.shape[0]}"
+            )
+        return self.normalize_rows(self._first_pass_matrix), {}
+
+    def score_codes(self, query_embeddings, codes):
+        return query_embeddings @ codes.T
+
+    def search(self, query_embeddings, top_k, sim_threshold=None, first_pass_embeddings=None):
+        """
+        :param first_pass_embeddings: Normalised query embeddings of the first-pass model
+            (required with first_pass_model_name)
+        """
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if self.first_pass_model_name is None:
+            first_pass_embeddings = self.normalize_rows(
+                query_embeddings[:, : self.truncate_dim]
+            )
+        elif first_pass_embeddings is None:
+            raise ValueError(
+                f"Query embeddings of the first-pass model {self.first_pass_model_name} are "
+                "needed to search the cascade index"
+            )
+        idx_candidates = self.select_candidates(
+            np.asarray(first_pass_embeddings, dtype=np.float32), top_k
+        )
+        return self.rescore_candidates(query_embeddings, idx_candidates, top_k, sim_threshold)
+
+    def get_params(self):
+        return {
+            **super().get_params(),
+            "truncate_dim": self.truncate_dim,
+            "first_pass_model_name": self.first_pass_model_name,
+        }
+
+
+# a view of an IVF or HNSW index over less than this share of its rows is searched exactly: its
+# rows are too scattered over the clusters or the graph to be found by a filtered search
+MIN_VIEW_FRACTION = 0.1
+
+
+def get_exact_row_range(search_index, start, stop):
+    """:return: exact index of the rows start:stop of search_index, sharing its matrix"""
+    return EmbeddingIndex(
+        search_index.embed_matrix[start:stop],
+        idx_records=search_index.idx_records[start:stop],
+        model_name=search_index.model_name,
+        memory_budget_mb=search_index.memory_budget_mb,
+        rows_normalized=True,
+    )
+
+
+SEARCH_INDEX_BACKENDS = {
+    index_class.backend: index_class
+    for index_class in [
+        EmbeddingIndex,
+        IVFIndex,
+        HNSWIndex,
+        Int8Index,
+        BinaryIndex,
+        CascadeIndex,
+    ]
+}
+
+
+def create_search_index(
+    embed_matrix, backend="exact", idx_records=None, model_name=None, **params
+):
+    """
+    :param embed_matrix: Embedding matrix, one row per record
+    :param backend: "exact" (brute force), "ivf", "hnsw" (approximate nearest neighbours),
+        "int8" or "binary" (quantised codes with exact rescoring), "cascade" (truncated
+        dimensions or smaller model, with exact rescoring)
+    :param params: Parameters of the backend
+    """
+    if backend not in SEARCH_INDEX_BACKENDS:
+        raise ValueError(
+            f"Unknown search backend {backend}, use one of {list(SEARCH_INDEX_BACKENDS)}"
+        )
+    return SEARCH_INDEX_BACKENDS[backend](
+        embed_matrix, idx_records=idx_records, model_name=model_name, **params
+    )
+
+
+def load_search_index(
+    index_dir,
+    manifest_entry,
+    embed_matrix,
+    idx_records=None,
+    model_name=None,
+    rows_normalized=False,
+):
+    """
+    :param rows_normalized: True if the rows of embed_matrix have a unit norm (see
+        EmbeddingIndex), False to check them
+    """
+    return SEARCH_INDEX_BACKENDS[manifest_entry["backend"]].load(
+        index_dir,
+        manifest_entry,
+        embed_matrix,
+        idx_records=idx_records,
+        model_name=model_name,
+        rows_normalized=rows_normalized,
+    )
+
+
+def row_norms(embed_matrix):
+    """L2 norm of each row, without a temporary copy of the matrix"""
+    embed_matrix = np.asarray(embed_matrix, dtype=np.float32)
+    return np.sqrt(np.einsum("ij,ij->i", embed_matrix, embed_matrix))
+
+
+def apply_sim_threshold(idx_records, scores, sim_threshold):
+    """Mark the results below sim_threshold as not found (position -1, score -inf)"""
+    if sim_threshold is None:
+        return idx_records, scores
+    is_below = ~(scores >= sim_threshold)
+    return np.where(is_below, -1, idx_records), np.where(is_below, -np.inf, scores)
+
+
+def top_k_similar(sim_matrix, top_k):
+    """
+    Select the top_k columns of each row of sim_matrix, sorted by decreasing score.
+
+    :param sim_matrix: Similarity matrix of shape (n_queries, n_records)
+    :param top_k: Number of columns to select (capped to n_records)
+    :return: (column indices, scores), both of shape (n_queries, min(top_k, n_records))
+    """
+    n_rows, n_cols = sim_matrix.shape
+    top_k = max(0, min(top_k, n_cols))
+    if top_k == 0:
+        return np.empty((n_rows, 0), dtype=np.int64), np.empty(
+            (n_rows, 0), dtype=sim_matrix.dtype
+        )
+
+    if top_k < n_cols:
+        idx_top = np.argpartition(-sim_matrix, kth=top_k - 1, axis=1)[:, :top_k]
+    else:
+        idx_top = np.broadcast_to(np.arange(n_cols), (n_rows, n_cols))
+    scores_top = np.take_along_axis(sim_matrix, idx_top, axis=1)
+
+    order = np.argsort(-scores_top, axis=1, kind="stable")
+    idx_top = np.take_along_axis(idx_top, order, axis=1)
+    scores_top = np.take_along_axis(scores_top, order, axis=1)
+    return idx_top.astype(np.int64, copy=False), scores_top
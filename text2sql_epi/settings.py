@@ -18,6 +18,9 @@ class Settings(BaseSettings):
     AZURE_CLIENT_ID: str
     AZURE_CLIENT_SECRET: str
     AZURE_TENANT_ID: str
+    # budgets of the LLM deployments, e.g.
+    # {"gpt-4-turbo-1106-preview-ascent": {"requests_per_minute": 480, "tokens_per_minute": 80000}}
+    LLM_RATE_LIMITS: dict = {}
 
 
 settings = Settings()
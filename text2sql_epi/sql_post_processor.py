@@ -8,44 +8,123 @@ logger = logging.getLogger(__name__)
 ICD_VOCABULARIES = ["ICD10CM", "ICD9CM"]
 SNOMED_VOCABULARIES = ["SNOMED"]
 
+ENTITY_TO_DOMAIN_ID = {
+    "condition": "Condition",
+    "procedure": "Procedure",
+    "drug": "Drug",
+    "measurement": "Measurement",
+}
+
+# retrieval parameters of the placeholder concepts
+CONCEPTS_TOP_K_SCREENING = 10
+CONCEPTS_TOP_K_PROMPT = 4
+CONCEPTS_SIM_THRESHOLD = 0.0
+
 
 class MedicalSQLProcessor:
-    def __init__(self, assistant=None):
+    def __init__(self, assistant=None, concept_cache=None):
+        """
+        :param assistant: Assistant asked to correct invalid SQL queries
+        :param concept_cache: ConceptResolutionCache of the concepts retrieved for the
+            placeholders (None: always search the ontology)
+        """
         self.assistant = assistant
+        self.concept_cache = concept_cache
         self.condition = []
         self.procedure = []
         self.drug = []
         self.measurement = []
         self.concept_not_found = []
 
-    async def get_replacement_value(self, entity, name, medcodeonto=None):
-        entity_to_domain_id = {
-            "condition": "Condition",
-            "procedure": "Procedure",
-            "drug": "Drug",
-            "measurement": "Measurement",
-        }
-
-        if entity in entity_to_domain_id:
-            entity_codes_df = await medcodeonto.get_similar_codes_from_onto(question_masked=name,
-                                                                         top_k_screening=10,
-                                                                         top_k_prompt=4,
-                                                                         sim_threshold=0.0)
-
-            entity_codes = {name: entity_codes_df.to_dict('records')}
-            print(f"Retrieved codes: {entity_codes}")
-            print("Please note that the medical coding is based on a mockup ontology. "
-                  "Results will not be reliable")
-            # Get the current list for the entity
-            current_list = getattr(self, entity, [])
-            # Append the new entity codes to the list
-            current_list.append(entity_codes)
-            # Update the attribute on the object
-            setattr(self, entity, current_list)
-            return entity_codes
+    async def get_replacement_value(self, entity, name, medcodeonto=None, vocabularies=None):
+        if entity in ENTITY_TO_DOMAIN_ID:
+            cache_key = self.get_concept_cache_key(medcodeonto, name, ENTITY_TO_DOMAIN_ID[entity], vocabularies)
+            records = self.concept_cache.get(*cache_key) if cache_key is not None else None
+            if records is None:
+                # only search the concepts of the domain and vocabularies of the placeholder
+                entity_codes_df = await medcodeonto.get_similar_codes_from_onto(question_masked=name,
+                                                                             top_k_screening=CONCEPTS_TOP_K_SCREENING,
+                                                                             top_k_prompt=CONCEPTS_TOP_K_PROMPT,
+                                                                             sim_threshold=CONCEPTS_SIM_THRESHOLD,
+                                                                             domain_id=ENTITY_TO_DOMAIN_ID[entity],
+                                                                             vocabularies=vocabularies)
+                records = entity_codes_df.to_dict('records')
+                if cache_key is not None:
+                    self.concept_cache.put(*cache_key, records)
+            return self.record_entity_codes(entity, name, records)
         else:
             return []
 
+    def get_concept_cache_key(self, medcodeonto, name, domain_id, vocabularies):
+        """
+        :return: (ontology fingerprint, request key) of the concept cache, None without cache
+        """
+        if self.concept_cache is None:
+            return None
+        request_key = self.concept_cache.get_request_key(
+            name,
+            domain_id,
+            vocabularies,
+            top_k_screening=CONCEPTS_TOP_K_SCREENING,
+            top_k_prompt=CONCEPTS_TOP_K_PROMPT,
+            sim_threshold=CONCEPTS_SIM_THRESHOLD,
+        )
+        return medcodeonto.get_fingerprint(), request_key
+
+    def record_entity_codes(self, entity, name, records):
+        entity_codes = {name: records}
+        print(f"Retrieved codes: {entity_codes}")
+        print("Please note that the medical coding is based on a mockup ontology. "
+              "Results will not be reliable")
+        # Get the current list for the entity
+        current_list = getattr(self, entity, [])
+        # Append the new entity codes to the list
+        current_list.append(entity_codes)
+        # Update the attribute on the object
+        setattr(self, entity, current_list)
+        return entity_codes
+
+    async def resolve_placeholders(self, matches, explorer_concepts, medcodeonto, selected_coding=None):
+        """
+        Retrieve the concepts of all the placeholders of a query with one batch search.
+
+        :return: dict mapping each (entity, name) match to its entity codes {name: records}
+        """
+        matches_to_resolve = [
+            (entity, name) for entity, name in matches
+            if entity in ENTITY_TO_DOMAIN_ID and not (explorer_concepts and name in explorer_concepts)
+        ]
+        concept_requests = [
+            (name, ENTITY_TO_DOMAIN_ID[entity], selected_coding.get(entity) if selected_coding else None)
+            for entity, name in matches_to_resolve
+        ]
+        if not concept_requests:
+            return {}
+
+        cache_keys = [self.get_concept_cache_key(medcodeonto, *request) for request in concept_requests]
+        records_list = [
+            self.concept_cache.get(*cache_key) if cache_key is not None else None for cache_key in cache_keys
+        ]
+
+        # only the requests missing from the cache are searched
+        idx_missing = [idx for idx, records in enumerate(records_list) if records is None]
+        if idx_missing:
+            entity_codes_dfs = await medcodeonto.get_similar_codes_batch(
+                [concept_requests[idx] for idx in idx_missing],
+                top_k_screening=CONCEPTS_TOP_K_SCREENING,
+                top_k_prompt=CONCEPTS_TOP_K_PROMPT,
+                sim_threshold=CONCEPTS_SIM_THRESHOLD,
+            )
+            for idx, entity_codes_df in zip(idx_missing, entity_codes_dfs):
+                records_list[idx] = entity_codes_df.to_dict('records')
+                if cache_keys[idx] is not None:
+                    self.concept_cache.put(*cache_keys[idx], records_list[idx])
+
+        return {
+            (entity, name): self.record_entity_codes(entity, name, records)
+            for (entity, name), records in zip(matches_to_resolve, records_list)
+        }
+
     async def get_entity_codes(self, name, domain_id, vocabularies):
         tasks = [
             self.get_codes(name, domain_id, vocabulary_name)
@@ -64,11 +143,17 @@ class MedicalSQLProcessor:
                     merged_codes[key] = codes[key]
         return merged_codes
 
-    async def replace_function(self, match, medcodeonto):
+    async def replace_function(self, match, medcodeonto, selected_coding=None, resolved_concepts=None):
         entity, name = match
-        replacement_value = await self.get_replacement_value(
-            entity, name, medcodeonto
-        )
+        if resolved_concepts and match in resolved_concepts:
+            replacement_value = resolved_concepts[match]
+        else:
+            replacement_value = await self.get_replacement_value(
+                entity,
+                name,
+                medcodeonto,
+                vocabularies=selected_coding.get(entity) if selected_coding else None,
+            )
         return self.format_replacement_result(replacement_value[name])
 
     def format_replacement_result(self, result):
@@ -86,7 +171,6 @@ class MedicalSQLProcessor:
         self,
         sql_text,
         max_retries=5,
-        sleep_sec=0,
         explorer_concepts=None,
         selected_coding=None,
         rag=None,
@@ -102,8 +186,6 @@ class MedicalSQLProcessor:
             The initial SQL query text with placeholders for dynamic replacement.
         max_retries : int
             The maximum number of retries allowed to correct the SQL query.
-        sleep_sec : int
-            The number of seconds to wait before retrying.
         explorer_concepts : dict
             A dictionary of user selected concepts used for replacing placeholders in the SQL query.
         selected_coding : dict
@@ -134,7 +216,7 @@ class MedicalSQLProcessor:
 
             matches = re.findall(pattern, str(sql_text))
             modified_sql = await self.process_matches(
-                matches, sql_text, explorer_concepts, medcodeonto
+                matches, sql_text, explorer_concepts, medcodeonto, selected_coding
             )
 
             if "NO_CONCEPT_IDS_FOUND" in modified_sql:
@@ -145,31 +227,40 @@ class MedicalSQLProcessor:
                 return modified_sql
 
             # Make the sql correct
-            sql_text = await self.handle_invalid_sql(rag, sleep_sec)
+            sql_text = await self.handle_invalid_sql(rag)
             attempts += 1
 
         return sql_text
 
     async def process_matches(
-        self, matches, sql_text, explorer_concepts, medcodeonto=None
+        self, matches, sql_text, explorer_concepts, medcodeonto=None, selected_coding=None
     ):
         """
         Process all regex matches and replace them in the SQL text.
         """
+        # a placeholder used several times in the query is resolved once
+        matches = list(dict.fromkeys(matches))
+        resolved_concepts = None
+        if medcodeonto is not None:
+            resolved_concepts = await self.resolve_placeholders(
+                matches, explorer_concepts, medcodeonto, selected_coding
+            )
         coroutines = [
-            self.get_replacement(match, explorer_concepts, medcodeonto)
+            self.get_replacement(match, explorer_concepts, medcodeonto, selected_coding, resolved_concepts)
             for match in matches
         ]
         replacements = await asyncio.gather(*coroutines)
         return self.apply_replacements_to_sql(matches, replacements, sql_text)
 
-    async def get_replacement(self, match, explorer_concepts, medcodeonto):
+    async def get_replacement(
+        self, match, explorer_concepts, medcodeonto, selected_coding=None, resolved_concepts=None
+    ):
         """
         Get the replacement for a given match.
         """
         category, group_key = match
         if not explorer_concepts or group_key not in explorer_concepts:
-            return await self.replace_function(match, medcodeonto)
+            return await self.replace_function(match, medcodeonto, selected_coding, resolved_concepts)
 
         values = explorer_concepts[group_key]["value"]
         formatted_ids = self.format_replacement_result(values)
@@ -211,7 +302,7 @@ class MedicalSQLProcessor:
             modified_sql = modified_sql.replace(f"[{match[0]}@{match[1]}]", replacement)
         return modified_sql
 
-    async def handle_invalid_sql(self, rag, sleep_sec):
+    async def handle_invalid_sql(self, rag):
         """
         Handle the case where the SQL does not meet the required criteria.
         """
@@ -223,8 +314,6 @@ class MedicalSQLProcessor:
         rag.assistant.add_message(prompt)
         completed_prompt = await self.assistant.get_response()
         sql_text = self.parse_sql_from_response(completed_prompt)
-        if sleep_sec > 0:
-            await asyncio.sleep(sleep_sec)
         return sql_text
 
     @staticmethod